@@ -1,10 +1,12 @@
 db.createCollection("users")
 db.createCollection("groups")
 db.createCollection("apps")
+db.createCollection("memberships")
+db.createCollection("search_index")
 
-db.users.createIndex({"email": 1}, {unique: true})
-db.groups.createIndex({"groupName": 1}, {unique: true})
-db.apps.createIndex({"appName": 1}, {unique: true})
+// Indexes are declared in pyauth/schema.py, the jots container creates them at startup (runserv.py --ensure-indexes)
 
-db.groups.insert({groupName: "admin", groupId: UUID().toString().split('"')[1], members: []})
+var adminGroupId = UUID().toString().split('"')[1]
+db.groups.insert({groupName: "admin", groupId: adminGroupId})
+db.search_index.insert({kind: "groups", refId: adminGroupId, value: "admin", grams: ["adm", "dmi", "min"]})
 
@@ -0,0 +1,274 @@
+''' Durable outbox for personalised emails
+    Messages are stored in SQLite and sent by background worker threads,
+    so rendering and delivery happen off the request path
+    Failed sends are retried with exponential backoff up to MAIL_MAX_ATTEMPTS
+    MAILQUEUESYNC=1 sends inline instead, for tests and scripts
+    MAILQUEUEPATH must name the database file, e.g. on a volume shared by the web workers,
+    create_app checks one of the two is usable before serving
+'''
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from . import send
+
+MAIL_QUEUE_PATH = os.environ.get("MAILQUEUEPATH") # Outbox database file, required unless MAILQUEUESYNC=1
+MAIL_WORKERS = int(os.environ.get("MAILWORKERS", 2))
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAILMAXATTEMPTS", 5))
+MAIL_RETRY_BASE = float(os.environ.get("MAILRETRYBASE", 2)) # Seconds before the first retry, doubled for each after
+MAIL_POLL_INTERVAL = float(os.environ.get("MAILPOLLINTERVAL", 1)) # Seconds an idle worker waits before checking again
+MAIL_LEASE = float(os.environ.get("MAILLEASE", 60)) # Seconds a claimed message is held before another worker may retry it
+MAIL_QUEUE_SYNC = os.environ.get("MAILQUEUESYNC", "0") == "1"
+
+
+class Error(Exception):
+  pass
+
+class QueueError(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS outbox (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               recipient TEXT NOT NULL,
+               template_name TEXT NOT NULL,
+               template_path TEXT NOT NULL,
+               data TEXT NOT NULL,
+               mail_agent TEXT NOT NULL,
+               status TEXT NOT NULL DEFAULT 'pending',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               next_attempt REAL NOT NULL,
+               last_error TEXT,
+               created REAL NOT NULL)'''
+
+_INDEX = '''CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)'''
+
+logger = logging.getLogger(__name__)
+
+
+class mail_queue(object):
+  def __init__(self, path=None, workers=MAIL_WORKERS, max_attempts=MAIL_MAX_ATTEMPTS,
+               retry_base=MAIL_RETRY_BASE, poll_interval=MAIL_POLL_INTERVAL, lease=MAIL_LEASE):
+    if path is None:
+      path = MAIL_QUEUE_PATH
+    if not path:
+      # A path relative to whatever directory the server started in would lose mail quietly
+      raise QueueError("outbox", "MAILQUEUEPATH must be set to the outbox database file")
+
+    self.path = path
+    self.workers = workers
+    self.max_attempts = max_attempts
+    self.retry_base = retry_base
+    self.poll_interval = poll_interval
+    self.lease = lease
+
+    self._threads = list()
+    self._wake = threading.Event()
+    self._stop = threading.Event()
+    self._lock = threading.Lock()
+
+    try:
+      with self._connect() as con:
+        con.execute(_SCHEMA)
+        con.execute(_INDEX)
+    except sqlite3.Error as err:
+      raise QueueError("outbox", "could not open {} - {}".format(path, err))
+
+
+  def _connect(self):
+    # One short-lived connection per operation, sqlite3 connections can't be shared between threads
+    con = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    return _transaction(con)
+
+
+  def enqueue(self, email_obj, mail_agent="file"):
+    ''' Store a personalised_email for sending, returns message ID
+    '''
+    if not isinstance(email_obj, send.personalised_email):
+      raise QueueError("enqueue", "not a personalised email")
+
+    now = time.time()
+    try:
+      with self._connect() as con:
+        cursor = con.execute('''INSERT INTO outbox (recipient, template_name, template_path, data, mail_agent, next_attempt, created)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                             (email_obj.recipient, email_obj.template_name, email_obj.template_path,
+                              json.dumps(email_obj.data), mail_agent, now, now))
+        message_id = cursor.lastrowid
+    except sqlite3.Error as err:
+      raise QueueError("enqueue", "could not queue email - {}".format(err))
+
+    self._wake.set()
+    return message_id
+
+
+  def _claim(self):
+    ''' Take the oldest due message, leased so a crashed worker's message is picked up again
+        Returns row or None
+    '''
+    now = time.time()
+    # The transaction is BEGIN IMMEDIATE, so no other worker can claim between the SELECT and UPDATE
+    # Avoids UPDATE ... RETURNING, which needs SQLite 3.35
+    with self._connect() as con:
+      row = con.execute('''SELECT id, recipient, template_name, template_path, data, mail_agent, attempts
+                           FROM outbox
+                           WHERE status IN ('pending', 'sending') AND next_attempt <= ?
+                           ORDER BY next_attempt, id LIMIT 1''',
+                        (now,)).fetchone()
+      if row is not None:
+        con.execute("UPDATE outbox SET status = 'sending', next_attempt = ? WHERE id = ?",
+                    (now + self.lease, row[0]))
+      return row
+
+
+  def process_one(self):
+    ''' Send one due message
+        Returns True if a message was handled (sent or failed), False if none were due
+    '''
+    row = self._claim()
+    if row is None:
+      return False
+
+    message_id, recipient, template_name, template_path, data, mail_agent, attempts = row
+    try:
+      email_obj = send.personalised_email(recipient=recipient,
+                                          template_name=template_name,
+                                          data=json.loads(data),
+                                          template_path=template_path)
+      email_obj.send(mail_agent=mail_agent)
+
+    except send.Error as err:
+      self._failed(message_id, attempts + 1, err.message)
+      return True
+
+    except Exception as err:
+      self._failed(message_id, attempts + 1, str(err))
+      return True
+
+    with self._connect() as con:
+      con.execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+    return True
+
+
+  def _failed(self, message_id, attempts, error):
+    with self._connect() as con:
+      if attempts >= self.max_attempts:
+        con.execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                    (attempts, error, message_id))
+      else:
+        retry_at = time.time() + self.retry_base * (2 ** (attempts - 1))
+        con.execute("UPDATE outbox SET status = 'pending', attempts = ?, last_error = ?, next_attempt = ? WHERE id = ?",
+                    (attempts, error, retry_at, message_id))
+
+
+  def drain(self):
+    ''' Send everything currently due in the calling thread, returns count handled
+    '''
+    handled = 0
+    while self.process_one():
+      handled += 1
+    return handled
+
+
+  def stats(self):
+    ''' Returns count of messages per status
+    '''
+    with self._connect() as con:
+      rows = con.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+    return {status: count for status, count in rows}
+
+
+  def _worker(self):
+    while not self._stop.is_set():
+      try:
+        if self.process_one():
+          continue
+      except sqlite3.Error:
+        # Database busy or unavailable, back off and try again
+        logger.exception("mail outbox %s unavailable, retrying in %ss", self.path, self.poll_interval)
+      except Exception:
+        # Keep the worker alive, whatever went wrong is retried after the lease
+        logger.exception("mail outbox worker error")
+      self._wake.wait(self.poll_interval)
+      self._wake.clear()
+
+
+  def start(self):
+    with self._lock:
+      self._stop.clear()
+      self._threads = [thread for thread in self._threads if thread.is_alive()]
+      for n in range(self.workers - len(self._threads)):
+        thread = threading.Thread(target=self._worker, name="mail-outbox-{}".format(n), daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+
+  def stop(self, timeout=None):
+    with self._lock:
+      self._stop.set()
+      self._wake.set()
+      for thread in self._threads:
+        thread.join(timeout)
+      self._threads = list()
+
+
+class _transaction(object):
+  ''' Wraps a connection so each use is one immediate transaction, closed afterwards
+  '''
+  def __init__(self, con):
+    self.con = con
+
+  def __enter__(self):
+    self.con.execute("BEGIN IMMEDIATE")
+    return self.con
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      if exc_type is None:
+        self.con.execute("COMMIT")
+      else:
+        self.con.execute("ROLLBACK")
+    finally:
+      self.con.close()
+    return False
+
+
+_queues = dict()
+_queues_lock = threading.Lock()
+
+
+def get_queue():
+  ''' Queue for this process, workers are started on first use
+      Threads don't survive a fork, each process starts its own
+  '''
+  with _queues_lock:
+    queue_obj = _queues.get(os.getpid())
+    if queue_obj is None:
+      queue_obj = mail_queue()
+      queue_obj.start()
+      _queues.clear()
+      _queues[os.getpid()] = queue_obj
+    return queue_obj
+
+
+def check():
+  ''' Raises QueueError unless mail can be sent, inline with MAILQUEUESYNC or through the outbox
+      Run at startup, so a missing outbox fails the server rather than the first request that sends mail
+  '''
+  if MAIL_QUEUE_SYNC:
+    return
+  mail_queue(workers=0)
+
+
+def enqueue(email_obj, mail_agent="file"):
+  ''' Queue a personalised_email, or send it now if MAILQUEUESYNC is set
+  '''
+  if MAIL_QUEUE_SYNC:
+    return email_obj.send(mail_agent=mail_agent)
+  return get_queue().enqueue(email_obj, mail_agent=mail_agent)
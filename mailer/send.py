@@ -1,8 +1,15 @@
 import os
+import threading
+import functools
+import concurrent.futures
 import jinja2
 
 from . import to_file
 
+MAIL_TEMPLATE_RELOAD = os.environ.get("MAILTEMPLATERELOAD", "0") == "1" # Re-check template mtimes, for development
+MAIL_TEMPLATE_CACHE = os.environ.get("MAILTEMPLATECACHE") # Directory for compiled template bytecode, defaults to a temp dir
+DEFAULT_TEMPLATE_PATH = "{}/templates/".format(os.path.dirname(os.path.abspath(__file__)))
+
 class Error(Exception):
   pass
 
@@ -17,6 +24,51 @@ class MailActionError(Error):
     self.message = message
 
 
+_environments = dict()
+_environments_lock = threading.Lock()
+
+
+def get_environment(template_path):
+  ''' One jinja environment per template directory, shared by every email
+      Parsed templates stay in the environment, compiled bytecode is also cached on disk
+  '''
+  environment = _environments.get(template_path)
+  if environment is None:
+    with _environments_lock:
+      environment = _environments.get(template_path)
+      if environment is None:
+        environment = jinja2.Environment(loader=jinja2.FileSystemLoader(template_path),
+                                         bytecode_cache=jinja2.FileSystemBytecodeCache(MAIL_TEMPLATE_CACHE),
+                                         auto_reload=MAIL_TEMPLATE_RELOAD)
+        _environments[template_path] = environment
+  return environment
+
+
+def get_template(template_path, template_filename):
+  ''' Compiled on first use, reloaded on change only if MAIL_TEMPLATE_RELOAD is set
+  '''
+  return get_environment(template_path).get_template(template_filename)
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_template_exists(template_path, template_filename):
+  return os.path.isfile("{}/{}".format(template_path, template_filename))
+
+
+def _template_exists(template_path, template_filename):
+  if MAIL_TEMPLATE_RELOAD:
+    return os.path.isfile("{}/{}".format(template_path, template_filename))
+  return _cached_template_exists(template_path, template_filename)
+
+
+def clear_template_cache():
+  ''' Drop environments and existence checks, templates are re-read on next use
+  '''
+  with _environments_lock:
+    _environments.clear()
+  _cached_template_exists.cache_clear()
+
+
 class personalised_email(object):
   def __init__(self, recipient, template_name, data=None, template_path=None):
     if recipient is None:
@@ -34,7 +86,7 @@ class personalised_email(object):
 
     # Assume a local templates dir if not given
     if template_path is None:
-      template_path = "{}/templates/".format(os.path.dirname(os.path.abspath(__file__)))
+      template_path = DEFAULT_TEMPLATE_PATH
 
     _check_user_string(recipient)
     _check_email(recipient)
@@ -47,11 +99,12 @@ class personalised_email(object):
     _check_user_string(template_name)
     if template_name not in available_templates.keys():
       raise InputError("new email", "unknown template")
+    self.template_name = template_name
     self.template_filename = available_templates[template_name]
 
     _check_user_string(template_path)
-    if not os.path.isfile("{}/{}".format(template_path, self.template_filename)):
-      raise ("email", "template file does not exist")
+    if not _template_exists(template_path, self.template_filename):
+      raise InputError("new email", "template file does not exist")
     self.template_path = template_path
 
     for key in data.keys():
@@ -62,8 +115,7 @@ class personalised_email(object):
 
   def _render_template(self):
     try:
-        j2_env = jinja2.Environment(loader=jinja2.FileSystemLoader(self.template_path))
-        template = j2_env.get_template(self.template_filename)
+        template = get_template(self.template_path, self.template_filename)
         return template.render(self.data)
     except jinja2.TemplateNotFound:
       raise MailActionError("render", "could not find template {}".format(self.template_filename))
@@ -92,6 +144,74 @@ class personalised_email(object):
       raise MailActionError("send", "could not send email to {}".format(self.recipient))
 
 
+def _strings_to_list(messages):
+  return [mail_body for recipient, mail_body in messages]
+
+
+# Batch agents take a list of (recipient, mail body) and return one result per message
+BATCH_AGENTS = {"file": to_file.write_batch_to_spool,
+                "string": _strings_to_list}
+
+
+def send_batch(template_name, messages, mail_agent="file", template_path=None, batch_size=100, concurrency=1):
+  ''' Send one template to many recipients
+      Takes iterable of (recipient, data), renders each with the shared compiled template
+      and hands them to the agent batch_size at a time, concurrency batches in parallel
+      Returns list of dicts in input order - {"recipient", "sent", "result", "error"}
+  '''
+  _check_user_string(mail_agent)
+  if mail_agent not in BATCH_AGENTS.keys():
+    raise MailActionError("send batch", "{} is not a valid batch mail agent".format(mail_agent))
+  if not isinstance(batch_size, int) or batch_size < 1:
+    raise InputError("send batch", "batch size must be a positive int")
+  if not isinstance(concurrency, int) or concurrency < 1:
+    raise InputError("send batch", "concurrency must be a positive int")
+
+  results = list()
+  emails = list()
+  for recipient, data in messages:
+    result = {"recipient": recipient, "sent": False, "result": None, "error": None}
+    results.append(result)
+    try:
+      emails.append((result, personalised_email(recipient=recipient,
+                                                template_name=template_name,
+                                                data=data,
+                                                template_path=template_path)))
+    except Error as err:
+      result['error'] = err.message
+    except (TypeError, AttributeError):
+      result['error'] = "bad message"
+
+  def send_chunk(chunk):
+    rendered = list()
+    for result, email_obj in chunk:
+      try:
+        rendered.append((result, email_obj.recipient, email_obj._render_template()))
+      except MailActionError as err:
+        result['error'] = err.message
+
+    try:
+      agent_results = BATCH_AGENTS[mail_agent]([(recipient, mail_body) for result, recipient, mail_body in rendered])
+    except Exception:
+      for result, recipient, mail_body in rendered:
+        result['error'] = "could not send email to {}".format(recipient)
+      return
+
+    for (result, recipient, mail_body), agent_result in zip(rendered, agent_results):
+      result['sent'] = True
+      result['result'] = agent_result
+
+  chunks = [emails[start:start + batch_size] for start in range(0, len(emails), batch_size)]
+  if concurrency == 1:
+    for chunk in chunks:
+      send_chunk(chunk)
+  else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+      list(executor.map(send_chunk, chunks))
+
+  return results
+
+
 def _check_user_string(user_string):
   illegal_chars = ["$", ";", ","]
   for char in user_string:
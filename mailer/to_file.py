@@ -1,5 +1,11 @@
+import os
+import json
+import fcntl
 import datetime
 
+MAIL_SPOOL_DIR = os.environ.get("MAILSPOOLDIR", ".")
+MAIL_SPOOL_MAX_BYTES = int(os.environ.get("MAILSPOOLMAXBYTES", 10 * 1024 * 1024)) # Spool file is rotated once past this size
+
 def write_to_file(recipient, mail_body):
   date_now = datetime.datetime.now()
   date_now_str = date_now.strftime("%d%m%YT_%H%M%S")
@@ -9,3 +15,51 @@ def write_to_file(recipient, mail_body):
 
   return True
 
+
+class spool_writer(object):
+  ''' Appends batches of emails to one NDJSON spool file, one message per line
+      Full spool files are renamed with a timestamp and a new one started
+      Appends and rotation hold an flock on a lock file next to the spool, so
+      every thread and process writing to the directory takes turns
+  '''
+  def __init__(self, directory=MAIL_SPOOL_DIR, max_bytes=MAIL_SPOOL_MAX_BYTES):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.path = os.path.join(directory, "mail_spool.ndjson")
+    # The spool file itself is renamed on rotation, the lock file never is
+    self.lock_path = os.path.join(directory, "mail_spool.lock")
+
+  def _rotate(self):
+    date_now_str = datetime.datetime.now().strftime("%d%m%YT_%H%M%S_%f")
+    os.replace(self.path, os.path.join(self.directory, "mail_spool_{}.ndjson".format(date_now_str)))
+
+  def write_batch(self, messages):
+    ''' Takes list of (recipient, mail body), written with a single append
+        Returns list of booleans, one per message
+    '''
+    date_now_str = datetime.datetime.now().isoformat()
+    lines = "".join(json.dumps({"recipient": recipient, "date": date_now_str, "body": mail_body}) + "\n"
+                    for recipient, mail_body in messages)
+
+    with open(self.lock_path, "a") as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        with open(self.path, "a") as spool_file:
+          spool_file.write(lines)
+          size = spool_file.tell()
+        if size >= self.max_bytes:
+          self._rotate()
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return [True] * len(messages)
+
+
+_spool = {"writer": None}
+
+
+def write_batch_to_spool(messages):
+  # Created on first use, so importing the mailer touches no files
+  if _spool['writer'] is None:
+    _spool['writer'] = spool_writer()
+  return _spool['writer'].write_batch(messages)
@@ -1,14 +1,23 @@
-import bcrypt
+import os
 import hashlib
+import hmac
 import uuid
+import functools
 import datetime
 import random
 import string
-import copy
+import time
+import threading
+import collections
 
-from . import mongo
+from . import storage
+from . import properties
+from . import hashing
 #import mongo
 
+APP_AUTH_CACHE_SIZE = int(os.environ.get("APPAUTHCACHESIZE", 1024))
+APP_AUTH_CACHE_TTL = int(os.environ.get("APPAUTHCACHETTL", 300)) # Seconds a verified secret is trusted without bcrypt
+
 
 class Error(Exception):
   pass
@@ -39,48 +48,112 @@ class AppNotFound(Error):
     self.message = message
 
 
-class app_properties:
+class app_properties(properties.read_only_properties):
   ''' Readonly container for app properties
   '''
-  def __init__(self, app_doc):
-    for key in app_doc.keys():
-      self.__dict__[key] = app_doc[key]
+  _redacted = ("secret",)
+  _read_only_error = AppPropertyError
+  _read_only_message = "app properties are read-only, use update method"
 
-  def __setattr__(self, name, value):
-    raise AppPropertyError("set property", "app properties are read-only, use update method")
 
-  def as_dict(self):
-    attr_as_dict = copy.deepcopy(self.__dict__)
-    if "secret" in attr_as_dict:
-      del attr_as_dict['secret']
-    return attr_as_dict
+class credential_cache(object):
+  ''' Bounded, TTL-limited record of app secrets that passed a bcrypt check
+      Holds an HMAC of the secret under a per-process random key, never the secret itself.
+      Entries are tied to the stored secret hash, so a rotated secret never matches
+  '''
+  def __init__(self, size, ttl):
+    self.size = size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._hmac_key = os.urandom(32)
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def _digest(self, value):
+    if isinstance(value, str):
+      value = value.encode('utf-8')
+    return hmac.new(self._hmac_key, value, hashlib.sha256).digest()
+
+  def check(self, app_id, stored_hash, secret):
+    ''' Returns True if this secret was verified against this stored hash within the TTL
+    '''
+    with self._lock:
+      entry = self._entries.get(app_id)
+      if entry is None or entry[0] < time.monotonic():
+        self.misses += 1
+        return False
+      expiry, hash_digest, secret_digest = entry
+
+    if hmac.compare_digest(hash_digest, self._digest(stored_hash)) and \
+       hmac.compare_digest(secret_digest, self._digest(secret)):
+      with self._lock:
+        self.hits += 1
+      return True
+
+    with self._lock:
+      self.misses += 1
+    return False
+
+  def add(self, app_id, stored_hash, secret):
+    entry = (time.monotonic() + self.ttl, self._digest(stored_hash), self._digest(secret))
+    with self._lock:
+      self._entries[app_id] = entry
+      self._entries.move_to_end(app_id)
+      while len(self._entries) > self.size:
+        self._entries.popitem(last=False)
+
+  def invalidate(self, app_id=None):
+    with self._lock:
+      if app_id is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(app_id, None)
+
+  def stats(self):
+    with self._lock:
+      return {"hits": self.hits,
+              "misses": self.misses,
+              "size": len(self._entries)}
+
+
+_credential_cache = credential_cache(APP_AUTH_CACHE_SIZE, APP_AUTH_CACHE_TTL)
 
 
 class app:
-  def __init__(self, app_name=None, app_id=None, app_key=None, db=None):
+  # Not fetched until first used when loading lazily
+  LAZY_FIELDS = ("secret",)
+
+  def __init__(self, app_name=None, app_id=None, app_key=None, db=None, lazy=True):
     ''' Uses supplied ID  to find mongo record
         Dynamically populates class properties with mongo document content
+        lazy leaves the secret hash in mongo until it is read
     '''
     if db is None:
-      # This assumes host and port have been set in envvars
-      self.db = mongo.mongo()
+      # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+      self.db = storage.get_backend()
     else:
       self.db = db
 
+    if lazy:
+      projection = {field: 0 for field in self.LAZY_FIELDS}
+    else:
+      projection = None
+
     if app_name is None and app_id is None and app_key is None:
       raise InputError("get app", "app id or name is required")
 
     if app_name is not None:
       _check_user_string(app_name)
-      app_details = self.db.get_app_by_name(app_name)
+      app_details = self.db.get_app_by_name(app_name, projection=projection)
 
     elif app_id is not None:
       _check_user_string(app_id, is_uuid=True)
-      app_details = self.db.get_app_by_id(app_id)
+      app_details = self.db.get_app_by_id(app_id, projection=projection)
 
     elif app_key is not None:
       _check_user_string(app_key)
-      app_details = self.db.get_app_by_key(app_key)
+      app_details = self.db.get_app_by_key(app_key, projection=projection)
 
     if app_details is None:
       raise AppNotFound("get app", "app not found")
@@ -89,24 +162,52 @@ class app:
     if "_id" in app_details:
       del app_details['_id']
 
-    self.properties = app_properties(app_details)
+    lazy_fields = dict()
+    if projection is not None:
+      for field in self.LAZY_FIELDS:
+        lazy_fields[field] = functools.partial(self._load_field, app_details['appId'], field)
+    self.properties = app_properties(app_details, lazy=lazy_fields)
+
+
+  def _load_field(self, app_id, field):
+    app_doc = self.db.get_app_by_id(app_id, projection={field: 1})
+    if app_doc is None or field not in app_doc:
+      return properties.MISSING
+    return app_doc[field]
 
 
   def authenticate(self, secret):
+    ''' Repeat authentications with a recently verified secret skip bcrypt
+        First-time and failed attempts always pay the full cost
+    '''
     secret = secret.encode('utf-8')
     try:
-      result = bcrypt.checkpw(secret, self.properties.secret)
-      return result
-
+      stored_hash = self.properties.secret
     except AttributeError:
       # Secret is not set
       return False
 
+    return check_secret(self.properties.appId, stored_hash, secret)
+
 
   def update(self, **kwargs):
     pass
 
 
+def check_secret(app_id, stored_hash, secret):
+  ''' Takes bytes, returns boolean
+      Only secrets that miss the credential cache pay the bcrypt cost
+  '''
+  if _credential_cache.check(app_id, stored_hash, secret):
+    return True
+
+  result = hashing.check_password(secret, stored_hash)
+  if result:
+    _credential_cache.add(app_id, stored_hash, secret)
+
+  return result
+
+
 def _check_user_string(user_string, is_uuid=False):
   illegal_chars = ["$", ";", ",", "(", ")"]
   for char in user_string:
@@ -125,8 +226,8 @@ def _check_user_string(user_string, is_uuid=False):
 
 def delete_app(app_id, db=None):
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not app_id:
     raise InputError("delete app", "app id not given")
@@ -136,14 +237,16 @@ def delete_app(app_id, db=None):
   try:
     result = db.delete_app(app_id=app_id)
     return result
-  except mongo.RecordError as err:
+  except storage.RecordError as err:
     raise AppActionError("delete app", err.message)
+  finally:
+    _credential_cache.invalidate(app_id)
 
 
 def create_app(name, attributes=None, db=None):
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not name:
     raise InputError("new app", "name not give")
@@ -166,28 +269,29 @@ def create_app(name, attributes=None, db=None):
   app_fields = {"appId": app_id,
                 "appName": name,
                 "key": app_key,
-                "secret": bcrypt.hashpw(app_secret.encode('utf-8'), bcrypt.gensalt()),
+                "secret": hashing.hash_password(app_secret.encode('utf-8')),
                 "attributes": attributes}
 
   try:
     doc_id = db.create_app(app_fields)
     return (app_id, app_key, app_secret)
 
-  except mongo.DuplicateApp:
+  except storage.DuplicateApp:
     raise AppActionError("new app", "app already exists")
 
 
-def find_apps_like(app_name, db=None):
+def find_apps_like(app_name, db=None, mode="contains"):
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not app_name:
     raise InputError("find app", "app name required")
 
   _check_user_string(app_name)
+  storage.check_search_mode(mode, InputError, "find app")
 
-  apps = db.find_apps_by_name(app_name)
+  apps = db.find_apps_by_name(app_name, mode=mode)
 
   app_data = dict()
   for app_id, app_name in apps:
@@ -195,3 +299,60 @@ def find_apps_like(app_name, db=None):
 
   return app_data
 
+
+def find_apps_page(app_name, limit=storage.FIND_PAGE_SIZE, cursor=None, db=None, mode="contains"):
+  ''' Returns one page of apps like the given name and a cursor for the next
+      Cursor is None once the last page has been returned
+  '''
+  if db is None:
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
+
+  if not app_name:
+    raise InputError("find app", "app name required")
+
+  _check_user_string(app_name)
+  storage.check_page_limit(limit, InputError, "find app")
+  storage.check_search_mode(mode, InputError, "find app")
+
+  try:
+    apps, next_cursor = storage.find_page(functools.partial(db.find_apps_by_name, mode=mode), app_name, limit, cursor=cursor)
+  except storage.RecordError as err:
+    raise InputError("find app", err.message)
+
+  app_data = dict()
+  for app_id, found_name in apps:
+    app_data[found_name] = app_id
+
+  return app_data, next_cursor
+
+
+def iter_apps_like(app_name, db=None, mode="contains"):
+  ''' Yields (app name, app ID) for every match, a page at a time
+  '''
+  if db is None:
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
+
+  if not app_name:
+    raise InputError("find app", "app name required")
+
+  _check_user_string(app_name)
+  storage.check_search_mode(mode, InputError, "find app")
+
+  def generate():
+    for app_id, found_name in storage.iter_find(functools.partial(db.find_apps_by_name, mode=mode), app_name):
+      yield found_name, app_id
+
+  return generate()
+
+
+def invalidate_credentials(app_id=None):
+  ''' Drop cached verified secrets for one app, or all apps
+      Call after rotating an app secret
+  '''
+  _credential_cache.invalidate(app_id)
+
+
+def credential_cache_stats():
+  return _credential_cache.stats()
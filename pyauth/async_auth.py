@@ -0,0 +1,103 @@
+''' Coroutine versions of the lookups on the hot authentication paths
+    Same validation, errors and property containers as user, app and group,
+    over a storage.async_backend. App secrets are checked in the hashing pool
+    from an executor thread, so the event loop never waits on bcrypt
+'''
+import asyncio
+
+from . import storage
+from . import user
+from . import group
+from . import app
+
+
+async def get_user(email_address=None, user_id=None, db=None, projection=None):
+  ''' Returns user_properties, raises user.UserNotFound or user.InputError
+      Lazy loading is sync, so fields left out by projection are simply absent
+  '''
+  if db is None:
+    db = storage.get_async_backend()
+
+  if email_address is not None:
+    user._check_email(email_address)
+    user_details = await db.get_user_by_email(email_address, projection=projection)
+
+  elif user_id is not None:
+    user._check_user_string(user_id, is_uuid=True)
+    user_details = await db.get_user_by_id(user_id, projection=projection)
+
+  else:
+    raise user.InputError("get user", "one unique identifier must be provided - email, userid")
+
+  if user_details is None:
+    raise user.UserNotFound("user", "user not found")
+
+  user_details.pop("_id", None)
+  return user.user_properties(user_details)
+
+
+async def get_app(app_name=None, app_key=None, db=None, projection=None):
+  ''' Returns app_properties, raises app.AppNotFound or app.InputError
+  '''
+  if db is None:
+    db = storage.get_async_backend()
+
+  if app_name is not None:
+    app._check_user_string(app_name)
+    app_details = await db.get_app_by_name(app_name, projection=projection)
+
+  elif app_key is not None:
+    app._check_user_string(app_key)
+    app_details = await db.get_app_by_key(app_key, projection=projection)
+
+  else:
+    raise app.InputError("get app", "app name or key is required")
+
+  if app_details is None:
+    raise app.AppNotFound("get app", "app not found")
+
+  app_details.pop("_id", None)
+  return app.app_properties(app_details)
+
+
+async def authenticate_app(app_props, secret):
+  ''' Same check as app.authenticate for properties fetched with the secret
+      Raises hashing.Error when the hashing pool is saturated
+  '''
+  stored_hash = app_props.get("secret")
+  if stored_hash is None:
+    return False
+
+  secret = secret.encode('utf-8')
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, app.check_secret, app_props.appId, stored_hash, secret)
+
+
+async def get_group_names(user_props, db=None):
+  ''' As user.get_group_names, from the groups field or the membership lookup
+  '''
+  user_groups = user_props.get("groups")
+  if user_groups is not None:
+    return list(user_groups.values())
+
+  if db is None:
+    db = storage.get_async_backend()
+  return [group_name for group_id, group_name in await db.find_user_groups(user_props.userId)]
+
+
+async def user_in_group(user_props, group_name, db=None):
+  ''' True if the user is a member, raises group.GroupNotFound
+      Uses the user's groups field when it was fetched, else the membership lookup
+  '''
+  if db is None:
+    db = storage.get_async_backend()
+
+  group_details = await db.get_group_by_name(group_name, projection={"groupId": 1})
+  if group_details is None:
+    raise group.GroupNotFound("group", "group not found")
+
+  user_groups = user_props.get("groups")
+  if user_groups is not None:
+    return group_details['groupId'] in user_groups
+
+  return group_details['groupId'] in [group_id for group_id, name in await db.find_user_groups(user_props.userId)]
@@ -0,0 +1,379 @@
+''' Motor (asyncio) storage backend, the mongo backend's methods as coroutines
+    Lets an async front end keep many lookups in flight on one event loop
+    instead of holding a thread per request. Queries are shared with mongo.py
+
+    Requires motor, pinned in requirements.txt for the asgi server mode
+'''
+import os
+import asyncio
+import hashlib
+import threading
+
+import pymongo
+
+from . import mongo
+from . import storage
+from .storage import RecordError, DuplicateAccount, DuplicateGroup, DuplicateApp
+
+try:
+  import motor.motor_asyncio
+except ImportError:
+  motor = None
+
+
+# Motor clients belong to the event loop that created them, one per loop, server and credentials
+_clients = dict()
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
+
+
+def get_client(host, port, username=None, password=None, pool_size=None):
+  ''' Returns the client for the running event loop, created without connecting
+  '''
+  global _clients, _clients_pid
+  if motor is None:
+    raise storage.ConnectionError("new connection", "async backend requires motor - pip install -r requirements.txt")
+
+  if os.getpid() != _clients_pid:
+    _clients = dict()
+    _clients_pid = os.getpid()
+
+  if pool_size is None:
+    pool_size = mongo.MONGO_POOL_SIZE
+
+  password_hash = None
+  if password is not None:
+    password_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
+  client_key = (id(asyncio.get_running_loop()), host, port, username, password_hash, pool_size)
+
+  with _clients_lock:
+    client = _clients.get(client_key)
+    if client is None:
+      client = motor.motor_asyncio.AsyncIOMotorClient(host, port,
+                                                      username=username,
+                                                      password=password,
+                                                      maxPoolSize=pool_size)
+      _clients[client_key] = client
+    return client
+
+
+def close_clients():
+  with _clients_lock:
+    clients = list(_clients.values())
+    _clients.clear()
+
+  for client in clients:
+    client.close()
+
+
+class async_mongo(storage.async_backend):
+  ''' Must be created inside a running event loop
+      client, if given, is used instead of one from the registry
+  '''
+  def __init__(self, mongo_host=None, mongo_port=None,
+                     username=None, password=None, pool_size=None, client=None):
+    if client is None:
+      self.host = mongo_host or mongo.MONGO_HOST
+      if not self.host:
+        raise storage.ConnectionError("new connection", "host name/address required")
+
+      self.port = mongo_port or mongo.MONGO_PORT
+      if not isinstance(self.port, int):
+        raise storage.ConnectionError("new connection", "port must be int")
+
+      if username is None:
+        username, password = mongo.MONGO_USER, mongo.MONGO_PASSWORD
+      client = get_client(self.host, self.port, username=username, password=password, pool_size=pool_size)
+    self.client = client
+
+    self.users_collection = self.client.pyauth.users
+    self.groups_collection = self.client.pyauth.groups
+    self.apps_collection = self.client.pyauth.apps
+    self.memberships_collection = self.client.pyauth.memberships
+    self.search_collection = self.client.pyauth.search_index
+
+  async def clear_collections(self):
+    for collection in [self.users_collection, self.groups_collection, self.apps_collection,
+                       self.memberships_collection, self.search_collection]:
+      await collection.delete_many({})
+
+
+  async def _find_one(self, collection, query, expression, projection=None):
+    documents = await collection.find(query, mongo.without_id(projection)).limit(2).to_list(length=2)
+
+    if len(documents) > 1:
+      raise RecordError(expression, "to many records returned")
+
+    elif len(documents) == 0:
+      return None
+
+    return documents[0]
+
+
+  async def _find_like(self, collection, kind, name_field, id_field, name, limit=None, after=None, mode="contains"):
+    if mode not in storage.SEARCH_MODES:
+      raise RecordError("find", "unknown search mode")
+
+    if mode == "substring":
+      collection, query = self.search_collection, mongo.substring_query(kind, name, after=after)
+      id_field, name_field = "refId", "value"
+    else:
+      query = mongo.like_query(name_field, name, after=after, mode=mode)
+
+    docs = collection.find(query, {id_field: 1, name_field: 1, "_id": 0}).sort(name_field, pymongo.ASCENDING)
+    if limit is not None:
+      docs = docs.limit(limit)
+
+    return [(doc[id_field], doc[name_field]) async for doc in docs]
+
+
+  async def index_search_value(self, kind, ref_id, value):
+    if not mongo.SEARCH_INDEX_ENABLED:
+      return
+
+    await self.search_collection.update_one({"kind": kind, "refId": str(ref_id)},
+                                            {"$set": {"value": value,
+                                                      "grams": mongo.search_ngrams(value)}},
+                                            upsert=True)
+
+
+  async def remove_search_value(self, kind, ref_id):
+    await self.search_collection.delete_one({"kind": kind, "refId": str(ref_id)})
+
+
+  async def create_user(self, data):
+    try:
+      result = await self.users_collection.insert_one(data)
+    except pymongo.errors.DuplicateKeyError:
+      raise DuplicateAccount("create user", "an account exists with this email address")
+
+    await self.index_search_value("users", data['userId'], data['email'])
+    return result.inserted_id
+
+
+  async def update_user(self, user_id, data, unset=None, return_document=True, projection=None):
+    update = mongo.update_document(data, unset)
+
+    if return_document:
+      doc = await self.users_collection.find_one_and_update({"userId": str(user_id)},
+                                                            update,
+                                                            projection=projection,
+                                                            upsert=False,
+                                                            return_document=pymongo.collection.ReturnDocument.AFTER)
+    else:
+      result = await self.users_collection.update_one({"userId": str(user_id)}, update, upsert=False)
+      doc = True if result.matched_count else None
+
+    if doc is not None and data and "email" in data:
+      await self.index_search_value("users", user_id, data['email'])
+    return doc
+
+
+  async def get_user_by_email(self, email_address, projection=None):
+    return await self._find_one(self.users_collection, {"email": email_address}, "get user", projection=projection)
+
+
+  async def get_user_by_id(self, user_id, projection=None):
+    return await self._find_one(self.users_collection, {"userId": user_id}, "get user", projection=projection)
+
+
+  async def get_users_by_ids(self, user_ids, projection=None, chunk_size=mongo.MONGO_IN_CHUNK_SIZE):
+    if projection is not None and any(projection.values()):
+      projection = dict(projection)
+      projection['userId'] = 1
+
+    user_ids = list(user_ids)
+    users = dict()
+    for chunk_start in range(0, len(user_ids), chunk_size):
+      chunk = user_ids[chunk_start:chunk_start + chunk_size]
+      async for doc in self.users_collection.find({"userId": {"$in": chunk}}, projection):
+        users[doc['userId']] = doc
+
+    return users
+
+
+  async def get_user_by_reset_code(self, reset_code, projection=None):
+    return await self._find_one(self.users_collection, {"$and": [{"status": {"$eq": "new"}}, {"resetCode": {"$eq": reset_code}}]}, "user reset", projection=projection)
+
+
+  async def _delete_one(self, collection, query, expression):
+    result = await collection.delete_one(query)
+    if result.deleted_count == 0:
+      raise RecordError(expression, "no documents to be deleted")
+
+
+  async def delete_user(self, user_id):
+    await self._delete_one(self.users_collection, {"userId": str(user_id)}, "delete user")
+    await self.remove_search_value("users", user_id)
+    return True
+
+
+  async def find_users_by_email_address(self, email_address, limit=None, after=None, mode="contains"):
+    return await self._find_like(self.users_collection, "users", "email", "userId", email_address,
+                                 limit=limit, after=after, mode=mode)
+
+
+  async def create_group(self, data):
+    try:
+      result = await self.groups_collection.insert_one(data)
+    except pymongo.errors.DuplicateKeyError:
+      raise DuplicateGroup("create group", "a group exists with this name")
+
+    await self.index_search_value("groups", data['groupId'], data['groupName'])
+    return result.inserted_id
+
+
+  async def get_group_by_name(self, group_name, projection=None):
+    return await self._find_one(self.groups_collection, {"groupName": group_name}, "get group", projection=projection)
+
+
+  async def get_group_by_id(self, group_id, projection=None):
+    return await self._find_one(self.groups_collection, {"groupId": group_id}, "get group", projection=projection)
+
+
+  async def update_group(self, group_id, data, projection=None):
+    doc = await self.groups_collection.find_one_and_update({"groupId": str(group_id)},
+                                                           {"$set": data},
+                                                           projection=projection,
+                                                           upsert=False,
+                                                           return_document=pymongo.collection.ReturnDocument.AFTER)
+    if doc is not None and "groupName" in data:
+      await self.index_search_value("groups", group_id, data['groupName'])
+      await self.set_user_group(await self.get_group_member_ids(group_id), group_id, data['groupName'])
+    return doc
+
+
+  async def find_groups_by_name(self, group_name, limit=None, after=None, mode="contains"):
+    return await self._find_like(self.groups_collection, "groups", "groupName", "groupId", group_name,
+                                 limit=limit, after=after, mode=mode)
+
+
+  async def delete_group(self, group_id):
+    await self._delete_one(self.groups_collection, {"groupId": str(group_id)}, "delete group")
+    await self.unset_user_group(await self.get_group_member_ids(group_id), group_id)
+    await self.memberships_collection.delete_many({"groupId": str(group_id)})
+    await self.remove_search_value("groups", group_id)
+    return True
+
+
+  async def add_group_member(self, group_id, user_id, group_name=None):
+    membership = {"groupId": str(group_id), "userId": str(user_id)}
+    try:
+      result = await self.memberships_collection.update_one(membership,
+                                                            {"$setOnInsert": membership},
+                                                            upsert=True)
+    except pymongo.errors.DuplicateKeyError:
+      return False
+
+    if result.upserted_id is None:
+      return False
+
+    await self.set_user_group([user_id], group_id, group_name)
+    return True
+
+
+  async def remove_group_member(self, group_id, user_id):
+    result = await self.memberships_collection.delete_one({"groupId": str(group_id), "userId": str(user_id)})
+    if result.deleted_count != 1:
+      return False
+
+    await self.unset_user_group([user_id], group_id)
+    return True
+
+
+  async def set_group_members(self, group_id, user_ids, group_name=None):
+    user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    removed_ids = list(set(await self.get_group_member_ids(group_id)) - set(user_ids))
+    if removed_ids:
+      await self.memberships_collection.delete_many({"groupId": str(group_id), "userId": {"$in": removed_ids}})
+      await self.unset_user_group(removed_ids, group_id)
+
+    if len(user_ids) == 0:
+      return
+
+    try:
+      await self.memberships_collection.bulk_write(mongo.member_upserts(group_id, user_ids), ordered=False)
+    except pymongo.errors.BulkWriteError as err:
+      if not mongo.only_duplicate_keys(err):
+        raise
+
+    await self.set_user_group(user_ids, group_id, group_name)
+
+
+  async def _get_group_name(self, group_id):
+    group_doc = await self.get_group_by_id(str(group_id), projection={"groupName": 1})
+    if group_doc is None:
+      return None
+    return group_doc['groupName']
+
+
+  async def set_user_group(self, user_ids, group_id, group_name=None):
+    if group_name is None:
+      group_name = await self._get_group_name(group_id)
+      if group_name is None:
+        return
+
+    field = "groups.{}".format(group_id)
+    user_ids = [str(user_id) for user_id in user_ids]
+    for start in range(0, len(user_ids), mongo.MONGO_IN_CHUNK_SIZE):
+      await self.users_collection.update_many({"userId": {"$in": user_ids[start:start + mongo.MONGO_IN_CHUNK_SIZE]},
+                                               "groups": {"$exists": True}},
+                                              {"$set": {field: group_name}})
+
+
+  async def unset_user_group(self, user_ids, group_id):
+    field = "groups.{}".format(group_id)
+    user_ids = [str(user_id) for user_id in user_ids]
+    for start in range(0, len(user_ids), mongo.MONGO_IN_CHUNK_SIZE):
+      await self.users_collection.update_many({"userId": {"$in": user_ids[start:start + mongo.MONGO_IN_CHUNK_SIZE]},
+                                               field: {"$exists": True}},
+                                              {"$unset": {field: ""}})
+
+
+  async def get_group_member_ids(self, group_id):
+    docs = self.memberships_collection.find({"groupId": str(group_id)}, {"userId": 1, "_id": 0})
+    return [doc['userId'] async for doc in docs]
+
+
+  async def find_user_groups(self, user_id):
+    docs = self.memberships_collection.find({"userId": str(user_id)}, {"groupId": 1, "_id": 0})
+    group_ids = [doc['groupId'] async for doc in docs]
+    if len(group_ids) == 0:
+      return list()
+
+    docs = self.groups_collection.find({"groupId": {"$in": group_ids}},
+                                       {"groupId": 1, "groupName": 1, "_id": 0})
+    return [(doc['groupId'], doc['groupName']) async for doc in docs]
+
+
+  async def create_app(self, data):
+    try:
+      result = await self.apps_collection.insert_one(data)
+    except pymongo.errors.DuplicateKeyError:
+      raise DuplicateApp("create app", "an app exists with this name")
+
+    await self.index_search_value("apps", data['appId'], data['appName'])
+    return result.inserted_id
+
+
+  async def get_app_by_id(self, app_id, projection=None):
+    return await self._find_one(self.apps_collection, {"appId": app_id}, "get app", projection=projection)
+
+
+  async def get_app_by_name(self, app_name, projection=None):
+    return await self._find_one(self.apps_collection, {"appName": app_name}, "get app", projection=projection)
+
+
+  async def get_app_by_key(self, app_key, projection=None):
+    return await self._find_one(self.apps_collection, {"key": app_key}, "get app", projection=projection)
+
+
+  async def delete_app(self, app_id):
+    await self._delete_one(self.apps_collection, {"appId": str(app_id)}, "delete app")
+    await self.remove_search_value("apps", app_id)
+    return True
+
+
+  async def find_apps_by_name(self, app_name, limit=None, after=None, mode="contains"):
+    return await self._find_like(self.apps_collection, "apps", "appName", "appId", app_name,
+                                 limit=limit, after=after, mode=mode)
@@ -1,7 +1,14 @@
+import os
 import uuid
-import copy
+import functools
+import time
+import threading
 
-from . import mongo
+from . import storage
+from . import properties
+
+GROUP_CACHE_TTL = int(os.environ.get("GROUPCACHETTL", 5)) # Seconds a cached member set stays valid
+GROUP_PROJECTION = {"_id": 0, "members": 0} # Members come from the memberships collection, skip any legacy array
 
 
 class Error(Exception):
@@ -33,28 +40,89 @@ class GroupNotFound(Error):
     self.message = message
 
 
-class group_properties:
+class group_properties(properties.read_only_properties):
   ''' Readonly container for group properties
   '''
-  def __init__(self, group_doc):
-    for key in group_doc.keys():
-      self.__dict__[key] = group_doc[key]
+  _redacted = ("password",)
+  _read_only_error = GroupPropertyError
+  _read_only_message = "group properties are read-only, use update methods"
 
-  def __setattr__(self, name, value):
-    raise GroupPropertyError("set property", "group properties are read-only, use update methods")
 
-  def as_dict(self):
-    attr_as_dict = copy.deepcopy(self.__dict__)
-    if "password" in attr_as_dict:
-      del attr_as_dict['password']
-    return attr_as_dict
+class member_cache(object):
+  ''' In-process cache of group member IDs held as sets, keyed by group name
+      Entries expire after a short TTL and are dropped as soon as this process
+      changes the group. Other processes pick up changes when the TTL expires
+      Each invalidation bumps a generation, a load that started before one is
+      returned to its caller but not cached
+  '''
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = dict()
+    self._generation = 0 # Bumped when every group is invalidated
+    self._generations = dict() # Group name to count of invalidations
+    self._lock = threading.Lock()
+
+  def _current_generation(self, group_name):
+    return (self._generation, self._generations.get(group_name, 0))
+
+  def get(self, group_name, loader):
+    ''' Returns cached member set, calling loader() to fill it on a miss
+    '''
+    time_now = time.monotonic()
+    with self._lock:
+      entry = self._entries.get(group_name)
+      if entry is not None and entry[0] > time_now:
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
+      generation = self._current_generation(group_name)
+
+    members = frozenset(loader())
+    with self._lock:
+      # Skip the store if the group changed while loading, members may be stale
+      if self._current_generation(group_name) == generation:
+        self._entries[group_name] = (time_now + self.ttl, members)
+    return members
+
+  def invalidate(self, group_name=None):
+    with self._lock:
+      if group_name is None:
+        self._entries.clear()
+        self._generation += 1
+      else:
+        self._entries.pop(group_name, None)
+        self._generations[group_name] = self._generations.get(group_name, 0) + 1
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {"hits": self.hits,
+              "misses": self.misses,
+              "hitRate": self.hits / lookups if lookups else 0.0,
+              "size": len(self._entries)}
+
+  def reset(self):
+    with self._lock:
+      self._entries.clear()
+      self._generations.clear()
+      self._generation += 1
+      self.hits = 0
+      self.misses = 0
+
+
+_member_cache = member_cache(GROUP_CACHE_TTL)
 
 
 class group:
-  def __init__(self, group_name=None, group_id=None, db=None):
+  def __init__(self, group_name=None, group_id=None, db=None, lazy=True):
+    ''' lazy leaves the member list in mongo until it is read
+    '''
+    self.lazy = lazy
     if db is None:
-      # This assumes host and port have been set in envvars
-      self.db = mongo.mongo()
+      # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+      self.db = storage.get_backend()
     else:
       self.db = db
 
@@ -63,13 +131,13 @@ class group:
 
     if group_name is not None:
       _check_user_string(group_name)
-      group_details = self.db.get_group_by_name(group_name)
+      group_details = self.db.get_group_by_name(group_name, projection=GROUP_PROJECTION)
       if group_details is None:
         raise GroupNotFound("group", "group not found")
 
     elif group_id is not None:
       _check_user_string(group_id)
-      group_details = self.db.get_group_by_id(group_id)
+      group_details = self.db.get_group_by_id(group_id, projection=GROUP_PROJECTION)
       if group_details is None:
         raise GroupNotFound("group", "group not found")
 
@@ -77,7 +145,26 @@ class group:
     if "_id" in group_details:
       del group_details['_id']
 
-    self.properties = group_properties(group_details)
+    self.properties = self._build_properties(group_details)
+
+
+  def _build_properties(self, group_details):
+    ''' Membership is held in its own collection, present it as a members field
+    '''
+    group_id = group_details['groupId']
+    if self.lazy:
+      return group_properties(group_details,
+                              lazy={"members": functools.partial(self.db.get_group_member_ids, group_id)})
+
+    group_details['members'] = self.db.get_group_member_ids(group_id)
+    return group_properties(group_details)
+
+
+  def _set_local_members(self, members_list):
+    ''' Refresh local properties after a single member change, without re-reading the group
+    '''
+    self.properties = self.properties.replace({"members": members_list})
+    _member_cache.invalidate(self.properties.groupName)
 
 
   def add_member(self, user_id=None, email=None):
@@ -88,55 +175,59 @@ class group:
       # Check user is real
       _check_user_string(user_id, is_uuid=True)
 
-      user_details = self.db.get_user_by_id(user_id)
+      user_details = self.db.get_user_by_id(user_id, projection={"userId": 1})
       if user_details is None:
         raise GroupActionError("group member", "user not found, can't be added")
 
     elif email is not None:
       _check_email(email)
 
-      user_details = self.db.get_user_by_email(email)
+      user_details = self.db.get_user_by_email(email, projection={"userId": 1})
       if user_details is None:
         raise GroupActionError("group member", "user not found, can't be added")
 
-    if user_details['userId'] in self.properties.members:
+    # Single atomic upsert, membership is never rewritten as a whole
+    added = self.db.add_group_member(self.properties.groupId, user_details['userId'],
+                                     group_name=self.properties.groupName)
+    if not added:
       raise GroupActionError("group member", "user already in group")
 
-    members_list = self.properties.members.copy()
+    members_list = [member_id for member_id in self.properties.members if member_id != user_details['userId']]
     members_list.append(user_details['userId'])
-    result = self.update(members=members_list)
-    if result:
-      return members_list
+    self._set_local_members(members_list)
+    return members_list
 
 
   def get_members_detail(self, attribute=None):
-    ''' Iterate group member list
-        Get user document
+    ''' Get user documents for all members in one batched lookup
         Returns named attribute or whole document if not given
     '''
     if attribute is not None:
       if not isinstance(attribute, str):
         raise InputError("group member", "attribute must be a string")
       _check_user_string(attribute)
+      projection = {"_id": 0, attribute: 1}
+    else:
+      # Drop Mongo doc ID from returned documents
+      projection = {"_id": 0}
+
+    try:
+      user_docs = self.db.get_users_by_ids(self.properties.members, projection=projection)
+    except storage.RecordError as err:
+      raise GroupActionError("group member", err.message)
 
     user_details = dict()
     for user_id in self.properties.members:
-      try:
-        user_doc = self.db.get_user_by_id(user_id)
-      except mongo.RecordError as err:
-        raise GroupActionError("group member", err.message)
+      user_doc = user_docs.get(user_id)
 
       if user_doc is None:
           user_details[user_id] = str()
-      elif user_doc is not None and attribute is not None:
+      elif attribute is not None:
         if attribute in user_doc:
           user_details[user_id] = user_doc[attribute]
         else:
           user_details[user_id] = str()
-      elif user_doc is not None and attribute is None:
-        # Drop Mongo doc ID before setting properties
-        if "_id" in user_doc:
-          del user_doc['_id']
+      else:
         user_details[user_id] = user_doc
 
     return user_details
@@ -159,7 +250,7 @@ class group:
 
       if not force:
         # If forcing, don't check for a valid user
-        user_details = self.db.get_user_by_id(user_id)
+        user_details = self.db.get_user_by_id(user_id, projection={"userId": 1})
         if user_details is None:
           raise GroupActionError("group member", "user not found, can't be removed")
         user_id = user_details['userId']
@@ -167,24 +258,24 @@ class group:
     elif email is not None:
       _check_email(email)
 
-      user_details = self.db.get_user_by_email(email)
+      user_details = self.db.get_user_by_email(email, projection={"userId": 1})
       if user_details is None:
         raise GroupActionError("group member", "user not found, can't be removed")
       user_id = user_details['userId']
 
-    if user_id not in self.properties.members:
+    removed = self.db.remove_group_member(self.properties.groupId, user_id)
+    if not removed:
       raise GroupActionError("group member", "user not in group")
 
-    members_list = self.properties.members.copy()
-    members_list.remove(user_id)
-    result = self.update(members=members_list)
-    if result:
-      return members_list
+    members_list = [member_id for member_id in self.properties.members if member_id != user_id]
+    self._set_local_members(members_list)
+    return members_list
 
 
   def update(self, **kwargs):
     ''' Takes kwargs, converts to dict
         Updates mongo and local properties object if OK
+        A members list replaces the group's membership
     '''
     if len(kwargs.items()) < 1:
       raise InputError("update group", "no updates given")
@@ -195,7 +286,21 @@ class group:
       _check_user_string(value)
       group_fields[key] = value
 
-    updated_doc = self.db.update_group(self.properties.groupId, group_fields)
+    members_list = group_fields.pop("members", None)
+    if members_list is not None:
+      if not isinstance(members_list, list):
+        raise InputError("update group", "members must be in a list")
+      for member_id in members_list:
+        _check_user_string(member_id, is_uuid=True)
+      self.db.set_group_members(self.properties.groupId, members_list, group_name=self.properties.groupName)
+
+    if len(group_fields) > 0:
+      updated_doc = self.db.update_group(self.properties.groupId, group_fields, projection=GROUP_PROJECTION)
+    else:
+      updated_doc = self.db.get_group_by_id(self.properties.groupId, projection=GROUP_PROJECTION)
+
+    # Drop cached members under both the old and (if renamed) new name
+    _member_cache.invalidate(self.properties.groupName)
 
     if updated_doc is None:
       raise GroupActionError("update group", "no group document found to update")
@@ -203,7 +308,8 @@ class group:
       # Drop Mongo doc ID  before setting properties
       if "_id" in updated_doc:
         del updated_doc['_id']
-      self.properties = group_properties(updated_doc)
+      self.properties = self._build_properties(updated_doc)
+      _member_cache.invalidate(self.properties.groupName)
 
     return True
 
@@ -234,8 +340,8 @@ def delete_group(group_id, db=None):
       Returns boolean
   '''
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not group_id:
     raise InputError("group", "group id not given")
@@ -249,8 +355,10 @@ def delete_group(group_id, db=None):
   try:
     result = db.delete_group(group_id)
     return result
-  except mongo.RecordError as err:
+  except storage.RecordError as err:
     raise GroupActionError("delete group", err.message)
+  finally:
+    _member_cache.invalidate(group_obj.properties.groupName)
 
 
 
@@ -260,8 +368,8 @@ def create_group(group_name, group_members=[], db=None):
       Returns group ID
   '''
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not group_name:
     raise InputError("group", "group name not given")
@@ -278,28 +386,30 @@ def create_group(group_name, group_members=[], db=None):
   group_id = str(uuid.uuid4())
 
   group_fields = {"groupName": group_name,
-                  "groupId": group_id,
-                  "members": group_members}
+                  "groupId": group_id}
 
   try:
     doc_id = db.create_group(group_fields)
+    db.set_group_members(group_id, group_members, group_name=group_name)
+    _member_cache.invalidate(group_name)
     return {group_name: group_id}
 
-  except mongo.DuplicateGroup:
+  except storage.DuplicateGroup:
       raise GroupActionError("group", "group already exists")
 
 
-def find_groups_like(group_name, db=None):
+def find_groups_like(group_name, db=None, mode="contains"):
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not group_name:
     raise InputError("group", "group name not given")
 
   _check_user_string(group_name)
+  storage.check_search_mode(mode, InputError, "group")
 
-  groups = db.find_groups_by_name(group_name)
+  groups = db.find_groups_by_name(group_name, mode=mode)
 
   if len(groups) == 0:
     raise GroupNotFound("find group", "no groups found")
@@ -317,8 +427,8 @@ def find_user_in_group(user_id, db=None):
       the given user ID is a memeber of
   '''
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not user_id:
     raise InputError("find user groups", "user id not given")
@@ -332,3 +442,85 @@ def find_user_in_group(user_id, db=None):
     group_data[group_name] = group_id
 
   return group_data
+
+
+def user_in_group(user_id, group_name, db=None):
+  ''' Set lookup against the cached members of the named group
+      Returns boolean, raises GroupNotFound
+  '''
+  if db is None:
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
+
+  if not user_id:
+    raise InputError("group member", "user id not given")
+
+  if not group_name:
+    raise InputError("group member", "group name not given")
+
+  _check_user_string(group_name)
+
+  def load_members():
+    group_details = db.get_group_by_name(group_name, projection={"groupId": 1})
+    if group_details is None:
+      raise GroupNotFound("group", "group not found")
+    return db.get_group_member_ids(group_details['groupId'])
+
+  return user_id in _member_cache.get(group_name, load_members)
+
+
+def member_cache_stats():
+  ''' Returns hit/miss counts and hit rate for the group member cache
+  '''
+  return _member_cache.stats()
+
+
+def clear_member_cache():
+  _member_cache.reset()
+
+
+def find_groups_page(group_name, limit=storage.FIND_PAGE_SIZE, cursor=None, db=None, mode="contains"):
+  ''' Returns one page of groups like the given name and a cursor for the next
+      Cursor is None once the last page has been returned
+  '''
+  if db is None:
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
+
+  if not group_name:
+    raise InputError("group", "group name not given")
+
+  _check_user_string(group_name)
+  storage.check_page_limit(limit, InputError, "group")
+  storage.check_search_mode(mode, InputError, "group")
+
+  try:
+    groups, next_cursor = storage.find_page(functools.partial(db.find_groups_by_name, mode=mode), group_name, limit, cursor=cursor)
+  except storage.RecordError as err:
+    raise InputError("group", err.message)
+
+  group_data = dict()
+  for group_id, found_name in groups:
+    group_data[found_name] = group_id
+
+  return group_data, next_cursor
+
+
+def iter_groups_like(group_name, db=None, mode="contains"):
+  ''' Yields (group name, group ID) for every match, a page at a time
+  '''
+  if db is None:
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
+
+  if not group_name:
+    raise InputError("group", "group name not given")
+
+  _check_user_string(group_name)
+  storage.check_search_mode(mode, InputError, "group")
+
+  def generate():
+    for group_id, found_name in storage.iter_find(functools.partial(db.find_groups_by_name, mode=mode), group_name):
+      yield found_name, group_id
+
+  return generate()
@@ -0,0 +1,267 @@
+import os
+import re
+import math
+import time
+import bcrypt
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
+
+WEB_WORKERS = int(os.environ.get("WEBWORKERS", os.cpu_count() or 1)) # Processes sharing this host's CPUs, as runserv.py
+HASH_WORKERS = int(os.environ.get("HASHWORKERS", max(1, (os.cpu_count() or 1) // WEB_WORKERS))) # Per process, 0 hashes inline in the calling thread
+HASH_QUEUE_DEPTH = int(os.environ.get("HASHQUEUEDEPTH", max(HASH_WORKERS, 1) * 4)) # Pending + running operations
+HASH_TIMEOUT = float(os.environ.get("HASHTIMEOUT", 5)) # Seconds to wait for a result
+HASH_RETRY_AFTER = 1 # Seconds suggested to callers turned away while saturated
+HASH_ROUNDS = int(os.environ.get("HASHROUNDS", 0)) # bcrypt cost for new hashes, 0 calibrates against HASH_TARGET_MS
+HASH_TARGET_MS = float(os.environ.get("HASHTARGETMS", 50)) # Target verification time on this host
+HASH_MIN_ROUNDS = int(os.environ.get("HASHMINROUNDS", 10)) # Security floor, calibration on a fast host never picks a cheaper cost
+HASH_MAX_ROUNDS = 31
+HASH_CALIBRATION_ROUNDS = 8 # Cost timed during calibration, each extra round doubles the work
+
+UNUSABLE_PASSWORD = "!" # Stored instead of a hash when an account has no usable password
+
+_BCRYPT_HASH = re.compile(rb"^\$2[abxy]?\$(\d{2})\$")
+
+logger = logging.getLogger(__name__)
+
+
+class Error(Exception):
+  pass
+
+class HashingBusy(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+class HashingTimeout(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+class HashingFailed(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+
+def _hashpw(password, rounds):
+  return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
+def _checkpw(password, hashed):
+  return bcrypt.checkpw(password, hashed)
+
+
+class hashing_service(object):
+  ''' Runs bcrypt in a bounded process pool so credential checks can't
+      occupy every web worker thread
+      Calls beyond the queue depth are refused immediately with HashingBusy
+  '''
+  def __init__(self, workers, queue_depth, timeout):
+    self.configure(workers, queue_depth, timeout)
+
+  def configure(self, workers=None, queue_depth=None, timeout=None):
+    if workers is not None:
+      self.workers = workers
+    if queue_depth is not None:
+      self.queue_depth = queue_depth
+    if timeout is not None:
+      self.timeout = timeout
+
+    self.shutdown()
+    self._executor = None
+    self._executor_pid = None
+    self._lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(self.queue_depth)
+
+  def _get_executor(self):
+    # Process pools are not fork-safe, each process gets its own
+    with self._lock:
+      if self._executor is None or self._executor_pid != os.getpid():
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                                mp_context=multiprocessing.get_context("spawn"))
+        self._executor_pid = os.getpid()
+      return self._executor
+
+  def _discard(self, executor):
+    # A child that dies breaks the whole pool, drop it so the next call starts a new one
+    with self._lock:
+      if self._executor is executor:
+        self._executor = None
+    executor.shutdown(wait=False)
+
+  def run(self, func, *args):
+    if self.workers == 0:
+      return func(*args)
+
+    try:
+      return self._submit(func, *args)
+    except concurrent.futures.process.BrokenProcessPool:
+      pass
+
+    # bcrypt calls are safe to repeat, try once more on a fresh pool
+    try:
+      return self._submit(func, *args)
+    except concurrent.futures.process.BrokenProcessPool:
+      raise HashingFailed("hash", "password worker process failed")
+
+  def _submit(self, func, *args):
+    slots = self._slots
+    if not slots.acquire(blocking=False):
+      raise HashingBusy("hash", "too many pending password operations")
+
+    executor = self._get_executor()
+    try:
+      future = executor.submit(func, *args)
+    except concurrent.futures.process.BrokenProcessPool:
+      slots.release()
+      self._discard(executor)
+      raise
+    except Exception:
+      slots.release()
+      raise
+
+    # Slot is held until the work finishes, even if the caller stops waiting
+    future.add_done_callback(lambda done: slots.release())
+
+    try:
+      return future.result(timeout=self.timeout)
+    except concurrent.futures.TimeoutError:
+      future.cancel()
+      raise HashingTimeout("hash", "password operation timed out")
+    except concurrent.futures.process.BrokenProcessPool:
+      self._discard(executor)
+      raise
+
+  def shutdown(self):
+    executor = getattr(self, "_executor", None)
+    if executor is not None and self._executor_pid == os.getpid():
+      executor.shutdown(wait=False)
+    self._executor = None
+
+  def after_fork(self):
+    # The parent's pool, lock and pending slots mean nothing in a child
+    self._executor = None
+    self._executor_pid = None
+    self._lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(self.queue_depth)
+
+
+_service = hashing_service(HASH_WORKERS, HASH_QUEUE_DEPTH, HASH_TIMEOUT)
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_service.after_fork)
+
+
+_rounds = {"value": None}
+_rounds_lock = threading.Lock()
+
+
+def calibrate(target_ms=None):
+  ''' Times a bcrypt check at HASH_CALIBRATION_ROUNDS and scales to the target latency
+      Returns the cost, clamped to HASH_MIN_ROUNDS - HASH_MAX_ROUNDS, a warning is logged if the floor applies
+  '''
+  if target_ms is None:
+    target_ms = HASH_TARGET_MS
+
+  hashed = bcrypt.hashpw(b"calibrate", bcrypt.gensalt(rounds=HASH_CALIBRATION_ROUNDS))
+  timings = list()
+  for n in range(3):
+    start = time.perf_counter()
+    bcrypt.checkpw(b"calibrate", hashed)
+    timings.append(time.perf_counter() - start)
+
+  sample_ms = max(min(timings) * 1000, 0.001)
+  rounds = HASH_CALIBRATION_ROUNDS + int(round(math.log2(target_ms / sample_ms)))
+  if rounds < HASH_MIN_ROUNDS:
+    logger.warning("bcrypt cost %s meets the %sms target, using the floor of %s (HASHMINROUNDS)",
+                   rounds, target_ms, HASH_MIN_ROUNDS)
+  return min(max(rounds, HASH_MIN_ROUNDS), HASH_MAX_ROUNDS)
+
+
+def get_rounds():
+  ''' Cost used for new hashes, HASH_ROUNDS if set else calibrated once per process
+  '''
+  with _rounds_lock:
+    if _rounds['value'] is None:
+      _rounds['value'] = HASH_ROUNDS if HASH_ROUNDS else calibrate()
+    return _rounds['value']
+
+
+def set_rounds(rounds=None):
+  ''' Pin the cost for new hashes, None recalibrates on next use
+  '''
+  if rounds is not None and not 4 <= rounds <= HASH_MAX_ROUNDS:
+    raise ValueError("bcrypt rounds must be between 4 and {}".format(HASH_MAX_ROUNDS))
+  with _rounds_lock:
+    _rounds['value'] = rounds
+
+
+def hash_rounds(hashed):
+  ''' Returns the cost stored in a bcrypt hash, or None if it isn't one
+  '''
+  if isinstance(hashed, str):
+    hashed = hashed.encode('utf-8')
+  if not isinstance(hashed, bytes):
+    return None
+  match = _BCRYPT_HASH.match(hashed)
+  if match is None:
+    return None
+  return int(match.group(1))
+
+
+def needs_rehash(hashed):
+  ''' True if hash was made with a lower cost than the current setting
+      Only ever upward, so hosts calibrating to different costs don't keep
+      rewriting each other's hashes, and a slower host never weakens one
+  '''
+  rounds = hash_rounds(hashed)
+  return rounds is not None and rounds < get_rounds()
+
+
+def hash_password(password):
+  ''' Takes bytes, returns bcrypt hash at the current cost
+  '''
+  return _service.run(_hashpw, password, get_rounds())
+
+
+def check_password(password, hashed):
+  ''' Takes bytes, returns boolean
+  '''
+  return _service.run(_checkpw, password, hashed)
+
+
+def configure(workers=None, queue_depth=None, timeout=None):
+  _service.configure(workers=workers, queue_depth=queue_depth, timeout=timeout)
+
+
+def share_workers(web_workers):
+  ''' Size this process's pool as one of web_workers sharing the host
+      For servers started with a worker count other than WEBWORKERS, envvars still win
+  '''
+  if "HASHWORKERS" in os.environ:
+    return
+
+  workers = max(1, (os.cpu_count() or 1) // max(web_workers, 1))
+  queue_depth = None
+  if "HASHQUEUEDEPTH" not in os.environ:
+    queue_depth = workers * 4
+  configure(workers=workers, queue_depth=queue_depth)
+
+
+def shutdown():
+  _service.shutdown()
+
+
+def after_fork():
+  ''' For pre-fork servers to call in each new worker, same as the automatic fork hook
+  '''
+  _service.after_fork()
+
+
+def is_usable(hashed):
+  ''' False for UNUSABLE_PASSWORD, or anything else that can't match a password
+  '''
+  return hash_rounds(hashed) is not None
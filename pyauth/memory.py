@@ -0,0 +1,488 @@
+''' In-memory storage backend
+    Documents live in process local dicts with the same unique keys as the
+    mongo indexes, for tests and local benchmarking without a server or mongomock
+    Backends with the same name share one store, like pooled mongo clients
+'''
+import copy
+import uuid
+import threading
+
+from . import storage
+
+
+class _store(object):
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.clear()
+
+  def clear(self):
+    self.users = dict() # userId: document
+    self.users_by_email = dict()
+    self.groups = dict() # groupId: document, insertion order stands in for natural order
+    self.groups_by_name = dict()
+    self.apps = dict() # appId: document
+    self.apps_by_name = dict()
+    self.apps_by_key = dict()
+    self.members = dict() # groupId: {userId: None}, dicts keep insertion order
+    self.memberships = dict() # userId: {groupId: None}
+
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+def _get_store(name):
+  with _stores_lock:
+    store = _stores.get(name)
+    if store is None:
+      store = _store()
+      _stores[name] = store
+    return store
+
+
+def _copy(doc):
+  # Nested values (groups, legacy members) are the only mutable parts of a document
+  return {key: copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+          for key, value in doc.items()}
+
+
+def _project(doc, projection):
+  ''' Copy of doc with a mongo style projection applied
+  '''
+  if doc is None:
+    return None
+  if not projection:
+    return _copy(doc)
+
+  fields = {field: value for field, value in projection.items() if field != "_id"}
+  if any(fields.values()):
+    return _copy({field: doc[field] for field, value in fields.items() if value and field in doc})
+  return _copy({field: value for field, value in doc.items() if field not in fields})
+
+
+def _set_field(doc, field, value):
+  # Dotted names address nested dicts, as in a mongo $set
+  path = field.split(".")
+  for part in path[:-1]:
+    doc = doc.setdefault(part, dict())
+  doc[path[-1]] = value
+
+
+def _unset_field(doc, field):
+  path = field.split(".")
+  for part in path[:-1]:
+    doc = doc.get(part)
+    if not isinstance(doc, dict):
+      return
+  doc.pop(path[-1], None)
+
+
+class memory(storage.backend):
+  def __init__(self, name="default"):
+    self.name = name
+    self.store = _get_store(name)
+
+
+  def clear_collections(self):
+    with self.store.lock:
+      self.store.clear()
+
+
+  def index_search_value(self, kind, ref_id, value):
+    # Names are searched directly, there is no separate index to maintain
+    pass
+
+
+  def remove_search_value(self, kind, ref_id):
+    pass
+
+
+  def _find_like(self, documents, name_field, id_field, name, limit=None, after=None, mode="contains"):
+    ''' prefix matches the start of the name, contains and substring match anywhere
+        prefix and contains are case sensitive and substring is not, as in mongo
+    '''
+    if mode not in storage.SEARCH_MODES:
+      raise storage.RecordError("find", "unknown search mode")
+
+    with self.store.lock:
+      if mode == "prefix":
+        results = [(doc[id_field], doc[name_field]) for doc in documents.values() if doc[name_field].startswith(name)]
+      elif mode == "substring":
+        results = [(doc[id_field], doc[name_field]) for doc in documents.values() if name.lower() in doc[name_field].lower()]
+      else:
+        results = [(doc[id_field], doc[name_field]) for doc in documents.values() if name in doc[name_field]]
+
+    results.sort(key=lambda result: result[1])
+    if after is not None:
+      results = [result for result in results if result[1] > after]
+    if limit is not None:
+      results = results[:limit]
+    return results
+
+
+  def create_user(self, data):
+    with self.store.lock:
+      if data['email'] in self.store.users_by_email or data['userId'] in self.store.users:
+        raise storage.DuplicateAccount("create user", "an account exists with this email address")
+
+      self.store.users[data['userId']] = _copy(data)
+      self.store.users_by_email[data['email']] = data['userId']
+    return uuid.uuid4().hex
+
+
+  def update_user(self, user_id, data, unset=None, return_document=True, projection=None):
+    with self.store.lock:
+      doc = self.store.users.get(str(user_id))
+      if doc is None:
+        return None
+
+      if data and "email" in data and data['email'] != doc['email']:
+        if data['email'] in self.store.users_by_email:
+          raise storage.DuplicateAccount("update user", "an account exists with this email address")
+        del self.store.users_by_email[doc['email']]
+        self.store.users_by_email[data['email']] = doc['userId']
+
+      for field, value in (data or dict()).items():
+        _set_field(doc, field, copy.deepcopy(value))
+      for field in (unset or list()):
+        _unset_field(doc, field)
+
+      if not return_document:
+        return True
+      return _project(doc, projection)
+
+
+  def get_user_by_email(self, email_address, projection=None):
+    with self.store.lock:
+      user_id = self.store.users_by_email.get(email_address)
+      return _project(self.store.users.get(user_id), projection)
+
+
+  def get_user_by_id(self, user_id, projection=None):
+    with self.store.lock:
+      return _project(self.store.users.get(user_id), projection)
+
+
+  def get_users_by_ids(self, user_ids, projection=None):
+    # Inclusion projections must still return the ID used to key the results
+    if projection is not None and any(projection.values()):
+      projection = dict(projection)
+      projection['userId'] = 1
+
+    users = dict()
+    with self.store.lock:
+      for user_id in user_ids:
+        doc = self.store.users.get(user_id)
+        if doc is not None:
+          users[user_id] = _project(doc, projection)
+    return users
+
+
+  def get_user_by_reset_code(self, reset_code, projection=None):
+    # Reset codes are rare and short lived, a scan is enough here
+    with self.store.lock:
+      documents = [doc for doc in self.store.users.values()
+                   if doc.get("status") == "new" and doc.get("resetCode") == reset_code]
+      if len(documents) > 1:
+        raise storage.RecordError("user reset", "to many records returned")
+      elif len(documents) == 0:
+        return None
+      return _project(documents[0], projection)
+
+
+  def delete_user(self, user_id):
+    with self.store.lock:
+      doc = self.store.users.pop(str(user_id), None)
+      if doc is None:
+        raise storage.RecordError("delete user", "no documents to be deleted")
+      del self.store.users_by_email[doc['email']]
+    return True
+
+
+  def find_users_by_email_address(self, email_address, limit=None, after=None, mode="contains"):
+    return self._find_like(self.store.users, "email", "userId", email_address,
+                           limit=limit, after=after, mode=mode)
+
+
+  def create_group(self, data):
+    with self.store.lock:
+      if data['groupName'] in self.store.groups_by_name or data['groupId'] in self.store.groups:
+        raise storage.DuplicateGroup("create group", "a group exists with this name")
+
+      self.store.groups[data['groupId']] = _copy(data)
+      self.store.groups_by_name[data['groupName']] = data['groupId']
+    return uuid.uuid4().hex
+
+
+  def get_group_by_name(self, group_name, projection=None):
+    with self.store.lock:
+      group_id = self.store.groups_by_name.get(group_name)
+      return _project(self.store.groups.get(group_id), projection)
+
+
+  def get_group_by_id(self, group_id, projection=None):
+    with self.store.lock:
+      return _project(self.store.groups.get(group_id), projection)
+
+
+  def update_group(self, group_id, data, projection=None):
+    with self.store.lock:
+      doc = self.store.groups.get(str(group_id))
+      if doc is None:
+        return None
+
+      if "groupName" in data and data['groupName'] != doc['groupName']:
+        if data['groupName'] in self.store.groups_by_name:
+          raise storage.DuplicateGroup("update group", "a group exists with this name")
+        del self.store.groups_by_name[doc['groupName']]
+        self.store.groups_by_name[data['groupName']] = doc['groupId']
+
+      for field, value in data.items():
+        _set_field(doc, field, copy.deepcopy(value))
+
+      if "groupName" in data:
+        self.set_user_group(self.get_group_member_ids(group_id), group_id, data['groupName'])
+      return _project(doc, projection)
+
+
+  def find_groups_by_name(self, group_name, limit=None, after=None, mode="contains"):
+    return self._find_like(self.store.groups, "groupName", "groupId", group_name,
+                           limit=limit, after=after, mode=mode)
+
+
+  def delete_group(self, group_id):
+    group_id = str(group_id)
+    with self.store.lock:
+      doc = self.store.groups.pop(group_id, None)
+      if doc is None:
+        raise storage.RecordError("delete group", "no documents to be deleted")
+      del self.store.groups_by_name[doc['groupName']]
+
+      member_ids = list(self.store.members.pop(group_id, dict()).keys())
+      self.unset_user_group(member_ids, group_id)
+      for user_id in member_ids:
+        self.store.memberships.get(user_id, dict()).pop(group_id, None)
+    return True
+
+
+  def add_group_member(self, group_id, user_id, group_name=None):
+    group_id, user_id = str(group_id), str(user_id)
+    with self.store.lock:
+      members = self.store.members.setdefault(group_id, dict())
+      if user_id in members:
+        return False
+
+      members[user_id] = None
+      self.store.memberships.setdefault(user_id, dict())[group_id] = None
+      self.set_user_group([user_id], group_id, group_name)
+    return True
+
+
+  def remove_group_member(self, group_id, user_id):
+    group_id, user_id = str(group_id), str(user_id)
+    with self.store.lock:
+      members = self.store.members.get(group_id, dict())
+      if user_id not in members:
+        return False
+
+      del members[user_id]
+      self.store.memberships.get(user_id, dict()).pop(group_id, None)
+      self.unset_user_group([user_id], group_id)
+    return True
+
+
+  def set_group_members(self, group_id, user_ids, group_name=None):
+    user_ids = [str(user_id) for user_id in user_ids]
+    with self.store.lock:
+      for user_id in set(self.get_group_member_ids(group_id)) - set(user_ids):
+        self.remove_group_member(group_id, user_id)
+
+      if group_name is None and len(user_ids) > 0:
+        group_name = self._get_group_name(group_id)
+      for user_id in user_ids:
+        self.add_group_member(group_id, user_id, group_name=group_name)
+
+
+  def _get_group_name(self, group_id):
+    doc = self.store.groups.get(str(group_id))
+    if doc is None:
+      return None
+    return doc['groupName']
+
+
+  def set_user_group(self, user_ids, group_id, group_name=None):
+    with self.store.lock:
+      if group_name is None:
+        group_name = self._get_group_name(group_id)
+        if group_name is None:
+          return
+
+      for user_id in user_ids:
+        doc = self.store.users.get(str(user_id))
+        if doc is not None and "groups" in doc:
+          doc['groups'][str(group_id)] = group_name
+
+
+  def unset_user_group(self, user_ids, group_id):
+    with self.store.lock:
+      for user_id in user_ids:
+        doc = self.store.users.get(str(user_id))
+        if doc is not None and isinstance(doc.get("groups"), dict):
+          doc['groups'].pop(str(group_id), None)
+
+
+  def get_group_member_ids(self, group_id):
+    with self.store.lock:
+      return list(self.store.members.get(str(group_id), dict()).keys())
+
+
+  def find_user_groups(self, user_id):
+    with self.store.lock:
+      group_ids = self.store.memberships.get(str(user_id), dict())
+      return [(doc['groupId'], doc['groupName']) for doc in self.store.groups.values()
+              if doc['groupId'] in group_ids]
+
+
+  def create_app(self, data):
+    with self.store.lock:
+      if (data['appName'] in self.store.apps_by_name or data['appId'] in self.store.apps
+          or data.get("key") in self.store.apps_by_key):
+        raise storage.DuplicateApp("create app", "an app exists with this name")
+
+      self.store.apps[data['appId']] = _copy(data)
+      self.store.apps_by_name[data['appName']] = data['appId']
+      if "key" in data:
+        self.store.apps_by_key[data['key']] = data['appId']
+    return uuid.uuid4().hex
+
+
+  def get_app_by_id(self, app_id, projection=None):
+    with self.store.lock:
+      return _project(self.store.apps.get(app_id), projection)
+
+
+  def get_app_by_name(self, app_name, projection=None):
+    with self.store.lock:
+      app_id = self.store.apps_by_name.get(app_name)
+      return _project(self.store.apps.get(app_id), projection)
+
+
+  def get_app_by_key(self, app_key, projection=None):
+    with self.store.lock:
+      app_id = self.store.apps_by_key.get(app_key)
+      return _project(self.store.apps.get(app_id), projection)
+
+
+  def delete_app(self, app_id):
+    with self.store.lock:
+      doc = self.store.apps.pop(str(app_id), None)
+      if doc is None:
+        raise storage.RecordError("delete app", "no documents to be deleted")
+      del self.store.apps_by_name[doc['appName']]
+      self.store.apps_by_key.pop(doc.get("key"), None)
+    return True
+
+
+  def find_apps_by_name(self, app_name, limit=None, after=None, mode="contains"):
+    return self._find_like(self.store.apps, "appName", "appId", app_name,
+                           limit=limit, after=after, mode=mode)
+
+
+class async_memory(storage.async_backend):
+  ''' memory as coroutines, calls never block so they run inline on the event loop
+  '''
+  def __init__(self, name="default"):
+    self.backend = memory(name)
+
+  async def clear_collections(self):
+    return self.backend.clear_collections()
+
+  async def index_search_value(self, kind, ref_id, value):
+    return self.backend.index_search_value(kind, ref_id, value)
+
+  async def remove_search_value(self, kind, ref_id):
+    return self.backend.remove_search_value(kind, ref_id)
+
+  # Users
+  async def create_user(self, data):
+    return self.backend.create_user(data)
+
+  async def update_user(self, user_id, data, unset=None, return_document=True, projection=None):
+    return self.backend.update_user(user_id, data, unset=unset, return_document=return_document, projection=projection)
+
+  async def get_user_by_email(self, email_address, projection=None):
+    return self.backend.get_user_by_email(email_address, projection=projection)
+
+  async def get_user_by_id(self, user_id, projection=None):
+    return self.backend.get_user_by_id(user_id, projection=projection)
+
+  async def get_users_by_ids(self, user_ids, projection=None):
+    return self.backend.get_users_by_ids(user_ids, projection=projection)
+
+  async def get_user_by_reset_code(self, reset_code, projection=None):
+    return self.backend.get_user_by_reset_code(reset_code, projection=projection)
+
+  async def delete_user(self, user_id):
+    return self.backend.delete_user(user_id)
+
+  async def find_users_by_email_address(self, email_address, limit=None, after=None, mode="contains"):
+    return self.backend.find_users_by_email_address(email_address, limit=limit, after=after, mode=mode)
+
+  # Groups
+  async def create_group(self, data):
+    return self.backend.create_group(data)
+
+  async def get_group_by_name(self, group_name, projection=None):
+    return self.backend.get_group_by_name(group_name, projection=projection)
+
+  async def get_group_by_id(self, group_id, projection=None):
+    return self.backend.get_group_by_id(group_id, projection=projection)
+
+  async def update_group(self, group_id, data, projection=None):
+    return self.backend.update_group(group_id, data, projection=projection)
+
+  async def find_groups_by_name(self, group_name, limit=None, after=None, mode="contains"):
+    return self.backend.find_groups_by_name(group_name, limit=limit, after=after, mode=mode)
+
+  async def delete_group(self, group_id):
+    return self.backend.delete_group(group_id)
+
+  async def add_group_member(self, group_id, user_id, group_name=None):
+    return self.backend.add_group_member(group_id, user_id, group_name=group_name)
+
+  async def remove_group_member(self, group_id, user_id):
+    return self.backend.remove_group_member(group_id, user_id)
+
+  async def set_group_members(self, group_id, user_ids, group_name=None):
+    return self.backend.set_group_members(group_id, user_ids, group_name=group_name)
+
+  async def set_user_group(self, user_ids, group_id, group_name=None):
+    return self.backend.set_user_group(user_ids, group_id, group_name=group_name)
+
+  async def unset_user_group(self, user_ids, group_id):
+    return self.backend.unset_user_group(user_ids, group_id)
+
+  async def get_group_member_ids(self, group_id):
+    return self.backend.get_group_member_ids(group_id)
+
+  async def find_user_groups(self, user_id):
+    return self.backend.find_user_groups(user_id)
+
+  # Apps
+  async def create_app(self, data):
+    return self.backend.create_app(data)
+
+  async def get_app_by_id(self, app_id, projection=None):
+    return self.backend.get_app_by_id(app_id, projection=projection)
+
+  async def get_app_by_name(self, app_name, projection=None):
+    return self.backend.get_app_by_name(app_name, projection=projection)
+
+  async def get_app_by_key(self, app_key, projection=None):
+    return self.backend.get_app_by_key(app_key, projection=projection)
+
+  async def delete_app(self, app_id):
+    return self.backend.delete_app(app_id)
+
+  async def find_apps_by_name(self, app_name, limit=None, after=None, mode="contains"):
+    return self.backend.find_apps_by_name(app_name, limit=limit, after=after, mode=mode)
@@ -1,47 +1,202 @@
 import os
-import json
 import pymongo
 import re
+import time
+import hashlib
+import threading
 
 from bson.objectid import ObjectId
 
+from . import storage
+# Errors and paging helpers are shared by every backend, kept here for existing callers
+from .storage import (
+    Error, ConnectionError, RecordError, DuplicateAccount, DuplicateGroup, DuplicateApp,
+    FIND_PAGE_SIZE, FIND_MAX_LIMIT, SEARCH_MODES, encode_cursor, decode_cursor, find_page, iter_find
+)
+
 MONGO_HOST = os.environ.get("MONGOHOST")
 MONGO_USER = os.environ.get("MONGOUSER")
 MONGO_PASSWORD = os.environ.get("MONGOPASSWORD")
 MONGO_PORT = 27017
+MONGO_POOL_SIZE = int(os.environ.get("MONGOPOOLSIZE", 100))
+MONGO_HEALTH_INTERVAL = int(os.environ.get("MONGOHEALTHINTERVAL", 30)) # Seconds between client health checks
+MONGO_IN_CHUNK_SIZE = 5000 # IDs per $in query, keeps large groups well under the BSON document limit
+SEARCH_NGRAM_SIZE = 3
+DUPLICATE_KEY_ERROR = 11000
+# Maintain the n-gram search index on writes, required for 'substring' mode
+SEARCH_INDEX_ENABLED = os.environ.get("MONGOSEARCHINDEX", "true").lower() != "false"
+
+# Process-wide client registry, one pooled client per server and credentials
+_clients = dict()
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
+
+
+def search_ngrams(value):
+  ''' Lower-cased, de-duplicated n-grams of the given string
+      Windows run to the end of the string, so the shorter suffixes are included
+      and queries shorter than an n-gram can match at the end of a value
+  '''
+  value = value.lower()
+  return sorted(set(value[n:n + SEARCH_NGRAM_SIZE] for n in range(len(value))))
+
+
+def like_query(name_field, name, after=None, mode="contains"):
+  ''' Query for the contains and prefix search modes
+  '''
+  escaped_name = re.escape(name)
+  if mode == "prefix":
+    query = {name_field: {"$regex": "^{}".format(escaped_name)}}
+  else:
+    query = {name_field: {"$regex": escaped_name}}
+
+  if after is not None:
+    query = {"$and": [query, {name_field: {"$gt": after}}]}
+  return query
+
+
+def substring_query(kind, name, after=None):
+  ''' Query on the search index collection for the substring search mode
+  '''
+  if len(name) < SEARCH_NGRAM_SIZE:
+    # Shorter than an n-gram, match n-grams or suffixes starting with it
+    gram_query = {"grams": {"$regex": "^{}".format(re.escape(name.lower()))}}
+  else:
+    # Suffixes only match at the end of a value, the query needs its full n-grams
+    grams = [gram for gram in search_ngrams(name) if len(gram) == SEARCH_NGRAM_SIZE]
+    gram_query = {"grams": {"$all": grams}}
+
+  # n-grams narrow the candidates, the regex confirms they are contiguous
+  # Case-insensitive, as the n-grams are
+  query = {"$and": [{"kind": kind}, gram_query, {"value": {"$regex": re.escape(name), "$options": "i"}}]}
+  if after is not None:
+    query['$and'].append({"value": {"$gt": after}})
+  return query
+
+
+def update_document(data, unset=None):
+  ''' One $set/$unset update for the given fields
+  '''
+  update = dict()
+  if data:
+    update['$set'] = data
+  if unset:
+    update['$unset'] = {field: "" for field in unset}
+  return update
+
+
+def member_upserts(group_id, user_ids):
+  ''' One upsert per membership, for a single unordered bulk_write
+  '''
+  upserts = list()
+  for user_id in user_ids:
+    membership = {"groupId": str(group_id), "userId": user_id}
+    upserts.append(pymongo.UpdateOne(membership, {"$setOnInsert": membership}, upsert=True))
+  return upserts
+
+
+def only_duplicate_keys(bulk_error):
+  ''' True if every failed write in a BulkWriteError hit a unique index
+      i.e. a concurrent add of the same member, which is not an error here
+  '''
+  return all(error['code'] == DUPLICATE_KEY_ERROR for error in bulk_error.details['writeErrors'])
+
+
+def without_id(projection):
+  ''' Projection that never returns the mongo doc ID
+  '''
+  if projection is None:
+    return {"_id": 0}
+  elif "_id" not in projection:
+    return dict(projection, _id=0)
+  return projection
+
+
+class _registered_client(object):
+  def __init__(self, client):
+    self.client = client
+    self.last_checked = None
+
+
+def _reset_registry():
+  ''' Forget clients inherited from a parent process
+      pymongo clients are not fork-safe, they are dropped rather than closed
+      so the parent's sockets are left alone
+  '''
+  global _clients, _clients_pid, _clients_lock
+  _clients = dict()
+  _clients_pid = os.getpid()
+  _clients_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_registry)
+
+
+def after_fork():
+  ''' For pre-fork servers to call in each new worker, same as the automatic fork hook
+  '''
+  _reset_registry()
+
+
+def get_client(host, port, username=None, password=None, pool_size=None):
+  ''' Returns the pooled client for the given server and credentials
+      Clients are created on first use without connecting and are shared by
+      every mongo object in the process. Health is checked on creation and then
+      at most once every MONGO_HEALTH_INTERVAL seconds
+  '''
+  if os.getpid() != _clients_pid:
+    _reset_registry()
+
+  if pool_size is None:
+    pool_size = MONGO_POOL_SIZE
+
+  # Credentials are part of the key, hash the password rather than hold it twice
+  password_hash = None
+  if password is not None:
+    password_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
+  client_key = (host, port, username, password_hash, pool_size)
+
+  with _clients_lock:
+    registered = _clients.get(client_key)
+    if registered is None:
+      client = pymongo.MongoClient(host, port,
+                                   username=username,
+                                   password=password,
+                                   maxPoolSize=pool_size,
+                                   connect=False)
+      registered = _registered_client(client)
+      _clients[client_key] = registered
+
+  time_now = time.monotonic()
+  if registered.last_checked is None or time_now - registered.last_checked > MONGO_HEALTH_INTERVAL:
+    try:
+      registered.client.server_info()
+      registered.last_checked = time_now
+    except pymongo.errors.ConnectionFailure:
+      with _clients_lock:
+        if _clients.get(client_key) is registered:
+          del _clients[client_key]
+      registered.client.close()
+      raise ConnectionError("new connection", "could not connect to host")
 
-class Error(Exception):
-  pass
-
-class ConnectionError(Error):
-  def __init__(self, expression, message):
-    self.expression = expression
-    self.message = message
-
-class RecordError(Error):
-  def __init__(self, expression, message):
-    self.expression = expression
-    self.message = message
+  return registered.client
 
-class DuplicateAccount(Error):
-  def __init__(self, expression, message):
-    self.expression = expression
-    self.message = message
 
-class DuplicateGroup(Error):
-  def __init__(self, expression, message):
-    self.expression = expression
-    self.message = message
+def close_clients():
+  ''' Close and forget every pooled client in this process
+  '''
+  with _clients_lock:
+    registered_clients = list(_clients.values())
+    _clients.clear()
 
-class DuplicateApp(Error):
-  def __init__(self, expression, message):
-    self.expression = expression
-    self.message = message
+  for registered in registered_clients:
+    registered.client.close()
 
 
-class mongo(object):
+class mongo(storage.backend):
   def __init__(self, mongo_host=None, mongo_port=None,
-                     username=None, password=None):
+                     username=None, password=None, pool_size=None):
     if mongo_host is not None:
       self.host = mongo_host
     elif mongo_host is None and MONGO_HOST:
@@ -59,81 +214,160 @@ class mongo(object):
       raise ConnectionError("new connection", "port required")
 
 
+    if pool_size is not None and not isinstance(pool_size, int):
+      raise ConnectionError("new connection", "pool size must be int")
+
+    # Clients are pooled per process, so constructing a mongo object is cheap
     if username is not None:
-      self.client = pymongo.MongoClient(self.host, self.port, username=username, password=password)
+      self.client = get_client(self.host, self.port, username=username, password=password, pool_size=pool_size)
     else:
-      self.client = pymongo.MongoClient(self.host, self.port, username=MONGO_USER, password=MONGO_PASSWORD)
-
-    try:
-      self.client.server_info()
-    except pymongo.errors.ConnectionFailure:
-      raise ConnectionError("new connection", "could not connect to host")
+      self.client = get_client(self.host, self.port, username=MONGO_USER, password=MONGO_PASSWORD, pool_size=pool_size)
 
     self.users_collection = self.client.pyauth.users
     self.groups_collection = self.client.pyauth.groups
     self.apps_collection = self.client.pyauth.apps
+    self.memberships_collection = self.client.pyauth.memberships
+    self.search_collection = self.client.pyauth.search_index
 
   def clear_collections(self):
     # Required to allow unit testing to clear up after runs
     self.users_collection.delete_many({})
     self.groups_collection.delete_many({})
     self.apps_collection.delete_many({})
+    self.memberships_collection.delete_many({})
+    self.search_collection.delete_many({})
+
+
+  def _find_one(self, collection, query, expression, projection=None):
+    ''' Fetch at most two documents, enough to detect duplicates without
+        pulling every match over the wire. Mongo doc ID is not returned
+        Returns document or None, raises RecordError if more than one matches
+    '''
+    documents = list(collection.find(query, without_id(projection)).limit(2))
+
+    if len(documents) > 1:
+      raise RecordError(expression, "to many records returned")
+
+    elif len(documents) == 0:
+      return None
+
+    return documents[0]
+
+
+  def _find_like(self, collection, kind, name_field, id_field, name, limit=None, after=None, mode="contains"):
+    ''' Search modes
+          contains - unanchored regex, scans every name
+          prefix - anchored regex, served by the unique index on the name field
+          substring - n-gram lookup in the search index collection, then exact match
+    '''
+    if mode not in SEARCH_MODES:
+      raise RecordError("find", "unknown search mode")
+
+    if mode == "substring":
+      return self._find_substring(kind, name, limit=limit, after=after)
+
+    query = like_query(name_field, name, after=after, mode=mode)
+    docs = collection.find(query, {id_field: 1, name_field: 1, "_id": 0}).sort(name_field, pymongo.ASCENDING)
+    if limit is not None:
+      docs = docs.limit(limit)
+
+    results = list()
+    for doc in docs:
+      results.append((doc[id_field], doc[name_field]))
+
+    return results
+
+
+  def _find_substring(self, kind, name, limit=None, after=None):
+    query = substring_query(kind, name, after=after)
+    docs = self.search_collection.find(query, {"refId": 1, "value": 1, "_id": 0}).sort("value", pymongo.ASCENDING)
+    if limit is not None:
+      docs = docs.limit(limit)
+
+    results = list()
+    for doc in docs:
+      results.append((doc['refId'], doc['value']))
+
+    return results
+
+
+  def index_search_value(self, kind, ref_id, value):
+    ''' Add or replace the search index entry for a user, group or app
+    '''
+    if not SEARCH_INDEX_ENABLED:
+      return
+
+    self.search_collection.update_one({"kind": kind, "refId": str(ref_id)},
+                                      {"$set": {"value": value,
+                                                "grams": search_ngrams(value)}},
+                                      upsert=True)
+
+
+  def remove_search_value(self, kind, ref_id):
+    self.search_collection.delete_one({"kind": kind, "refId": str(ref_id)})
 
 
   def create_user(self, data):
     try:
       doc_id = self.users_collection.insert_one(data).inserted_id
+      self.index_search_value("users", data['userId'], data['email'])
       return doc_id
 
     except pymongo.errors.DuplicateKeyError:
       raise DuplicateAccount("create user", "an account exists with this email address")
 
 
-  def update_user(self, user_id, data):
-    doc = self.users_collection.find_one_and_update({"userId" : str(user_id)},
-                                              {"$set": data},
-                                               upsert=False,
-                                               return_document=pymongo.collection.ReturnDocument.AFTER)
-    return doc
-
-
-  def get_user_by_email(self, email_address):
-    documents = self.users_collection.find({"email": email_address})
-    documents = list(documents)
+  def update_user(self, user_id, data, unset=None, return_document=True, projection=None):
+    ''' One $set/$unset for all given fields
+        Returns updated document, or True without fetching it if return_document is False
+        Returns None if no user matched
+    '''
+    update = update_document(data, unset)
+
+    if return_document:
+      doc = self.users_collection.find_one_and_update({"userId" : str(user_id)},
+                                                update,
+                                                 projection=projection,
+                                                 upsert=False,
+                                                 return_document=pymongo.collection.ReturnDocument.AFTER)
+    else:
+      result = self.users_collection.update_one({"userId" : str(user_id)}, update, upsert=False)
+      doc = True if result.matched_count else None
 
-    if len(documents) > 1:
-      raise RecordError("get user", "to many records returned")
+    if doc is not None and data and "email" in data:
+      self.index_search_value("users", user_id, data['email'])
+    return doc
 
-    elif len(documents) == 0:
-      return None
 
-    return documents[0]
+  def get_user_by_email(self, email_address, projection=None):
+    return self._find_one(self.users_collection, {"email": email_address}, "get user", projection=projection)
 
 
-  def get_user_by_id(self, user_id):
-    documents = self.users_collection.find({"userId": user_id})
-    documents = list(documents)
+  def get_user_by_id(self, user_id, projection=None):
+    return self._find_one(self.users_collection, {"userId": user_id}, "get user", projection=projection)
 
-    if len(documents) > 1:
-      raise RecordError("get user", "to many records returned")
 
-    elif len(documents) == 0:
-      return None
+  def get_users_by_ids(self, user_ids, projection=None, chunk_size=MONGO_IN_CHUNK_SIZE):
+    ''' One $in query per chunk of IDs
+        Returns dict of user ID to document, unknown IDs are omitted
+    '''
+    # Inclusion projections must still return the ID used to key the results
+    if projection is not None and any(projection.values()):
+      projection = dict(projection)
+      projection['userId'] = 1
 
-    return documents[0]
+    user_ids = list(user_ids)
+    users = dict()
+    for chunk_start in range(0, len(user_ids), chunk_size):
+      chunk = user_ids[chunk_start:chunk_start + chunk_size]
+      for doc in self.users_collection.find({"userId": {"$in": chunk}}, projection):
+        users[doc['userId']] = doc
 
+    return users
 
-  def get_user_by_reset_code(self, reset_code):
-    documents = self.users_collection.find({"$and": [{"status": {"$eq": "new"}}, {"resetCode": {"$eq": reset_code}}]})
-    documents = list(documents)
 
-    if len(documents) > 1:
-      raise RecordError("user reset", "to many records returned")
-
-    elif len(documents) == 0:
-      return None
-
-    return documents[0]
+  def get_user_by_reset_code(self, reset_code, projection=None):
+    return self._find_one(self.users_collection, {"$and": [{"status": {"$eq": "new"}}, {"resetCode": {"$eq": reset_code}}]}, "user reset", projection=projection)
 
 
   def delete_user(self, user_id):
@@ -146,78 +380,56 @@ class mongo(object):
       raise RecordError("delete user", "no documents to be deleted")
 
     else:
+      self.remove_search_value("users", user_id)
       return True
 
 
-  def find_users_by_email_address(self, email_address):
-    ''' Use basic regex to find names like that supplied
+  def find_users_by_email_address(self, email_address, limit=None, after=None, mode="contains"):
+    ''' Find names like that supplied, ordered by name
         Returns list of tuples: (ID, name)
+        Limit and after (last name of the previous page) select a page
     '''
-    regex = re.compile('.*{}.*'.format(email_address))
-    docs = self.users_collection.find({'email': regex})
-
-    user_ids = list()
-    for doc in docs:
-      user_ids.append((doc['userId'], doc['email']))
-
-    return user_ids
+    return self._find_like(self.users_collection, "users", "email", "userId", email_address,
+                           limit=limit, after=after, mode=mode)
 
 
   def create_group(self, data):
     try:
       doc_id = self.groups_collection.insert_one(data).inserted_id
+      self.index_search_value("groups", data['groupId'], data['groupName'])
       return doc_id
 
     except pymongo.errors.DuplicateKeyError:
       raise DuplicateGroup("create group", "a group exists with this name")
 
 
-  def get_group_by_name(self, group_name):
-    documents = self.groups_collection.find({"groupName": group_name})
-    documents = list(documents)
-
-    if len(documents) > 1:
-      raise RecordError("get group", "to many records returned")
-
-    elif len(documents) == 0:
-      return None
+  def get_group_by_name(self, group_name, projection=None):
+    return self._find_one(self.groups_collection, {"groupName": group_name}, "get group", projection=projection)
 
-    return documents[0]
 
+  def get_group_by_id(self, group_id, projection=None):
+    return self._find_one(self.groups_collection, {"groupId": group_id}, "get group", projection=projection)
 
-  def get_group_by_id(self, group_id):
-    documents = self.groups_collection.find({"groupId": group_id})
-    documents = list(documents)
 
-    if len(documents) > 1:
-      raise RecordError("get group", "to many records returned")
-
-    elif len(documents) == 0:
-      return None
-
-    return documents[0]
-
-
-  def update_group(self, group_id, data):
+  def update_group(self, group_id, data, projection=None):
     doc = self.groups_collection.find_one_and_update({"groupId" : str(group_id)},
                                                      {"$set": data},
+                                                      projection=projection,
                                                       upsert=False,
                                                       return_document=pymongo.collection.ReturnDocument.AFTER)
+    if doc is not None and "groupName" in data:
+      self.index_search_value("groups", group_id, data['groupName'])
+      self.set_user_group(self.get_group_member_ids(group_id), group_id, data['groupName'])
     return doc
 
 
-  def find_groups_by_name(self, group_name):
-    ''' Use basic regex to find names like that supplied
+  def find_groups_by_name(self, group_name, limit=None, after=None, mode="contains"):
+    ''' Find names like that supplied, ordered by name
         Returns list of tuples: (ID, name)
+        Limit and after (last name of the previous page) select a page
     '''
-    regex = re.compile('.*{}.*'.format(group_name))
-    docs = self.groups_collection.find({'groupName': regex})
-
-    groups = list()
-    for doc in docs:
-      groups.append((doc['groupId'], doc['groupName']))
-
-    return groups
+    return self._find_like(self.groups_collection, "groups", "groupName", "groupId", group_name,
+                           limit=limit, after=after, mode=mode)
 
 
   def delete_group(self, group_id):
@@ -230,12 +442,115 @@ class mongo(object):
       raise RecordError("delete group", "no documents to be deleted")
 
     else:
+      self.unset_user_group(self.get_group_member_ids(group_id), group_id)
+      self.memberships_collection.delete_many({"groupId": str(group_id)})
+      self.remove_search_value("groups", group_id)
       return True
 
 
+  def add_group_member(self, group_id, user_id, group_name=None):
+    ''' Upsert a single membership document
+        Returns True if added, False if the user was already a member
+    '''
+    membership = {"groupId": str(group_id), "userId": str(user_id)}
+    try:
+      result = self.memberships_collection.update_one(membership,
+                                                      {"$setOnInsert": membership},
+                                                      upsert=True)
+    except pymongo.errors.DuplicateKeyError:
+      # Concurrent add of the same member, unique index rejected the second insert
+      return False
+
+    if result.upserted_id is None:
+      return False
+
+    self.set_user_group([user_id], group_id, group_name)
+    return True
+
+
+  def remove_group_member(self, group_id, user_id):
+    ''' Returns True if removed, False if the user was not a member
+    '''
+    result = self.memberships_collection.delete_one({"groupId": str(group_id), "userId": str(user_id)})
+    if result.deleted_count != 1:
+      return False
+
+    self.unset_user_group([user_id], group_id)
+    return True
+
+
+  def set_group_members(self, group_id, user_ids, group_name=None):
+    ''' Replace group membership with the given user IDs
+        Members are upserted with one bulk write, existing ones are left as they are
+    '''
+    user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    removed_ids = list(set(self.get_group_member_ids(group_id)) - set(user_ids))
+    if removed_ids:
+      self.memberships_collection.delete_many({"groupId": str(group_id), "userId": {"$in": removed_ids}})
+      self.unset_user_group(removed_ids, group_id)
+
+    if len(user_ids) == 0:
+      return
+
+    try:
+      self.memberships_collection.bulk_write(member_upserts(group_id, user_ids), ordered=False)
+    except pymongo.errors.BulkWriteError as err:
+      if not only_duplicate_keys(err):
+        raise
+
+    self.set_user_group(user_ids, group_id, group_name)
+
+
+  def _get_group_name(self, group_id):
+    group_doc = self.get_group_by_id(str(group_id), projection={"groupName": 1})
+    if group_doc is None:
+      return None
+    return group_doc['groupName']
+
+
+  def set_user_group(self, user_ids, group_id, group_name=None):
+    ''' Record group in each user's denormalised groups field, {group ID: group name}
+        Users without the field are left alone, they have not been migrated yet
+    '''
+    if group_name is None:
+      group_name = self._get_group_name(group_id)
+      if group_name is None:
+        return
+
+    field = "groups.{}".format(group_id)
+    user_ids = [str(user_id) for user_id in user_ids]
+    for start in range(0, len(user_ids), MONGO_IN_CHUNK_SIZE):
+      self.users_collection.update_many({"userId": {"$in": user_ids[start:start + MONGO_IN_CHUNK_SIZE]},
+                                         "groups": {"$exists": True}},
+                                        {"$set": {field: group_name}})
+
+
+  def unset_user_group(self, user_ids, group_id):
+    field = "groups.{}".format(group_id)
+    user_ids = [str(user_id) for user_id in user_ids]
+    for start in range(0, len(user_ids), MONGO_IN_CHUNK_SIZE):
+      self.users_collection.update_many({"userId": {"$in": user_ids[start:start + MONGO_IN_CHUNK_SIZE]},
+                                         field: {"$exists": True}},
+                                        {"$unset": {field: ""}})
+
+
+  def get_group_member_ids(self, group_id):
+    docs = self.memberships_collection.find({"groupId": str(group_id)},
+                                            {"userId": 1, "_id": 0})
+    return [doc['userId'] for doc in docs]
+
+
   def find_user_groups(self, user_id):
-    docs = self.groups_collection.find({"members": str(user_id)})
-    docs = list(docs)
+    ''' Returns list of tuples: (ID, name)
+    '''
+    docs = self.memberships_collection.find({"userId": str(user_id)},
+                                            {"groupId": 1, "_id": 0})
+    group_ids = [doc['groupId'] for doc in docs]
+    if len(group_ids) == 0:
+      return list()
+
+    docs = self.groups_collection.find({"groupId": {"$in": group_ids}},
+                                       {"groupId": 1, "groupName": 1, "_id": 0})
 
     groups = list()
     for doc in docs:
@@ -247,49 +562,23 @@ class mongo(object):
   def create_app(self, data):
     try:
       doc_id = self.apps_collection.insert_one(data).inserted_id
+      self.index_search_value("apps", data['appId'], data['appName'])
       return doc_id
 
     except pymongo.errors.DuplicateKeyError:
       raise DuplicateApp("create app", "an app exists with this name")
 
 
-  def get_app_by_id(self, app_id):
-    documents = self.apps_collection.find({"appId": app_id})
-    documents = list(documents)
-
-    if len(documents) > 1:
-      raise RecordError("get app", "to many records returned")
-
-    elif len(documents) == 0:
-      return None
-
-    return documents[0]
-
+  def get_app_by_id(self, app_id, projection=None):
+    return self._find_one(self.apps_collection, {"appId": app_id}, "get app", projection=projection)
 
-  def get_app_by_name(self, app_name):
-    documents = self.apps_collection.find({"appName": app_name})
-    documents = list(documents)
 
-    if len(documents) > 1:
-      raise RecordError("get app", "to many records returned")
+  def get_app_by_name(self, app_name, projection=None):
+    return self._find_one(self.apps_collection, {"appName": app_name}, "get app", projection=projection)
 
-    elif len(documents) == 0:
-      return None
 
-    return documents[0]
-
-
-  def get_app_by_key(self, app_key):
-    documents = self.apps_collection.find({"key": app_key})
-    documents = list(documents)
-
-    if len(documents) > 1:
-      raise RecordError("get app", "to many records returned")
-
-    elif len(documents) == 0:
-      return None
-
-    return documents[0]
+  def get_app_by_key(self, app_key, projection=None):
+    return self._find_one(self.apps_collection, {"key": app_key}, "get app", projection=projection)
 
 
   def delete_app(self, app_id):
@@ -302,18 +591,14 @@ class mongo(object):
       raise RecordError("delete app", "no documents to be deleted")
 
     else:
+      self.remove_search_value("apps", app_id)
       return True
 
 
-  def find_apps_by_name(self, app_name):
-    ''' Use basic regex to find names like that supplied
+  def find_apps_by_name(self, app_name, limit=None, after=None, mode="contains"):
+    ''' Find names like that supplied, ordered by name
         Returns list of tuples: (ID, name)
+        Limit and after (last name of the previous page) select a page
     '''
-    regex = re.compile('.*{}.*'.format(app_name))
-    docs = self.apps_collection.find({'appName': regex})
-
-    apps = list()
-    for doc in docs:
-      apps.append((doc['appId'], doc['appName']))
-
-    return apps
+    return self._find_like(self.apps_collection, "apps", "appName", "appId", app_name,
+                           limit=limit, after=after, mode=mode)
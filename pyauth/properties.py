@@ -0,0 +1,92 @@
+import types
+
+
+MISSING = object() # Returned by a loader when the document has no such field
+
+
+class read_only_properties(object):
+  ''' Base for the user, group and app property containers
+      Fields live in the instance dict so attribute reads stay plain lookups,
+      everything else reads through a mapping proxy over that dict
+      Heavy fields can be given as loaders, fetched on first access
+      Subclasses set _redacted (fields left out of as_dict), _read_only_error and _read_only_message
+  '''
+  __slots__ = ("__dict__", "_lazy")
+  _redacted = ()
+  _read_only_error = AttributeError
+  _read_only_message = "properties are read-only"
+
+  def __init__(self, doc, lazy=None):
+    # Shallow copy so later changes to the source document don't show through
+    self.__dict__.update(doc)
+    object.__setattr__(self, "_lazy", dict(lazy or dict()))
+
+  def __getattr__(self, name):
+    # Only called when normal lookup fails, i.e. for fields not loaded yet
+    if name == "_lazy":
+      raise AttributeError(name)
+
+    loader = self._lazy.get(name)
+    if loader is None:
+      raise AttributeError(name)
+
+    value = loader()
+    self._lazy.pop(name, None)
+    if value is MISSING:
+      raise AttributeError(name)
+
+    self.__dict__[name] = value
+    return value
+
+  def __setattr__(self, name, value):
+    raise self._read_only_error("set property", self._read_only_message)
+
+  def __delattr__(self, name):
+    raise self._read_only_error("delete property", self._read_only_message)
+
+  def __contains__(self, name):
+    return name in self.__dict__ or name in self._lazy
+
+  def get(self, name, default=None):
+    if name in self.__dict__:
+      return self.__dict__[name]
+    if name in self._lazy:
+      return getattr(self, name, default)
+    return default
+
+  def is_loaded(self, name):
+    ''' False while a lazy field is still waiting to be fetched
+    '''
+    return name not in self._lazy
+
+  def load(self, names=None):
+    ''' Fetch pending lazy fields, all of them if names is None
+    '''
+    if names is None:
+      names = list(self._lazy.keys())
+    for name in names:
+      if name in self._lazy:
+        getattr(self, name, None)
+
+  def view(self):
+    ''' Read-only mapping of every field, including redacted ones, no copy is made
+        Pending lazy fields are fetched first
+    '''
+    self.load()
+    return types.MappingProxyType(self.__dict__)
+
+  def as_dict(self):
+    ''' New dict of every field except redacted ones
+        Nested values (e.g. group members) are shared, not copied
+    '''
+    self.load([name for name in self._lazy.keys() if name not in self._redacted])
+    return {key: value for key, value in self.__dict__.items() if key not in self._redacted}
+
+  def replace(self, changes, unset=()):
+    ''' New container of the same type with the given fields changed or removed
+        Lazy fields that aren't touched stay lazy
+    '''
+    fields = {key: value for key, value in self.__dict__.items() if key not in unset}
+    fields.update(changes)
+    lazy = {key: loader for key, loader in self._lazy.items() if key not in changes and key not in unset}
+    return type(self)(fields, lazy=lazy)
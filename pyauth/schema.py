@@ -0,0 +1,162 @@
+''' Index declarations for every pyauth lookup
+    Apply with ensure_indexes at startup or from the command line:
+
+    python -m jots.pyauth.schema --apply
+    python -m jots.pyauth.schema --check
+'''
+import argparse
+import pymongo
+
+from . import mongo
+
+
+class Error(Exception):
+  pass
+
+class SchemaError(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+
+# Collection attribute on the mongo object: list of index definitions
+INDEXES = {
+  "users_collection": [
+    {"keys": [("email", pymongo.ASCENDING)], "unique": True},
+    {"keys": [("userId", pymongo.ASCENDING)], "unique": True},
+    # Only users part way through registration or a reset have a reset code
+    {"keys": [("resetCode", pymongo.ASCENDING), ("status", pymongo.ASCENDING)],
+     "partialFilterExpression": {"resetCode": {"$gt": ""}}}],
+  "groups_collection": [
+    {"keys": [("groupName", pymongo.ASCENDING)], "unique": True},
+    {"keys": [("groupId", pymongo.ASCENDING)], "unique": True}],
+  "apps_collection": [
+    {"keys": [("appName", pymongo.ASCENDING)], "unique": True},
+    {"keys": [("appId", pymongo.ASCENDING)], "unique": True},
+    {"keys": [("key", pymongo.ASCENDING)], "unique": True}],
+  "memberships_collection": [
+    {"keys": [("groupId", pymongo.ASCENDING), ("userId", pymongo.ASCENDING)], "unique": True},
+    {"keys": [("userId", pymongo.ASCENDING), ("groupId", pymongo.ASCENDING)]}],
+  "search_collection": [
+    {"keys": [("kind", pymongo.ASCENDING), ("grams", pymongo.ASCENDING)]},
+    {"keys": [("kind", pymongo.ASCENDING), ("refId", pymongo.ASCENDING)], "unique": True},
+    {"keys": [("kind", pymongo.ASCENDING), ("value", pymongo.ASCENDING)]}]
+}
+
+
+def _index_name(keys):
+  # Same naming as the server default, e.g. groupId_1_userId_1
+  return "_".join("{}_{}".format(field, direction) for field, direction in keys)
+
+
+def ensure_indexes(db=None):
+  ''' Create every declared index, existing indexes are left as they are
+      Returns list of (collection name, index name)
+  '''
+  if db is None:
+    # This assumes host and port have been set in envvars
+    db = mongo.mongo()
+
+  applied = list()
+  for collection_attr, indexes in INDEXES.items():
+    collection = getattr(db, collection_attr)
+    for index in indexes:
+      options = {key: value for key, value in index.items() if key != "keys"}
+      try:
+        collection.create_index(index['keys'], name=_index_name(index['keys']), **options)
+      except pymongo.errors.OperationFailure as err:
+        raise SchemaError("ensure indexes", "{}.{} - {}".format(collection.name, _index_name(index['keys']), err))
+      applied.append((collection.name, _index_name(index['keys'])))
+
+  return applied
+
+
+def missing_indexes(db=None):
+  ''' Returns list of (collection name, index name) declared but not present
+  '''
+  if db is None:
+    # This assumes host and port have been set in envvars
+    db = mongo.mongo()
+
+  missing = list()
+  for collection_attr, indexes in INDEXES.items():
+    collection = getattr(db, collection_attr)
+    present_keys = [list(info['key']) for info in collection.index_information().values()]
+    for index in indexes:
+      if [tuple(key) for key in index['keys']] not in [[tuple(key) for key in keys] for keys in present_keys]:
+        missing.append((collection.name, _index_name(index['keys'])))
+
+  return missing
+
+
+def unused_indexes(db=None):
+  ''' Uses $indexStats to find indexes with no recorded use since the server started
+      Returns list of (collection name, index name), or None if stats are unavailable
+  '''
+  if db is None:
+    # This assumes host and port have been set in envvars
+    db = mongo.mongo()
+
+  unused = list()
+  for collection_attr in INDEXES.keys():
+    collection = getattr(db, collection_attr)
+    try:
+      stats = list(collection.aggregate([{"$indexStats": {}}]))
+    except (pymongo.errors.OperationFailure, NotImplementedError):
+      return None
+
+    for stat in stats:
+      if stat['name'] != "_id_" and stat['accesses']['ops'] == 0:
+        unused.append((collection.name, stat['name']))
+
+  return unused
+
+
+def reindex_search(db=None):
+  ''' Rewrite the search index entry of every user, group and app
+      Run after the n-gram format changes, entries are otherwise only updated on write
+      Returns number of entries written
+  '''
+  if db is None:
+    # This assumes host and port have been set in envvars
+    db = mongo.mongo()
+
+  sources = [("users", db.users_collection, "userId", "email"),
+             ("groups", db.groups_collection, "groupId", "groupName"),
+             ("apps", db.apps_collection, "appId", "appName")]
+
+  written = 0
+  for kind, collection, id_field, name_field in sources:
+    for doc in collection.find({}, {id_field: 1, name_field: 1, "_id": 0}):
+      db.index_search_value(kind, doc[id_field], doc[name_field])
+      written += 1
+
+  return written
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--apply", action="store_true", help="create any missing indexes")
+  parser.add_argument("--check", action="store_true", help="report missing and unused indexes")
+  parser.add_argument("--reindex-search", action="store_true", help="rebuild the substring search index entries")
+  args = parser.parse_args()
+
+  db = mongo.mongo()
+
+  if args.apply:
+    for collection_name, index_name in ensure_indexes(db):
+      print("ensured {}.{}".format(collection_name, index_name))
+
+  if args.reindex_search:
+    print("reindexed {} search entries".format(reindex_search(db)))
+
+  if args.check or not (args.apply or args.reindex_search):
+    for collection_name, index_name in missing_indexes(db):
+      print("missing {}.{}".format(collection_name, index_name))
+
+    unused = unused_indexes(db)
+    if unused is None:
+      print("index usage stats not available")
+    else:
+      for collection_name, index_name in unused:
+        print("unused {}.{}".format(collection_name, index_name))
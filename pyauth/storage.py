@@ -0,0 +1,435 @@
+''' Storage backend interface for pyauth
+    user, group and app only talk to a backend through the methods of
+    backend, so any class implementing them can stand in for mongo.mongo
+
+      mongo.mongo - pymongo, the production backend
+      memory.memory - process local dicts, for tests and local benchmarking
+      async_mongo.async_mongo - Motor, the same methods as coroutines (async_backend)
+
+    Calls made without db use get_backend(), chosen by PYAUTHBACKEND
+'''
+import os
+import abc
+import json
+import base64
+
+STORAGE_BACKEND = os.environ.get("PYAUTHBACKEND", "mongo") # mongo or memory
+BACKENDS = ["mongo", "memory"]
+FIND_PAGE_SIZE = 500 # Default page size for paged and streamed finds
+FIND_MAX_LIMIT = 1000
+SEARCH_MODES = ["contains", "prefix", "substring"]
+
+
+class Error(Exception):
+  pass
+
+class ConnectionError(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+class RecordError(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+class DuplicateAccount(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+class DuplicateGroup(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+class DuplicateApp(Error):
+  def __init__(self, expression, message):
+    self.expression = expression
+    self.message = message
+
+
+def get_backend(name=None):
+  ''' Backend for calls made without db, name defaults to PYAUTHBACKEND
+  '''
+  if name is None:
+    name = STORAGE_BACKEND
+
+  if name == "mongo":
+    from . import mongo
+    # This assumes host and port have been set in envvars
+    return mongo.mongo()
+
+  elif name == "memory":
+    from . import memory
+    return memory.memory()
+
+  raise ConnectionError("new connection", "backend must be one of {}".format(str(BACKENDS)))
+
+
+def get_async_backend(name=None):
+  ''' async_backend for calls made without db, must be called inside a running event loop
+  '''
+  if name is None:
+    name = STORAGE_BACKEND
+
+  if name == "mongo":
+    from . import async_mongo
+    # This assumes host and port have been set in envvars
+    return async_mongo.async_mongo()
+
+  elif name == "memory":
+    from . import memory
+    return memory.async_memory()
+
+  raise ConnectionError("new connection", "backend must be one of {}".format(str(BACKENDS)))
+
+
+def check_search_mode(mode, error, expression):
+  ''' Raises error(expression, message) unless mode is one of SEARCH_MODES
+      error is the caller's input error, e.g. user.InputError
+  '''
+  if mode not in SEARCH_MODES:
+    raise error(expression, "mode must be one of {}".format(str(SEARCH_MODES)))
+
+
+def check_page_limit(limit, error, expression):
+  ''' Raises error(expression, message) unless limit is an int from 1 to FIND_MAX_LIMIT
+  '''
+  if not isinstance(limit, int) or isinstance(limit, bool):
+    raise error(expression, "limit must be int")
+  if limit < 1 or limit > FIND_MAX_LIMIT:
+    raise error(expression, "limit must be between 1 and {}".format(FIND_MAX_LIMIT))
+
+
+def encode_cursor(last_name):
+  ''' Opaque continuation token for paged finds
+  '''
+  return base64.urlsafe_b64encode(json.dumps({"after": last_name}).encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor):
+  try:
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))['after']
+  except (ValueError, KeyError, TypeError, AttributeError):
+    raise RecordError("find", "invalid cursor")
+
+
+def find_page(find_method, name, limit, cursor=None):
+  ''' Runs one page of a find_*_by_* method
+      Returns (list of tuples, next cursor), next cursor is None on the last page
+  '''
+  after = None
+  if cursor is not None:
+    after = decode_cursor(cursor)
+
+  # Fetch one extra result to tell whether another page follows
+  results = find_method(name, limit=limit + 1, after=after)
+  if len(results) > limit:
+    results = results[:limit]
+    return results, encode_cursor(results[-1][1])
+
+  return results, None
+
+
+def iter_find(find_method, name, page_size=FIND_PAGE_SIZE):
+  ''' Yields every match of a find_*_by_* method, holding one page in memory at a time
+  '''
+  after = None
+  while True:
+    results = find_method(name, limit=page_size, after=after)
+    for result in results:
+      yield result
+
+    if len(results) < page_size:
+      return
+    after = results[-1][1]
+
+
+class backend(abc.ABC):
+  ''' Methods every storage backend provides
+      Documents are plain dicts without the mongo _id. Projections follow mongo rules:
+      {field: 0, ...} leaves fields out, {field: 1, ...} returns only those fields
+      Finds return lists of (ID, name) tuples ordered by name
+      All are abstract, a backend missing one fails when constructed
+  '''
+  @abc.abstractmethod
+  def clear_collections(self):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def index_search_value(self, kind, ref_id, value):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def remove_search_value(self, kind, ref_id):
+    raise NotImplementedError
+
+  # Users
+  @abc.abstractmethod
+  def create_user(self, data):
+    ''' Raises DuplicateAccount if the email address is taken
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def update_user(self, user_id, data, unset=None, return_document=True, projection=None):
+    ''' Returns updated document, True if return_document is False, None if no user matched
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_user_by_email(self, email_address, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_user_by_id(self, user_id, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_users_by_ids(self, user_ids, projection=None):
+    ''' Returns dict of user ID to document, unknown IDs are omitted
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_user_by_reset_code(self, reset_code, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def delete_user(self, user_id):
+    ''' Returns True, raises RecordError if no user matched
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def find_users_by_email_address(self, email_address, limit=None, after=None, mode="contains"):
+    raise NotImplementedError
+
+  # Groups
+  @abc.abstractmethod
+  def create_group(self, data):
+    ''' Raises DuplicateGroup if the name is taken
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_group_by_name(self, group_name, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_group_by_id(self, group_id, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def update_group(self, group_id, data, projection=None):
+    ''' A new groupName is copied to the members' groups field
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def find_groups_by_name(self, group_name, limit=None, after=None, mode="contains"):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def delete_group(self, group_id):
+    ''' Also removes memberships, raises RecordError if no group matched
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def add_group_member(self, group_id, user_id, group_name=None):
+    ''' Returns True if added, False if the user was already a member
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def remove_group_member(self, group_id, user_id):
+    ''' Returns True if removed, False if the user was not a member
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def set_group_members(self, group_id, user_ids, group_name=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def set_user_group(self, user_ids, group_id, group_name=None):
+    ''' Record group in each user's groups field, users without the field are left alone
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def unset_user_group(self, user_ids, group_id):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_group_member_ids(self, group_id):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def find_user_groups(self, user_id):
+    raise NotImplementedError
+
+  # Apps
+  @abc.abstractmethod
+  def create_app(self, data):
+    ''' Raises DuplicateApp if the name is taken
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_app_by_id(self, app_id, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_app_by_name(self, app_name, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def get_app_by_key(self, app_key, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def delete_app(self, app_id):
+    ''' Returns True, raises RecordError if no app matched
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def find_apps_by_name(self, app_name, limit=None, after=None, mode="contains"):
+    raise NotImplementedError
+
+
+BACKEND_METHODS = [name for name, value in vars(backend).items() if callable(value) and not name.startswith("_")]
+
+
+class async_backend(abc.ABC):
+  ''' Same methods as backend, each a coroutine
+      For front ends serving many concurrent requests on one event loop
+  '''
+  async def close(self):
+    pass
+
+  @abc.abstractmethod
+  async def clear_collections(self):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def index_search_value(self, kind, ref_id, value):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def remove_search_value(self, kind, ref_id):
+    raise NotImplementedError
+
+  # Users
+  @abc.abstractmethod
+  async def create_user(self, data):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def update_user(self, user_id, data, unset=None, return_document=True, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_user_by_email(self, email_address, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_user_by_id(self, user_id, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_users_by_ids(self, user_ids, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_user_by_reset_code(self, reset_code, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def delete_user(self, user_id):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def find_users_by_email_address(self, email_address, limit=None, after=None, mode="contains"):
+    raise NotImplementedError
+
+  # Groups
+  @abc.abstractmethod
+  async def create_group(self, data):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_group_by_name(self, group_name, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_group_by_id(self, group_id, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def update_group(self, group_id, data, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def find_groups_by_name(self, group_name, limit=None, after=None, mode="contains"):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def delete_group(self, group_id):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def add_group_member(self, group_id, user_id, group_name=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def remove_group_member(self, group_id, user_id):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def set_group_members(self, group_id, user_ids, group_name=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def set_user_group(self, user_ids, group_id, group_name=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def unset_user_group(self, user_ids, group_id):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_group_member_ids(self, group_id):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def find_user_groups(self, user_id):
+    raise NotImplementedError
+
+  # Apps
+  @abc.abstractmethod
+  async def create_app(self, data):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_app_by_id(self, app_id, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_app_by_name(self, app_name, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def get_app_by_key(self, app_key, projection=None):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def delete_app(self, app_id):
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  async def find_apps_by_name(self, app_name, limit=None, after=None, mode="contains"):
+    raise NotImplementedError
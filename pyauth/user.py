@@ -1,12 +1,11 @@
-import bcrypt
 import hashlib
 import uuid
+import functools
 import datetime
-import random
-import string
-import copy
 
-from . import mongo
+from . import storage
+from . import properties
+from . import hashing
 
 
 class Error(Exception):
@@ -38,48 +37,117 @@ class UserNotFound(Error):
     self.message = message
 
 
-class user_properties:
+class user_properties(properties.read_only_properties):
   ''' Readonly container for user properties
   '''
-  def __init__(self, user_doc):
-    for key in user_doc.keys():
-      self.__dict__[key] = user_doc[key]
+  _redacted = ("password",)
+  _read_only_error = UserPropertyError
+  _read_only_message = "user properties are read-only, use update method"
 
-  def __setattr__(self, name, value):
-    raise UserPropertyError("set property", "user properties are read-only, use update method")
 
-  def as_dict(self):
-    attr_as_dict = copy.deepcopy(self.__dict__)
-    if "password" in attr_as_dict:
-      del attr_as_dict['password']
-    return attr_as_dict
+class user_update:
+  ''' Collects field changes for one user and writes them in a single update
+      Use as a context manager, changes are written on exit unless an exception was raised
+
+      with user_obj.batch_update(return_document=False) as changes:
+        changes.set(status="reset")
+        changes.unset("refreshJti")
+  '''
+  def __init__(self, user_obj, return_document=True):
+    self.user_obj = user_obj
+    self.return_document = return_document
+    self.fields = dict()
+    self.unset_fields = list()
+
+  def set(self, **kwargs):
+    for key, value in kwargs.items():
+      _check_user_string(key)
+      _check_user_string(value)
+      if key in self.unset_fields:
+        self.unset_fields.remove(key)
+      self.fields[key] = value
+    return self
+
+  def unset(self, *fields):
+    for field in fields:
+      _check_user_string(field)
+      self.fields.pop(field, None)
+      if field not in self.unset_fields:
+        self.unset_fields.append(field)
+    return self
+
+  def flush(self):
+    ''' Writes pending changes, no-op if there are none
+        Local properties are refreshed from the returned document, or patched
+        with the pending changes when return_document is False
+    '''
+    if not self.fields and not self.unset_fields:
+      return False
+
+    updated_doc = self.user_obj.db.update_user(self.user_obj.properties.userId,
+                                               self.fields,
+                                               unset=self.unset_fields,
+                                               return_document=self.return_document,
+                                               projection=self.user_obj._projection)
+
+    if updated_doc is None:
+      raise UserActionError("update user", "no user document found to update")
+
+    if self.return_document:
+      # Drop Mongo doc ID  before setting properties
+      if "_id" in updated_doc:
+        del updated_doc['_id']
+      self.user_obj.properties = self.user_obj._build_properties(updated_doc, changed=self.fields)
+    else:
+      self.user_obj.properties = self.user_obj.properties.replace(self.fields, unset=self.unset_fields)
+
+    self.fields = dict()
+    self.unset_fields = list()
+    return True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.flush()
+    return False
 
 
 class user:
-  def __init__(self, email_address=None, user_id=None, db=None):
+  # Not fetched until first used when loading lazily
+  LAZY_FIELDS = ("password",)
+
+  def __init__(self, email_address=None, user_id=None, db=None, lazy=True):
     ''' Uses supplied detail (email or ID) to find mongo record
         Dynamically populates class properties with mongo document content
+        lazy leaves the password hash in mongo until it is read
     '''
     if db is None:
-      # This assumes host and port have been set in envvars
-      self.db = mongo.mongo()
+      # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+      self.db = storage.get_backend()
     else:
       self.db = db
 
+    if lazy:
+      self._projection = {field: 0 for field in self.LAZY_FIELDS}
+    else:
+      self._projection = None
+
     if email_address is None and user_id is None:
       raise InputError("get user", "one unique identifier must be provided - email, userid")
 
     if email_address is not None:
       _check_email(email_address)
 
-      user_details = self.db.get_user_by_email(email_address)
+      user_details = self.db.get_user_by_email(email_address, projection=self._projection)
       if user_details is None:
         raise UserNotFound("user", "user not found")
 
     elif user_id is not None:
       _check_user_string(user_id, is_uuid=True)
 
-      user_details = self.db.get_user_by_id(user_id)
+      user_details = self.db.get_user_by_id(user_id, projection=self._projection)
       if user_details is None:
         raise UserNotFound("user", "user not found")
 
@@ -87,30 +155,74 @@ class user:
     if "_id" in user_details:
       del user_details['_id']
 
-    self.properties = user_properties(user_details)
+    self.properties = self._build_properties(user_details)
+
+
+  def _build_properties(self, user_details, changed=()):
+    ''' Wrap a document fetched with self._projection, fields it left out load on first use
+    '''
+    lazy = dict()
+    if self._projection is not None:
+      for field in self.LAZY_FIELDS:
+        if field not in user_details and field not in changed:
+          lazy[field] = functools.partial(self._load_field, user_details['userId'], field)
+    return user_properties(user_details, lazy=lazy)
+
+
+  def _load_field(self, user_id, field):
+    user_doc = self.db.get_user_by_id(user_id, projection={field: 1})
+    if user_doc is None or field not in user_doc:
+      return properties.MISSING
+    return user_doc[field]
 
 
   def authenticate(self, password):
     ''' Compare provided string against bcryted value
-        Return boolean
+        Return boolean, raises hashing.HashingBusy when the hashing pool is saturated
+        Hashes made at a different cost are replaced after a successful check
     '''
     password = password.encode('utf-8')
     try:
-      result = bcrypt.checkpw(password, self.properties.password)
-      return result
-
+      stored_hash = self.properties.password
     except AttributeError:
       # User has not set a password
       return False
 
+    # Locked or mid-reset, nothing to compare against
+    if not hashing.is_usable(stored_hash):
+      return False
+
+    result = hashing.check_password(password, stored_hash)
+
+    if result and hashing.needs_rehash(stored_hash):
+      try:
+        with self.batch_update(return_document=False) as changes:
+          changes.set(password=hashing.hash_password(password))
+      except hashing.Error:
+        # Login still succeeds, the upgrade is retried next time
+        pass
+
+    return result
+
+
+  def get_group_names(self):
+    ''' Names of groups the user belongs to
+        Read from the user's groups field, users created before it existed fall back to a lookup
+    '''
+    user_groups = self.properties.get("groups")
+    if user_groups is None:
+      return [group_name for group_id, group_name in self.db.find_user_groups(self.properties.userId)]
+    return list(user_groups.values())
+
 
   def set_password(self, password):
     password = password.encode('utf-8')
-    password = bcrypt.hashpw(password, bcrypt.gensalt())
-    self.update(password=password,
-                resetCode="",
-                resetExpiry="",
-                status="active")
+    password = hashing.hash_password(password)
+    with self.batch_update(return_document=False) as changes:
+      changes.set(password=password,
+                  resetCode="",
+                  resetExpiry="",
+                  status="active")
 
     return True
 
@@ -130,25 +242,24 @@ class user:
     reset_code_hash.update(date_now_str.encode('utf-8'))
     reset_code = reset_code_hash.hexdigest()
 
-    # Set password to long random string
-    temp_password = "".join([random.choice(string.ascii_letters + string.digits) for n in range(64)]).encode('utf-8')
-    password = bcrypt.hashpw(temp_password, bcrypt.gensalt())
+    with self.batch_update(return_document=False) as changes:
+      # Lock out the old password until the reset completes
+      changes.set(status="reset",
+                  password=hashing.UNUSABLE_PASSWORD,
+                  resetCode=reset_code,
+                  resetExpiry=date_reset_expiry_str)
 
-    self.update(status="reset",
-                password=password,
-                resetCode=reset_code,
-                resetExpiry=date_reset_expiry_str)
-
-    # If user has logged in, clear refresh token JTI to block refreshing access token
-    if "refreshJti" in self.properties.as_dict():
-      self.update(refreshJti="")
+      # If user has logged in, clear refresh token JTI to block refreshing access token
+      if hasattr(self.properties, "refreshJti"):
+        changes.set(refreshJti="")
 
     return reset_code
 
 
   def set_refresh_jti(self, jti):
     _check_user_string(jti)
-    self.update(refreshJti=jti)
+    with self.batch_update(return_document=False) as changes:
+      changes.set(refreshJti=jti)
     return True
 
 
@@ -156,7 +267,8 @@ class user:
     _check_user_string(attribute)
     _check_user_string(value)
 
-    if attribute not in self.properties.as_dict():
+    # Password and groups have their own methods
+    if attribute in ("password", "groups") or not hasattr(self.properties, attribute):
       raise InputError("update attribute", "attribute does not exist")
 
     # Some attributes have proscriptive value requirements, check value is allowed
@@ -165,17 +277,8 @@ class user:
       if value not in defined_values[attribute]:
         raise InputError("update attribute", "{} must be one of {}".format(attribute, str(defined_values[attribute])))
 
-    user_field = {attribute: value}
-
-    updated_doc = self.db.update_user(self.properties.userId, user_field)
-
-    if updated_doc is None:
-      raise UserActionError("update user", "no user document found to update")
-    else:
-      # Drop Mongo doc ID  before setting properties
-      if "_id" in updated_doc:
-        del updated_doc['_id']
-      self.properties = user_properties(updated_doc)
+    with self.batch_update() as changes:
+      changes.set(**{attribute: value})
 
     return True
 
@@ -187,23 +290,17 @@ class user:
     if len(kwargs.items()) < 1:
       raise InputError("update user", "no updates given")
 
-    user_fields = dict()
-    for key, value in kwargs.items():
-      _check_user_string(key)
-      _check_user_string(value)
-      user_fields[key] = value
+    with self.batch_update() as changes:
+      changes.set(**kwargs)
 
-    updated_doc = self.db.update_user(self.properties.userId, user_fields)
+    return True
 
-    if updated_doc is None:
-      raise UserActionError("update user", "no user document found to update")
-    else:
-      # Drop Mongo doc ID  before setting properties
-      if "_id" in updated_doc:
-        del updated_doc['_id']
-      self.properties = user_properties(updated_doc)
 
-    return True
+  def batch_update(self, return_document=True):
+    ''' Returns a user_update, changes made through it are written together
+        return_document=False skips fetching the updated document
+    '''
+    return user_update(self, return_document=return_document)
 
 
 def _check_email(email_address):
@@ -238,8 +335,8 @@ def delete_user(user_id, db=None):
       Returns boolean
   '''
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not user_id:
     raise InputError("user", "user id not given")
@@ -249,7 +346,7 @@ def delete_user(user_id, db=None):
   try:
     result = db.delete_user(user_id)
     return result
-  except mongo.RecordError as err:
+  except storage.RecordError as err:
     raise UserActionError("delete user", err.message)
 
 
@@ -263,8 +360,8 @@ def create_user(service_domain,
       User must set initial password before login will succeed
   '''
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not email_address:
     raise InputError("create user", "email address required")
@@ -294,30 +391,80 @@ def create_user(service_domain,
                  "status": "new",
                  "email": email_address,
                  "resetCode": reset_code,
-                 "resetExpiry": date_reset_expiry_str}
+                 "resetExpiry": date_reset_expiry_str,
+                 # {group ID: group name}, maintained by group membership changes
+                 "groups": dict()}
 
   try:
     doc_id = db.create_user(user_fields)
     return reset_code
 
-  except mongo.DuplicateAccount:
+  except storage.DuplicateAccount:
     raise UserActionError("create user", "user already exists")
 
 
-def find_users_like(email_address, db=None):
+def find_users_like(email_address, db=None, mode="contains"):
   if db is None:
-    # This assumes host and port have been set in envvars
-    db = mongo.mongo()
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
 
   if not email_address:
     raise InputError("find user", "email address required")
 
   _check_email(email_address)
+  storage.check_search_mode(mode, InputError, "find user")
 
-  users = db.find_users_by_email_address(email_address)
+  users = db.find_users_by_email_address(email_address, mode=mode)
 
   user_data = dict()
   for user_id, email in users:
     user_data[email] = user_id
 
   return user_data
+
+
+def find_users_page(email_address, limit=storage.FIND_PAGE_SIZE, cursor=None, db=None, mode="contains"):
+  ''' Returns one page of users like the given address and a cursor for the next
+      Cursor is None once the last page has been returned
+  '''
+  if db is None:
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
+
+  if not email_address:
+    raise InputError("find user", "email address required")
+
+  _check_email(email_address)
+  storage.check_page_limit(limit, InputError, "find user")
+  storage.check_search_mode(mode, InputError, "find user")
+
+  try:
+    users, next_cursor = storage.find_page(functools.partial(db.find_users_by_email_address, mode=mode), email_address, limit, cursor=cursor)
+  except storage.RecordError as err:
+    raise InputError("find user", err.message)
+
+  user_data = dict()
+  for user_id, email in users:
+    user_data[email] = user_id
+
+  return user_data, next_cursor
+
+
+def iter_users_like(email_address, db=None, mode="contains"):
+  ''' Yields (email, user ID) for every match, a page at a time
+  '''
+  if db is None:
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    db = storage.get_backend()
+
+  if not email_address:
+    raise InputError("find user", "email address required")
+
+  _check_email(email_address)
+  storage.check_search_mode(mode, InputError, "find user")
+
+  def generate():
+    for user_id, email in storage.iter_find(functools.partial(db.find_users_by_email_address, mode=mode), email_address):
+      yield email, user_id
+
+  return generate()
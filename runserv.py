@@ -1,15 +1,106 @@
+import os
 import argparse
-from jots.webapp import app
+from jots.webapp import create_app
+
+
+def run_production(app, args, worker_class="gthread"):
+  ''' Pre-fork gunicorn server, workers x threads concurrent requests
+      SIGHUP reloads workers gracefully, SIGTERM drains in-flight requests before exiting
+  '''
+  try:
+    from gunicorn.app.base import BaseApplication
+  except ImportError:
+    raise SystemExit("production mode requires gunicorn - pip install gunicorn")
+
+  from jots.pyauth import mongo, hashing
+
+  def post_fork(server, worker):
+    # Clients, pools and locks from the master process are not usable in a worker
+    mongo.after_fork()
+    hashing.after_fork()
+    # Workers share the CPUs, so each gets a slice of the bcrypt processes
+    hashing.share_workers(args.workers)
+
+  class jots_server(BaseApplication):
+    def __init__(self, application, options):
+      self.application = application
+      self.options = options
+      super().__init__()
+
+    def load_config(self):
+      for key, value in self.options.items():
+        self.cfg.set(key, value)
+
+    def load(self):
+      return self.application
+
+  options = {"bind": "0.0.0.0:{}".format(args.port),
+             "workers": args.workers,
+             "threads": args.threads,
+             "worker_class": worker_class,
+             "keepalive": args.keep_alive,
+             "timeout": args.timeout,
+             "graceful_timeout": args.graceful_timeout,
+             "max_requests": args.max_requests,
+             "max_requests_jitter": args.max_requests // 10,
+             # App and keys load once in the master, workers share the pages
+             "preload_app": True,
+             "post_fork": post_fork,
+             "accesslog": "-"}
+
+  jots_server(app, options).run()
+
+
+def run_asgi(app, args):
+  ''' gunicorn with uvicorn workers, token and identity routes run on each worker's
+      event loop with async storage, everything else goes to the Flask app in threads
+  '''
+  try:
+    import uvicorn.workers
+  except ImportError:
+    raise SystemExit("asgi mode requires uvicorn, a2wsgi and motor - pip install -r requirements.txt")
+
+  from jots.webapp import asgi
+  run_production(asgi.create_asgi_app(app, wsgi_threads=args.threads), args,
+                 worker_class="uvicorn.workers.UvicornWorker")
+
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("-p", "--port", type=int, help="port to bind with flask")
+  parser.add_argument("--ensure-indexes", action="store_true", help="create any missing mongo indexes before serving")
+  parser.add_argument("--server", choices=["dev", "prod", "asgi"], default="dev",
+                      help="dev: flask debug server, prod: gunicorn with pre-forked workers, "
+                           "asgi: prod with async workers, needs uvicorn, a2wsgi and motor from requirements.txt")
+  parser.add_argument("--workers", type=int, default=int(os.environ.get("WEBWORKERS", os.cpu_count() or 1)),
+                      help="prod: worker processes, defaults to CPU count")
+  parser.add_argument("--threads", type=int, default=int(os.environ.get("WEBTHREADS", 4)),
+                      help="prod: threads per worker, asgi: threads per worker for routes served by flask")
+  parser.add_argument("--keep-alive", type=int, default=int(os.environ.get("WEBKEEPALIVE", 5)),
+                      help="prod: seconds to hold idle keep-alive connections")
+  parser.add_argument("--timeout", type=int, default=30, help="prod: seconds before a silent worker is restarted")
+  parser.add_argument("--graceful-timeout", type=int, default=30, help="prod: seconds workers get to finish on reload/stop")
+  parser.add_argument("--max-requests", type=int, default=10000, help="prod: requests before a worker is recycled, 0 disables")
   args = parser.parse_args()
 
+  if args.ensure_indexes:
+    from jots.pyauth import schema
+    schema.ensure_indexes()
+
+  # Settle the bcrypt cost before the first login rather than during it
+  from jots.pyauth import hashing
+  print("bcrypt cost: {}".format(hashing.get_rounds()))
+
   if args.port < 1023:
     raise ValueError("port", "port must be in unprivileged range")
 
-  app.config["SERVER_PORT"] = args.port
-  app.run(host='0.0.0.0',
-          port=args.port,
-          debug=True)
+  app = create_app({"SERVER_PORT": args.port})
+
+  if args.server == "prod":
+    run_production(app, args)
+  elif args.server == "asgi":
+    run_asgi(app, args)
+  else:
+    app.run(host='0.0.0.0',
+            port=args.port,
+            debug=True)
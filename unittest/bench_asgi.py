@@ -0,0 +1,255 @@
+''' Load test for the token and identity routes, WSGI (Flask) against the ASGI front
+    Reports requests/sec and latency percentiles with many concurrent clients
+
+    In process (default): both paths run in this process over the in-memory backend,
+    each storage call delayed by --latency-ms to stand in for a mongod round trip.
+    WSGI requests queue for --threads threads, as in a gthread worker; ASGI requests
+    are coroutines on one event loop. Needs JWT keys in envvars or ./public.key, ./private.key
+
+      python -m jots.unittest.bench_asgi [--connections 1000] [--duration 5] [--latency-ms 2] [--threads 32]
+
+    Against running servers, e.g. runserv.py --server prod and --server asgi on two ports:
+
+      python -m jots.unittest.bench_asgi --url http://localhost:5000/api/ --header "Authorization: Bearer ..."
+'''
+import time
+import base64
+import asyncio
+import argparse
+import concurrent.futures
+from urllib.parse import urlparse
+
+from werkzeug.test import EnvironBuilder
+
+
+class _slow(object):
+  ''' Delays every storage call on a sync backend
+  '''
+  def __init__(self, backend, delay):
+    self.backend = backend
+    self.delay = delay
+
+  def __getattr__(self, name):
+    method = getattr(self.backend, name)
+    def call(*args, **kwargs):
+      time.sleep(self.delay)
+      return method(*args, **kwargs)
+    return call
+
+
+class _async_slow(_slow):
+  ''' Delays every storage call on an async backend without blocking the loop
+  '''
+  def __getattr__(self, name):
+    method = getattr(self.backend, name)
+    async def call(*args, **kwargs):
+      await asyncio.sleep(self.delay)
+      return await method(*args, **kwargs)
+    return call
+
+
+def _report(name, latencies, elapsed, errors):
+  latencies = sorted(latencies)
+  if not latencies:
+    print("{:<28} no responses, {} errors".format(name, errors))
+    return
+  p50 = latencies[len(latencies) // 2] * 1000
+  p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000
+  print("{:<28} {:>10} {:>10.0f} {:>10.1f} {:>10.1f} {:>8}".format(
+        name, len(latencies), len(latencies) / elapsed, p50, p99, errors))
+
+
+async def _drive(request, connections, duration):
+  ''' connections clients each sending requests back to back until duration ends
+      Returns (latencies, elapsed, errors)
+  '''
+  latencies = list()
+  errors = [0]
+  deadline = time.perf_counter() + duration
+
+  async def client():
+    while time.perf_counter() < deadline:
+      start = time.perf_counter()
+      try:
+        status = await request()
+      except Exception:
+        status = None
+      if status is None or status >= 400:
+        errors[0] += 1
+      else:
+        latencies.append(time.perf_counter() - start)
+
+  start = time.perf_counter()
+  await asyncio.gather(*[client() for n in range(connections)])
+  return latencies, time.perf_counter() - start, errors[0]
+
+
+def _wsgi_request(flask_app, pool, path, headers):
+  def call():
+    environ = EnvironBuilder(path=path, headers=headers).get_environ()
+    status = dict()
+
+    def start_response(status_line, response_headers, exc_info=None):
+      status['code'] = int(status_line.split(" ", 1)[0])
+
+    result = flask_app(environ, start_response)
+    try:
+      b"".join(result)
+    finally:
+      if hasattr(result, "close"):
+        result.close()
+    return status['code']
+
+  async def request():
+    return await asyncio.get_running_loop().run_in_executor(pool, call)
+  return request
+
+
+def _asgi_request(asgi_app, path, headers):
+  scope = {"type": "http", "method": "GET", "path": path, "root_path": "", "query_string": b"",
+           "http_version": "1.1", "scheme": "http", "server": ("bench.localhost", 80),
+           "client": ("127.0.0.1", 50000),
+           "headers": [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]}
+
+  async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+  async def request():
+    status = dict()
+    async def send(message):
+      if message['type'] == "http.response.start":
+        status['code'] = message['status']
+    await asgi_app(scope, receive, send)
+    return status['code']
+  return request
+
+
+def run_in_process(args):
+  # Nothing here sends mail, but create_app needs somewhere it could go
+  os.environ.setdefault("MAILQUEUESYNC", "1")
+  import jots.webapp
+  from jots.webapp import asgi
+  from jots.pyauth import memory, user, app, group
+
+  delay = args.latency_ms / 1000
+  db = memory.memory("bench")
+  flask_app = jots.webapp.create_app({"TESTING": True,
+                                      "TEST_DB": _slow(db, delay),
+                                      "TEST_ASYNC_DB": _async_slow(memory.async_memory("bench"), delay)})
+  asgi_app = asgi.create_asgi_app(flask_app)
+
+  user.create_user("bench.localhost", "bench@bench.local", db=db)
+  user_id = user.user(email_address="bench@bench.local", db=db).properties.userId
+  group.create_group("admin", group_members=[user_id], db=db)
+  app_id, app_key, app_secret = app.create_app("benchapp", db=db)
+  with flask_app.app_context():
+    from flask_jwt_extended import create_access_token
+    access_token = create_access_token("bench@bench.local", expires_delta=False)
+
+  bearer = {"Authorization": "Bearer {}".format(access_token)}
+  basic = {"Authorization": "Basic {}".format(base64.b64encode("{}:{}".format(app_key, app_secret).encode('utf-8')).decode('utf-8'))}
+  routes = [("/api/", bearer),
+            ("/api/v1/users/{}/details".format(user_id), bearer),
+            ("/token/new", basic)]
+
+  print("{} connections, {}s per run, {}ms per storage call, {} WSGI threads".format(
+        args.connections, args.duration, args.latency_ms, args.threads))
+  print("{:<28} {:>10} {:>10} {:>10} {:>10} {:>8}".format("route", "requests", "req/s", "p50 ms", "p99 ms", "errors"))
+
+  pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.threads)
+  try:
+    for path, headers in routes:
+      label = path if len(path) < 20 else path[:17] + "..."
+      _report("wsgi " + label, *asyncio.run(_drive(_wsgi_request(flask_app, pool, path, headers), args.connections, args.duration)))
+      _report("asgi " + label, *asyncio.run(_drive(_asgi_request(asgi_app, path, headers), args.connections, args.duration)))
+  finally:
+    pool.shutdown()
+    db.clear_collections()
+
+
+def _http_request(url, headers):
+  ''' One keep-alive HTTP/1.1 connection per client, responses must carry Content-Length
+  '''
+  parsed = urlparse(url)
+  path = parsed.path or "/"
+  if parsed.query:
+    path = "{}?{}".format(path, parsed.query)
+  lines = ["GET {} HTTP/1.1".format(path), "Host: {}".format(parsed.netloc)]
+  lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+  payload = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+  async def connect():
+    return await asyncio.open_connection(parsed.hostname, parsed.port or 80)
+
+  def request_factory():
+    connection = dict()
+
+    async def request():
+      if "writer" not in connection:
+        connection['reader'], connection['writer'] = await connect()
+      reader, writer = connection['reader'], connection['writer']
+      try:
+        writer.write(payload)
+        head = await reader.readuntil(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        length = 0
+        for line in head.split(b"\r\n")[1:]:
+          if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+        await reader.readexactly(length)
+        return status
+      except Exception:
+        writer.close()
+        connection.clear()
+        raise
+
+    return request
+  return request_factory
+
+
+async def _drive_url(request_factory, connections, duration):
+  # Each client keeps its own connection
+  requests = [request_factory() for n in range(connections)]
+  latencies = list()
+  errors = [0]
+  deadline = time.perf_counter() + duration
+
+  async def client(request):
+    while time.perf_counter() < deadline:
+      start = time.perf_counter()
+      try:
+        status = await request()
+      except Exception:
+        status = None
+      if status is None or status >= 400:
+        errors[0] += 1
+      else:
+        latencies.append(time.perf_counter() - start)
+
+  start = time.perf_counter()
+  await asyncio.gather(*[client(request) for request in requests])
+  return latencies, time.perf_counter() - start, errors[0]
+
+
+def run_url(args):
+  headers = dict(header.split(": ", 1) for header in args.header)
+  print("{} connections, {}s".format(args.connections, args.duration))
+  print("{:<28} {:>10} {:>10} {:>10} {:>10} {:>8}".format("url", "requests", "req/s", "p50 ms", "p99 ms", "errors"))
+  for url in args.url:
+    _report(url[-28:], *asyncio.run(_drive_url(_http_request(url, headers), args.connections, args.duration)))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--connections", type=int, default=1000)
+  parser.add_argument("--duration", type=float, default=5)
+  parser.add_argument("--latency-ms", type=float, default=2, help="in process: delay added to each storage call")
+  parser.add_argument("--threads", type=int, default=32, help="in process: threads serving WSGI requests")
+  parser.add_argument("--url", action="append", help="load test running servers instead, repeat to compare")
+  parser.add_argument("--header", action="append", default=list(), help="'Name: value' sent with each --url request")
+  args = parser.parse_args()
+
+  if args.url:
+    run_url(args)
+  else:
+    run_in_process(args)
@@ -0,0 +1,82 @@
+''' Benchmark group.get_members_detail for 10, 1k and 50k member groups
+    Compares the per-member lookup with the batched $in lookup
+    Runs against mongomock, or a real mongod if MONGOHOST is set
+    mongomock scans the collection for each $in value, use a real mongod for 50k
+
+    python -m jots.unittest.bench_group_members [--sizes 10 1000 50000]
+'''
+import os
+import argparse
+import time
+import uuid
+
+import mongomock
+
+from jots.pyauth import mongo, group
+
+
+def _populate(db, size):
+  user_ids = [str(uuid.uuid4()) for n in range(size)]
+  db.users_collection.insert_many([{"userId": user_id,
+                                    "email": "{}@bench.local".format(user_id),
+                                    "status": "active"} for user_id in user_ids])
+  group_id = group.create_group("bench{}".format(uuid.uuid4().hex), db=db).popitem()[1]
+  db.memberships_collection.insert_many([{"groupId": group_id, "userId": user_id} for user_id in user_ids])
+  return group.group(group_id=group_id, db=db)
+
+
+def _cleanup(group_obj):
+  ''' Only remove benchmark documents, never clear collections on a real server
+  '''
+  group_obj.db.users_collection.delete_many({"userId": {"$in": group_obj.properties.members}})
+  group_obj.db.delete_group(group_obj.properties.groupId)
+
+
+def _per_member(group_obj):
+  ''' Previous implementation, one query per member
+  '''
+  user_details = dict()
+  for user_id in group_obj.properties.members:
+    user_doc = group_obj.db.get_user_by_id(user_id)
+    user_details[user_id] = user_doc['email'] if user_doc is not None else str()
+  return user_details
+
+
+def _time(func, repeat):
+  timings = list()
+  for n in range(repeat):
+    start = time.perf_counter()
+    func()
+    timings.append(time.perf_counter() - start)
+  return min(timings) * 1000
+
+
+def run(db, sizes, old_limit, repeat):
+  print("{:>8} {:>14} {:>14}".format("members", "per-member ms", "batched ms"))
+  for size in sizes:
+    group_obj = _populate(db, size)
+
+    batched = _time(lambda: group_obj.get_members_detail(attribute="email"), repeat)
+    if size <= old_limit:
+      per_member = "{:14.2f}".format(_time(lambda: _per_member(group_obj), repeat))
+    else:
+      per_member = "{:>14}".format("skipped")
+
+    print("{:>8} {} {:14.2f}".format(size, per_member, batched))
+    _cleanup(group_obj)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 50000])
+  parser.add_argument("--old-limit", type=int, default=1000, help="largest group to time with per-member lookups")
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+
+  if os.environ.get("MONGOHOST"):
+    print("mongod: {}".format(os.environ.get("MONGOHOST")))
+    run(mongo.mongo(), args.sizes, args.old_limit, args.repeat)
+  else:
+    print("mongomock")
+    with mongomock.patch(servers=(('bench.localhost', 27017),)):
+      run(mongo.mongo(mongo_host='bench.localhost', mongo_port=27017), args.sizes, args.old_limit, args.repeat)
@@ -0,0 +1,70 @@
+''' Micro-benchmark for single document lookups in pyauth.mongo
+    Compares list(find()) with the bounded limit(2) lookup used by the get_*_by_* methods
+    Runs against mongomock, and also a real mongod if MONGOHOST is set
+
+    python -m jots.unittest.bench_mongo_lookup [--users 10000] [--lookups 1000]
+'''
+import os
+import argparse
+import random
+import time
+import uuid
+
+import mongomock
+
+from jots.pyauth import mongo
+
+
+def _unbounded(db, user_id):
+  ''' Previous implementation
+  '''
+  documents = list(db.users_collection.find({"userId": user_id}))
+  if len(documents) > 1:
+    raise mongo.RecordError("get user", "to many records returned")
+  elif len(documents) == 0:
+    return None
+  return documents[0]
+
+
+def _time(func, user_ids):
+  start = time.perf_counter()
+  for user_id in user_ids:
+    func(user_id)
+  return (time.perf_counter() - start) / len(user_ids) * 1000000
+
+
+def run(db, user_count, lookup_count):
+  user_ids = [str(uuid.uuid4()) for n in range(user_count)]
+  db.users_collection.insert_many([{"userId": user_id,
+                                    "email": "{}@bench.local".format(user_id),
+                                    "password": os.urandom(60),
+                                    "status": "active"} for user_id in user_ids])
+
+  try:
+    sample = random.sample(user_ids, min(lookup_count, user_count))
+    unbounded = _time(lambda user_id: _unbounded(db, user_id), sample)
+    bounded = _time(db.get_user_by_id, sample)
+    print("{:>10} {:>16.1f} {:>16.1f}".format(user_count, unbounded, bounded))
+  finally:
+    # Only remove benchmark documents, never clear collections on a real server
+    db.users_collection.delete_many({"userId": {"$in": user_ids}})
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--users", type=int, default=10000)
+  parser.add_argument("--lookups", type=int, default=1000)
+  args = parser.parse_args()
+
+  header = "{:>10} {:>16} {:>16}".format("users", "list(find) us", "limit(2) us")
+
+  print("mongomock")
+  print(header)
+  with mongomock.patch(servers=(('bench.localhost', 27017),)):
+    run(mongo.mongo(mongo_host='bench.localhost', mongo_port=27017), args.users, args.lookups)
+  mongo.close_clients()
+
+  if os.environ.get("MONGOHOST"):
+    print("mongod: {}".format(os.environ.get("MONGOHOST")))
+    print(header)
+    run(mongo.mongo(), args.users, args.lookups)
@@ -0,0 +1,78 @@
+''' Benchmark property containers for a 100k member group
+    Compares the previous __dict__ container, whose as_dict deep copied every field,
+    with the container now used by user, group and app
+
+    python -m jots.unittest.bench_properties [--members 100000] [--repeat 20]
+'''
+import argparse
+import copy
+import time
+import tracemalloc
+import uuid
+
+from jots.pyauth import group
+
+
+class _dict_properties:
+  ''' Previous implementation
+  '''
+  def __init__(self, group_doc):
+    for key in group_doc.keys():
+      self.__dict__[key] = group_doc[key]
+
+  def as_dict(self):
+    attr_as_dict = copy.deepcopy(self.__dict__)
+    if "password" in attr_as_dict:
+      del attr_as_dict['password']
+    return attr_as_dict
+
+
+def _time(func, repeat):
+  timings = list()
+  for n in range(repeat):
+    start = time.perf_counter()
+    func()
+    timings.append(time.perf_counter() - start)
+  return min(timings) * 1000
+
+
+def _memory(func):
+  ''' Peak bytes allocated while func runs, the member list itself is already allocated
+  '''
+  tracemalloc.start()
+  result = func()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return peak
+
+
+def run(member_count, repeat):
+  group_doc = {"groupId": str(uuid.uuid4()),
+               "groupName": "bench",
+               "url": "https://bench.local",
+               "members": [str(uuid.uuid4()) for n in range(member_count)]}
+
+  containers = [("__dict__ + deepcopy", _dict_properties), ("read_only_properties", group.group_properties)]
+
+  print("{:>22} {:>12} {:>12} {:>14} {:>14}".format("container", "build us", "as_dict ms", "as_dict KiB", "attr read ns"))
+  for name, container in containers:
+    properties = container(group_doc)
+    build = _time(lambda: container(group_doc), repeat) * 1000
+    as_dict = _time(properties.as_dict, repeat)
+    as_dict_memory = _memory(properties.as_dict) / 1024
+
+    start = time.perf_counter()
+    for n in range(100000):
+      properties.groupName
+    attr_read = (time.perf_counter() - start) / 100000 * 1000000000
+
+    print("{:>22} {:>12.1f} {:>12.2f} {:>14.1f} {:>14.1f}".format(name, build, as_dict, as_dict_memory, attr_read))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--members", type=int, default=100000)
+  parser.add_argument("--repeat", type=int, default=20)
+  args = parser.parse_args()
+
+  run(args.members, args.repeat)
@@ -0,0 +1,66 @@
+''' Micro-benchmark for the storage backends
+    Times the lookups made on every authenticated request against mongomock
+    and the in-memory backend, and a real mongod if MONGOHOST is set
+
+    python -m jots.unittest.bench_storage [--users 10000] [--lookups 1000]
+'''
+import os
+import argparse
+import random
+import time
+import uuid
+
+import mongomock
+
+from jots.pyauth import mongo, memory
+
+
+def _time(func, values):
+  start = time.perf_counter()
+  for value in values:
+    func(value)
+  return (time.perf_counter() - start) / len(values) * 1000000
+
+
+def run(name, db, user_count, lookup_count):
+  user_ids = [str(uuid.uuid4()) for n in range(user_count)]
+  group_id = str(uuid.uuid4())
+  db.create_group({"groupId": group_id, "groupName": "bench-{}".format(group_id)})
+  for user_id in user_ids:
+    db.create_user({"userId": user_id,
+                    "email": "{}@bench.local".format(user_id),
+                    "password": os.urandom(60),
+                    "status": "active",
+                    "groups": dict()})
+  for user_id in user_ids[:100]:
+    db.add_group_member(group_id, user_id)
+
+  try:
+    sample = random.sample(user_ids, min(lookup_count, user_count))
+    by_id = _time(db.get_user_by_id, sample)
+    by_email = _time(db.get_user_by_email, ["{}@bench.local".format(user_id) for user_id in sample])
+    groups = _time(db.find_user_groups, sample)
+    print("{:>10} {:>10} {:>14.1f} {:>14.1f} {:>14.1f}".format(name, user_count, by_id, by_email, groups))
+  finally:
+    # Only remove benchmark documents, never clear collections on a real server
+    db.delete_group(group_id)
+    for user_id in user_ids:
+      db.delete_user(user_id)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--users", type=int, default=10000)
+  parser.add_argument("--lookups", type=int, default=1000)
+  args = parser.parse_args()
+
+  print("{:>10} {:>10} {:>14} {:>14} {:>14}".format("backend", "users", "by id us", "by email us", "groups us"))
+
+  with mongomock.patch(servers=(('bench.localhost', 27017),)):
+    run("mongomock", mongo.mongo(mongo_host='bench.localhost', mongo_port=27017), args.users, args.lookups)
+  mongo.close_clients()
+
+  run("memory", memory.memory("bench"), args.users, args.lookups)
+
+  if os.environ.get("MONGOHOST"):
+    run("mongod", mongo.mongo(), args.users, args.lookups)
@@ -1,3 +1,5 @@
+import os
+
 import pytest
 import mongomock
 
@@ -5,10 +7,16 @@ from flask_jwt_extended import (create_refresh_token, create_access_token)
 
 from jots.pyauth import mongo, user, group, app
 
+# Endpoints send their mail through the outbox, inline so tests can see it
+os.environ['MAILQUEUESYNC'] = "1"
+
 
 @pytest.fixture(scope="function")
 @mongomock.patch(servers=(('dev.localhost', 27017),))
 def mongo_object():
+  # Pooled clients outlive the mock, start each test with a fresh one
+  mongo.close_clients()
+  group.clear_member_cache()
   db = mongo.mongo(mongo_host='dev.localhost', mongo_port=27017)
 
   def fin():
@@ -107,13 +115,11 @@ def client(mongo_object, monkeypatch):
 
   import jots.webapp
 
-  with jots.webapp.app.test_client() as client:
-    jots.webapp.app.config['TESTING'] = True
-    jots.webapp.app.config['TEST_DB'] = mongo_object
-
-    jots.webapp.app.config['DOMAIN_NAME'] = "dev.localhost"
-    jots.webapp.app.config['JWT_SECRET_KEY'] = "password"
-    jots.webapp.app.config['JWT_COOKIE_DOMAIN'] = "dev.localhost"
+  test_app = jots.webapp.create_app({"TESTING": True,
+                                     "TEST_DB": mongo_object,
+                                     "DOMAIN_NAME": "dev.localhost",
+                                     "JWT_SECRET_KEY": "password",
+                                     "JWT_COOKIE_DOMAIN": "dev.localhost"})
 
+  with test_app.test_client() as client:
     yield client
-
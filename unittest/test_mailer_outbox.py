@@ -0,0 +1,114 @@
+import time
+import pytest
+
+from jots.mailer import send, outbox
+
+
+@pytest.fixture
+def email_obj():
+  return send.personalised_email(recipient="test@dev.local",
+                                 template_name="reset",
+                                 data={"site_name": "dev.local",
+                                       "reset_url": "https://dev.local/reset?q=theresetcode"})
+
+
+def test_mail_queue(tmp_path, email_obj):
+  ''' Test outbox delivery
+      1) Queued message is sent by drain and removed
+      2) Failed send is retried later with backoff, then marked failed
+      3) Only personalised emails can be queued
+  '''
+  mail_queue = outbox.mail_queue(path=str(tmp_path / "outbox.db"), workers=0, max_attempts=2, retry_base=0.05)
+
+  #1
+  mail_queue.enqueue(email_obj, mail_agent="string")
+  assert mail_queue.stats() == {"pending": 1}
+  assert mail_queue.drain() == 1
+  assert mail_queue.stats() == dict()
+
+  #2
+  mail_queue.enqueue(email_obj, mail_agent="notanagent")
+  assert mail_queue.drain() == 1
+  assert mail_queue.stats() == {"pending": 1}
+  assert mail_queue.drain() == 0
+  time.sleep(0.1)
+  assert mail_queue.drain() == 1
+  assert mail_queue.stats() == {"failed": 1}
+
+  #3
+  with pytest.raises(outbox.QueueError):
+    mail_queue.enqueue("not an email")
+
+
+def test_mail_queue_workers(tmp_path, email_obj):
+  ''' Test background workers drain the outbox
+  '''
+  mail_queue = outbox.mail_queue(path=str(tmp_path / "outbox.db"), workers=2, poll_interval=0.05)
+  mail_queue.start()
+  try:
+    for n in range(5):
+      mail_queue.enqueue(email_obj, mail_agent="string")
+
+    deadline = time.time() + 5
+    while mail_queue.stats() and time.time() < deadline:
+      time.sleep(0.05)
+    assert mail_queue.stats() == dict()
+  finally:
+    mail_queue.stop()
+
+
+def test_mail_queue_errors(tmp_path, email_obj, caplog, monkeypatch):
+  ''' Test outbox failures are reported, not swallowed
+      1) No outbox path is refused rather than defaulting to the working directory
+      2) The startup check fails without an outbox or MAILQUEUESYNC, as does the app factory
+      3) A worker logs an unexpected error and keeps sending
+  '''
+  #1
+  monkeypatch.setattr(outbox, "MAIL_QUEUE_PATH", None)
+  with pytest.raises(outbox.QueueError):
+    outbox.mail_queue()
+
+  #2
+  monkeypatch.setattr(outbox, "MAIL_QUEUE_SYNC", False)
+  with pytest.raises(outbox.QueueError):
+    outbox.check()
+
+  import jots.webapp
+  with pytest.raises(outbox.QueueError):
+    jots.webapp.create_app({"JWT_PUBLIC_KEY": "public", "JWT_PRIVATE_KEY": "private"})
+
+  monkeypatch.setattr(outbox, "MAIL_QUEUE_PATH", str(tmp_path / "missing" / "outbox.db"))
+  with pytest.raises(outbox.QueueError):
+    outbox.check()
+
+  monkeypatch.setattr(outbox, "MAIL_QUEUE_PATH", str(tmp_path / "outbox.db"))
+  outbox.check()
+
+  monkeypatch.setattr(outbox, "MAIL_QUEUE_SYNC", True)
+  monkeypatch.setattr(outbox, "MAIL_QUEUE_PATH", None)
+  outbox.check()
+
+  #3
+  mail_queue = outbox.mail_queue(path=str(tmp_path / "outbox.db"), workers=1, poll_interval=0.05)
+  process_one = mail_queue.process_one
+  calls = list()
+
+  def fail_once():
+    calls.append(1)
+    if len(calls) == 1:
+      raise RuntimeError("outbox broke")
+    return process_one()
+  mail_queue.process_one = fail_once
+
+  mail_queue.enqueue(email_obj, mail_agent="string")
+  mail_queue.start()
+  try:
+    deadline = time.time() + 5
+    while mail_queue.stats() and time.time() < deadline:
+      time.sleep(0.05)
+    assert mail_queue.stats() == dict()
+  finally:
+    mail_queue.stop()
+
+  assert "mail outbox worker error" in caplog.text
+  assert "outbox broke" in caplog.text
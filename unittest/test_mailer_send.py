@@ -1,7 +1,16 @@
+import json
+import multiprocessing
+
 import pytest
 
 from jots.mailer import send
 
+
+def _spool_writes(directory, max_bytes):
+  spool = send.to_file.spool_writer(directory=directory, max_bytes=max_bytes)
+  for n in range(50):
+    spool.write_batch([("a@dev.local", "x" * 100), ("b@dev.local", "x" * 100)])
+
 @pytest.fixture
 def user_data():
   data = {"email_address": "test@dev.local",
@@ -21,3 +30,72 @@ def test_mailer(user_data):
   assert "theresetcode" in result
   assert user_data['data']['site_name'] in result
 
+
+
+def test_mailer_template_cache(user_data, tmp_path):
+  ''' Test templates are compiled once and shared
+      1) Emails for the same template directory share one environment and template
+      2) Missing template files are rejected
+  '''
+  #1
+  first = send.personalised_email(recipient=user_data['email_address'], template_name=user_data['template'], data=user_data['data'])
+  second = send.personalised_email(recipient="other@dev.local", template_name=user_data['template'], data=user_data['data'])
+  assert "theresetcode" in first.send(mail_agent="string")
+  assert send.get_environment(first.template_path) is send.get_environment(second.template_path)
+  assert send.get_template(first.template_path, first.template_filename) is send.get_template(second.template_path, second.template_filename)
+
+  #2
+  with pytest.raises(send.InputError):
+    send.personalised_email(recipient=user_data['email_address'], template_name=user_data['template'],
+                            data=user_data['data'], template_path=str(tmp_path))
+
+
+def test_mailer_send_batch(user_data, tmp_path, monkeypatch):
+  ''' Test batch sending
+      1) Every message gets a result in input order, bad recipients are reported not raised
+      2) Batches run concurrently and give the same results
+      3) File agent appends to one spool file and rotates it when full
+      4) Unknown agent is rejected
+  '''
+  messages = [("user{}@dev.local".format(n), {"site_name": "dev.local", "reset_url": "https://dev.local/reset?q=code{}".format(n)})
+              for n in range(25)]
+  messages.insert(3, ("notanemail", user_data['data']))
+
+  #1
+  results = send.send_batch("reset", messages, mail_agent="string", batch_size=10)
+  assert [result['recipient'] for result in results] == [recipient for recipient, data in messages]
+  assert results[3]['sent'] is False and results[3]['error']
+  assert results[4]['sent'] is True and "code3" in results[4]['result']
+
+  #2
+  assert send.send_batch("reset", messages, mail_agent="string", batch_size=4, concurrency=4) == results
+
+  #3
+  spool = send.to_file.spool_writer(directory=str(tmp_path), max_bytes=10 ** 9)
+  monkeypatch.setitem(send.BATCH_AGENTS, "file", spool.write_batch)
+  results = send.send_batch("reset", messages[:10], mail_agent="file", batch_size=3)
+  assert all(result['sent'] for result in results if result['recipient'] != "notanemail")
+  with open(spool.path) as spool_file:
+    assert len(spool_file.readlines()) == 9
+
+  spool.max_bytes = 1
+  send.send_batch("reset", messages[:2], mail_agent="file")
+  assert len(list(tmp_path.glob("mail_spool_*.ndjson"))) == 1
+
+  # Writers in other processes share the spool, no line is lost or split across a rotation
+  spool.max_bytes = 2000
+  for spool_file in tmp_path.glob("mail_spool*.ndjson"):
+    spool_file.unlink()
+  writers = [multiprocessing.get_context("fork").Process(target=_spool_writes, args=(str(tmp_path), spool.max_bytes))
+             for n in range(4)]
+  for writer in writers:
+    writer.start()
+  for writer in writers:
+    writer.join()
+  lines = [line for spool_file in tmp_path.glob("mail_spool*.ndjson") for line in spool_file.read_text().splitlines()]
+  assert len(lines) == 4 * 50 * 2
+  assert all(json.loads(line)['body'] == "x" * 100 for line in lines)
+
+  #4
+  with pytest.raises(send.MailActionError):
+    send.send_batch("reset", messages, mail_agent="notanagent")
@@ -50,3 +50,62 @@ def test_app_operations(mongo_object, app_data):
   del_result = app.delete_app(app_object_by_id.properties.appId,
                               db=mongo_object)
   assert del_result
+
+
+def test_app_find_paging(mongo_object, app_data):
+  ''' Test paged and streamed search
+      1) Pages are ordered by name and chained by cursor until exhausted
+      2) Streaming yields every match
+      3) Bad limit and cursor are rejected
+  '''
+  app_names = ["{}{}".format(app_data['app_name'], n) for n in range(5)]
+  for app_name in app_names:
+    app.create_app(name=app_name, db=mongo_object)
+
+  #1
+  found_names = list()
+  page, cursor = app.find_apps_page(app_data['app_name'], limit=2, db=mongo_object)
+  found_names.extend(page.keys())
+  while cursor is not None:
+    page, cursor = app.find_apps_page(app_data['app_name'], limit=2, cursor=cursor, db=mongo_object)
+    found_names.extend(page.keys())
+  assert found_names == app_names
+
+  #2
+  streamed = list(app.iter_apps_like(app_data['app_name'], db=mongo_object))
+  assert [name for name, app_id in streamed] == app_names
+
+  #3
+  with pytest.raises(app.InputError):
+    app.find_apps_page(app_data['app_name'], limit=0, db=mongo_object)
+  with pytest.raises(app.InputError):
+    app.find_apps_page(app_data['app_name'], limit=2, cursor="notacursor", db=mongo_object)
+
+
+def test_app_credential_cache(mongo_object, app_data):
+  ''' Test verified secret cache
+      1) First authentication misses, repeat is a hit
+      2) Wrong secret is rejected and does not replace the cached entry
+      3) Invalidation forces a full check
+  '''
+  app_id, app_key, app_secret = app.create_app(name=app_data['app_name'], db=mongo_object)
+  app_object = app.app(app_key=app_key, db=mongo_object)
+  app.invalidate_credentials()
+
+  #1
+  start_stats = app.credential_cache_stats()
+  assert app_object.authenticate(app_secret)
+  assert app_object.authenticate(app_secret)
+  stats = app.credential_cache_stats()
+  assert stats['misses'] - start_stats['misses'] == 1
+  assert stats['hits'] - start_stats['hits'] == 1
+
+  #2
+  assert not app_object.authenticate("notthesecret")
+  assert app_object.authenticate(app_secret)
+  assert app.credential_cache_stats()['hits'] - start_stats['hits'] == 2
+
+  #3
+  app.invalidate_credentials(app_id)
+  assert app_object.authenticate(app_secret)
+  assert app.credential_cache_stats()['misses'] - start_stats['misses'] == 3
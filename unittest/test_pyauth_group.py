@@ -80,3 +80,160 @@ def test_group_management(mongo_object, example_user, group_data):
   assert isinstance(search_result, dict)
   assert search_result[group_data['groupname']] == group_object_by_name.properties.groupId
 
+
+
+def test_group_member_cache(mongo_object, example_user, registered_user, example_group):
+  ''' Test cached membership check
+      1) Member is found, second lookup is served from cache
+      2) Non-member is not found
+      3) Adding a member invalidates the cached set
+      4) Removing a member invalidates the cached set
+      5) Unknown group raises GroupNotFound
+      6) A load overtaken by a change to the group is not cached
+  '''
+  group.clear_member_cache()
+
+  #1
+  assert group.user_in_group(example_user.properties.userId, "admin", db=mongo_object)
+  assert group.user_in_group(example_user.properties.userId, "admin", db=mongo_object)
+  stats = group.member_cache_stats()
+  assert stats['misses'] == 1
+  assert stats['hits'] == 1
+
+  #2
+  assert not group.user_in_group(registered_user.properties.userId, "admin", db=mongo_object)
+
+  #3
+  example_group.add_member(user_id=registered_user.properties.userId)
+  assert group.user_in_group(registered_user.properties.userId, "admin", db=mongo_object)
+
+  #4
+  example_group.remove_member(user_id=registered_user.properties.userId)
+  assert not group.user_in_group(registered_user.properties.userId, "admin", db=mongo_object)
+  assert group.member_cache_stats()['misses'] == 3
+
+  #5
+  with pytest.raises(group.GroupNotFound):
+    group.user_in_group(example_user.properties.userId, "notagroup", db=mongo_object)
+
+  #6
+  cache = group.member_cache(ttl=60)
+  def load_then_change():
+    cache.invalidate("race")
+    return ["stale"]
+
+  assert cache.get("race", load_then_change) == frozenset(["stale"])
+  assert cache.get("race", lambda: ["fresh"]) == frozenset(["fresh"])
+  assert cache.get("race", lambda: ["unused"]) == frozenset(["fresh"])
+
+  def load_then_clear():
+    cache.invalidate()
+    return ["stale"]
+
+  cache.get("other", load_then_clear)
+  assert cache.get("other", lambda: ["fresh"]) == frozenset(["fresh"])
+
+
+def test_group_memberships(mongo_object, example_user, registered_user, group_data):
+  ''' Test membership collection behaviour
+      1) Members given at creation are stored as membership documents
+      2) Adding an existing member is rejected, membership is not duplicated
+      3) Replacing the member list via update
+      4) Deleting the group removes its memberships
+  '''
+  #1
+  new_group_data = group.create_group(group_name=group_data['groupname'],
+                                      group_members=[example_user.properties.userId],
+                                      db=mongo_object)
+  group_id = new_group_data[group_data['groupname']]
+  assert mongo_object.get_group_member_ids(group_id) == [example_user.properties.userId]
+  assert "members" not in mongo_object.get_group_by_id(group_id)
+  assert group_data['groupname'] in group.find_user_in_group(example_user.properties.userId, db=mongo_object)
+
+  #2
+  group_object = group.group(group_id=group_id, db=mongo_object)
+  with pytest.raises(group.GroupActionError):
+    group_object.add_member(user_id=example_user.properties.userId)
+  assert len(mongo_object.get_group_member_ids(group_id)) == 1
+
+  #3
+  group_object.update(members=[registered_user.properties.userId])
+  assert group_object.properties.members == [registered_user.properties.userId]
+  assert group.find_user_in_group(example_user.properties.userId, db=mongo_object) == dict()
+
+  #4
+  group.delete_group(group_id, db=mongo_object)
+  assert mongo_object.get_group_member_ids(group_id) == []
+
+
+def test_group_lazy_members(mongo_object, example_user, group_data):
+  ''' Test member list is only fetched when used
+      1) Constructing a group doesn't read memberships
+      2) First read of members fetches them once
+      3) lazy=False fetches members up front
+  '''
+  group_id = group.create_group(group_name=group_data['groupname'],
+                                group_members=[example_user.properties.userId],
+                                db=mongo_object)[group_data['groupname']]
+
+  calls = list()
+  get_group_member_ids = mongo_object.get_group_member_ids
+  def counting_get_group_member_ids(*args, **kwargs):
+    calls.append(args)
+    return get_group_member_ids(*args, **kwargs)
+  mongo_object.get_group_member_ids = counting_get_group_member_ids
+
+  #1
+  group_object = group.group(group_id=group_id, db=mongo_object)
+  assert group_object.properties.groupName == group_data['groupname']
+  assert not group_object.properties.is_loaded("members")
+  assert len(calls) == 0
+
+  #2
+  assert group_object.properties.members == [example_user.properties.userId]
+  assert group_object.properties.members == [example_user.properties.userId]
+  assert len(calls) == 1
+
+  #3
+  group_object = group.group(group_id=group_id, db=mongo_object, lazy=False)
+  assert group_object.properties.is_loaded("members")
+  assert len(calls) == 2
+
+  group.delete_group(group_id, db=mongo_object)
+
+
+def test_user_group_names(mongo_object, example_user, registered_user, group_data):
+  ''' Test denormalised group names on the user document
+      1) Create, add and remove keep the user's groups field in step
+      2) Renaming the group renames it for members
+      3) Deleting the group removes it from members
+      4) Users without the field fall back to a membership lookup and aren't given one
+  '''
+  #1
+  group_id = group.create_group(group_name=group_data['groupname'],
+                                group_members=[example_user.properties.userId],
+                                db=mongo_object)[group_data['groupname']]
+  assert user.user(user_id=example_user.properties.userId, db=mongo_object).get_group_names() == [group_data['groupname']]
+
+  group_object = group.group(group_id=group_id, db=mongo_object)
+  group_object.remove_member(user_id=example_user.properties.userId)
+  assert mongo_object.get_user_by_id(example_user.properties.userId)['groups'] == dict()
+  group_object.add_member(user_id=example_user.properties.userId)
+  assert mongo_object.get_user_by_id(example_user.properties.userId)['groups'] == {group_id: group_data['groupname']}
+
+  #2
+  group_object.update(groupName="renamed")
+  assert user.user(user_id=example_user.properties.userId, db=mongo_object).get_group_names() == ["renamed"]
+
+  #3
+  group.delete_group(group_id, db=mongo_object)
+  assert user.user(user_id=example_user.properties.userId, db=mongo_object).get_group_names() == list()
+
+  #4
+  mongo_object.users_collection.update_one({"userId": registered_user.properties.userId}, {"$unset": {"groups": ""}})
+  group_id = group.create_group(group_name=group_data['groupname'],
+                                group_members=[registered_user.properties.userId],
+                                db=mongo_object)[group_data['groupname']]
+  assert "groups" not in mongo_object.get_user_by_id(registered_user.properties.userId)
+  assert user.user(user_id=registered_user.properties.userId, db=mongo_object).get_group_names() == [group_data['groupname']]
+  group.delete_group(group_id, db=mongo_object)
@@ -0,0 +1,127 @@
+import types
+import itertools
+
+import pytest
+
+from jots.pyauth import hashing
+
+
+@pytest.fixture(autouse=True)
+def restore_service():
+  ''' Tests reconfigure the shared pool, put it back for the rest of the suite
+  '''
+  service = hashing._service
+  saved = (service.workers, service.queue_depth, service.timeout)
+  yield
+  hashing.configure(workers=saved[0], queue_depth=saved[1], timeout=saved[2])
+  hashing.set_rounds(None)
+
+
+def test_hashing_pool():
+  ''' Test bcrypt offloaded to a worker process
+      1) Hash is created in the pool and verifies in the pool
+      2) Wrong password fails
+      3) Inline mode gives the same result as the pool
+  '''
+  hashing.configure(workers=1, queue_depth=2)
+  try:
+    #1
+    hashed = hashing.hash_password(b"password")
+    assert hashing.check_password(b"password", hashed) is True
+
+    #2
+    assert hashing.check_password(b"notthepassword", hashed) is False
+
+    #3
+    hashing.configure(workers=0)
+    assert hashing.check_password(b"password", hashed) is True
+  finally:
+    hashing.shutdown()
+
+
+def test_hashing_pool_saturated():
+  ''' Test callers are refused once the queue depth is used up, not queued indefinitely
+      1) No free slot raises HashingBusy
+      2) Slots are returned after each operation
+  '''
+  hashing.configure(workers=1, queue_depth=1)
+  try:
+    #1
+    assert hashing._service._slots.acquire(blocking=False)
+    with pytest.raises(hashing.HashingBusy):
+      hashing.hash_password(b"password")
+    hashing._service._slots.release()
+
+    #2
+    hashed = hashing.hash_password(b"password")
+    assert hashing.check_password(b"password", hashed) is True
+  finally:
+    hashing.shutdown()
+
+
+def test_hashing_calibration(monkeypatch, caplog):
+  ''' Test calibration scales the timed cost to the target
+      1) Above the floor, each doubling of the target adds a round
+      2) Below the floor, the floor is used and a warning logged
+  '''
+  # Every timed check at HASH_CALIBRATION_ROUNDS takes 2ms
+  clock = itertools.count(step=0.002)
+  monkeypatch.setattr(hashing, "time", types.SimpleNamespace(perf_counter=lambda: next(clock)))
+
+  #1
+  assert hashing.calibrate(target_ms=32) == hashing.HASH_CALIBRATION_ROUNDS + 4
+  assert hashing.calibrate(target_ms=64) == hashing.HASH_CALIBRATION_ROUNDS + 5
+  assert hashing.calibrate(target_ms=32) > hashing.HASH_MIN_ROUNDS
+  assert "floor" not in caplog.text
+
+  #2
+  assert hashing.calibrate(target_ms=2) == hashing.HASH_MIN_ROUNDS
+  assert "using the floor of {}".format(hashing.HASH_MIN_ROUNDS) in caplog.text
+
+
+def test_hashing_rounds():
+  ''' Test configurable bcrypt cost
+      1) New hashes use the configured cost
+      2) Calibration stays within the allowed range
+      3) A hash at a lower cost needs rehashing, higher costs and unknown values do not
+  '''
+  hashing.configure(workers=0)
+  try:
+    #1
+    hashing.set_rounds(4)
+    hashed = hashing.hash_password(b"password")
+    assert hashing.hash_rounds(hashed) == 4
+    assert hashing.needs_rehash(hashed) is False
+
+    #2
+    assert hashing.HASH_MIN_ROUNDS <= hashing.calibrate(target_ms=1) <= hashing.HASH_MAX_ROUNDS
+    assert hashing.calibrate(target_ms=10 ** 12) == hashing.HASH_MAX_ROUNDS
+
+    #3
+    hashing.set_rounds(5)
+    assert hashing.needs_rehash(hashed) is True
+    assert hashing.needs_rehash("notahash") is False
+
+    hashing.set_rounds(4)
+    assert hashing.needs_rehash(hashing._hashpw(b"password", 5)) is False
+  finally:
+    hashing.set_rounds(None)
+
+
+def test_hashing_pool_recovers():
+  ''' Test a crashed worker process doesn't break later calls
+      1) Work that kills its process is retried once on a fresh pool, then fails with HashingFailed
+      2) The broken pool is replaced and the next call succeeds
+  '''
+  import os
+  hashing.configure(workers=1, queue_depth=2)
+  try:
+    #1
+    with pytest.raises(hashing.HashingFailed):
+      hashing._service.run(os._exit, 1)
+
+    #2
+    hashed = hashing.hash_password(b"password")
+    assert hashing.check_password(b"password", hashed) is True
+  finally:
+    hashing.shutdown()
@@ -0,0 +1,88 @@
+import os
+import pytest
+import mongomock
+
+from jots.pyauth import mongo
+
+
+@mongomock.patch(servers=(('dev.localhost', 27017),))
+def test_client_registry():
+  ''' Test pooled client registry
+      1) Two mongo objects for the same server share one client
+      2) Different credentials get their own client
+      3) Closing clients empties the registry, next object gets a new client
+      4) A registry inherited from another process is discarded
+  '''
+  mongo.close_clients()
+
+  #1
+  db_a = mongo.mongo(mongo_host='dev.localhost', mongo_port=27017)
+  db_b = mongo.mongo(mongo_host='dev.localhost', mongo_port=27017)
+  assert db_a.client is db_b.client
+
+  #2
+  db_c = mongo.mongo(mongo_host='dev.localhost', mongo_port=27017,
+                     username="someone", password="password")
+  assert db_c.client is not db_a.client
+
+  #3
+  mongo.close_clients()
+  db_d = mongo.mongo(mongo_host='dev.localhost', mongo_port=27017)
+  assert db_d.client is not db_a.client
+
+  #4
+  mongo._clients_pid = os.getpid() + 1
+  db_e = mongo.mongo(mongo_host='dev.localhost', mongo_port=27017)
+  assert db_e.client is not db_d.client
+  assert mongo._clients_pid == os.getpid()
+
+  mongo.close_clients()
+
+
+def test_client_registry_bad_input():
+  with pytest.raises(mongo.ConnectionError):
+    mongo.mongo(mongo_host='dev.localhost', mongo_port=27017, pool_size="10")
+
+
+def test_get_users_by_ids(mongo_object, example_user, registered_user):
+  ''' Test batched user lookup
+      1) Known IDs are returned keyed by user ID, unknown IDs are omitted
+      2) Projection limits returned fields, lookups are chunked
+  '''
+  user_ids = [example_user.properties.userId, registered_user.properties.userId, "notauser"]
+
+  #1
+  users = mongo_object.get_users_by_ids(user_ids)
+  assert set(users.keys()) == set(user_ids[:2])
+
+  #2
+  users = mongo_object.get_users_by_ids(user_ids, projection={"email": 1, "_id": 0}, chunk_size=1)
+  assert users[example_user.properties.userId] == {"userId": example_user.properties.userId,
+                                                   "email": example_user.properties.email}
+
+
+def test_single_document_lookup(mongo_object, example_user):
+  ''' Test bounded single document lookups
+      1) Found document has no Mongo doc ID
+      2) Unknown value returns None
+      3) Duplicate records raise RecordError
+      4) Projections limit returned fields, Mongo doc ID is still dropped
+  '''
+  #1
+  user_doc = mongo_object.get_user_by_id(example_user.properties.userId)
+  assert user_doc['email'] == example_user.properties.email
+  assert "_id" not in user_doc
+
+  #2
+  assert mongo_object.get_user_by_email("not@known.com") is None
+
+  #4
+  assert mongo_object.get_user_by_email(example_user.properties.email, projection={"userId": 1}) == {"userId": example_user.properties.userId}
+  assert "password" not in mongo_object.get_user_by_id(example_user.properties.userId, projection={"password": 0})
+  assert "email" in mongo_object.get_user_by_id(example_user.properties.userId, projection={"password": 0})
+
+  #3
+  mongo_object.users_collection.insert_one({"userId": "duplicate", "email": "dup@one.com"})
+  mongo_object.users_collection.insert_one({"userId": "duplicate", "email": "dup@two.com"})
+  with pytest.raises(mongo.RecordError):
+    mongo_object.get_user_by_id("duplicate")
@@ -0,0 +1,44 @@
+import pytest
+import mongomock
+
+from jots.pyauth import mongo, schema
+
+
+def test_indexes(mongo_object, monkeypatch):
+  ''' Test index bootstrap
+      1) All indexes are reported missing on empty collections
+      2) Ensure creates every declared index and nothing is reported missing
+      3) Ensure is idempotent
+      4) Unused index check is None without $indexStats (mongomock), with stats
+         an undeclared index that was never used is reported
+  '''
+  declared = sum(len(indexes) for indexes in schema.INDEXES.values())
+
+  #1
+  assert len(schema.missing_indexes(mongo_object)) == declared
+
+  #2
+  applied = schema.ensure_indexes(mongo_object)
+  assert len(applied) == declared
+  assert ("users", "userId_1") in applied
+  assert schema.missing_indexes(mongo_object) == []
+
+  #3
+  assert schema.ensure_indexes(mongo_object) == applied
+
+  #4
+  mongo_object.users_collection.create_index("legacyField", name="legacyField_1")
+  try:
+    assert schema.unused_indexes(mongo_object) is None
+
+    # Stats as $indexStats reports them, declared indexes have been used
+    declared_names = {schema._index_name(index['keys']) for indexes in schema.INDEXES.values() for index in indexes}
+    for collection_attr in schema.INDEXES.keys():
+      collection = getattr(mongo_object, collection_attr)
+      stats = [{"name": name, "accesses": {"ops": 5 if name in declared_names else 0}}
+               for name in collection.index_information().keys()]
+      monkeypatch.setattr(collection, "aggregate", lambda pipeline, stats=stats: iter(stats))
+
+    assert schema.unused_indexes(mongo_object) == [("users", "legacyField_1")]
+  finally:
+    mongo_object.users_collection.drop_index("legacyField_1")
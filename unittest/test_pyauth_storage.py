@@ -0,0 +1,221 @@
+import asyncio
+import inspect
+
+import pytest
+import mongomock
+
+from jots.pyauth import storage, mongo, schema, memory, async_mongo, user, group
+
+
+class _async_cursor(object):
+  ''' Motor's cursor over a mongomock cursor
+  '''
+  def __init__(self, cursor):
+    self.cursor = cursor
+
+  def sort(self, *args):
+    return _async_cursor(self.cursor.sort(*args))
+
+  def limit(self, limit):
+    return _async_cursor(self.cursor.limit(limit))
+
+  async def to_list(self, length=None):
+    return list(self.cursor)
+
+  async def __aiter__(self):
+    for doc in self.cursor:
+      yield doc
+
+
+class _async_collection(object):
+  ''' Motor's collection over a mongomock one, every method but find is a coroutine
+  '''
+  def __init__(self, collection):
+    self.collection = collection
+
+  def find(self, *args, **kwargs):
+    return _async_cursor(self.collection.find(*args, **kwargs))
+
+  def __getattr__(self, name):
+    method = getattr(self.collection, name)
+    async def call(*args, **kwargs):
+      return method(*args, **kwargs)
+    return call
+
+
+class _async_client(object):
+  def __init__(self, client):
+    self.pyauth = _async_database(client.pyauth)
+
+
+class _async_database(object):
+  def __init__(self, database):
+    self.database = database
+
+  def __getattr__(self, name):
+    return _async_collection(getattr(self.database, name))
+
+
+class _blocking(object):
+  ''' Sync calls to an async backend, so the same tests drive it
+  '''
+  def __init__(self, backend, loop):
+    self.backend = backend
+    self.loop = loop
+
+  def __getattr__(self, name):
+    method = getattr(self.backend, name)
+    def call(*args, **kwargs):
+      return self.loop.run_until_complete(method(*args, **kwargs))
+    return call
+
+
+@pytest.fixture(scope="function", params=["mongo", "async_mongo", "memory"])
+def backend(request):
+  ''' Each test runs against mongomock, async_mongo over mongomock and the in-memory backend
+  '''
+  group.clear_member_cache()
+  if request.param == "memory":
+    db = memory.memory("test")
+    yield db
+    db.clear_collections()
+  else:
+    with mongomock.patch(servers=(('dev.localhost', 27017),)):
+      mongo.close_clients()
+      db = mongo.mongo(mongo_host='dev.localhost', mongo_port=27017)
+      # Unique indexes are what refuse duplicates in mongo
+      schema.ensure_indexes(db=db)
+      if request.param == "async_mongo":
+        loop = asyncio.new_event_loop()
+        yield _blocking(async_mongo.async_mongo(client=_async_client(db.client)), loop)
+        loop.close()
+      else:
+        yield db
+      db.clear_collections()
+      mongo.close_clients()
+
+
+def test_backend_methods():
+  ''' Test every backend implements the whole interface
+      1) Sync backends override every method
+      2) Async backends override every method with a coroutine
+      3) Backends are chosen by name, unknown names are refused
+      4) A backend missing a method can't be created
+  '''
+  #1
+  for backend_class in [mongo.mongo, memory.memory]:
+    for name in storage.BACKEND_METHODS:
+      assert getattr(backend_class, name) is not getattr(storage.backend, name), name
+
+  #2
+  for backend_class in [async_mongo.async_mongo, memory.async_memory]:
+    for name in storage.BACKEND_METHODS:
+      assert getattr(backend_class, name) is not getattr(storage.async_backend, name), name
+      assert inspect.iscoroutinefunction(getattr(backend_class, name)), name
+
+  #3
+  assert isinstance(storage.get_backend("memory"), memory.memory)
+  with pytest.raises(storage.ConnectionError):
+    storage.get_backend("unknown")
+
+  #4
+  class incomplete(storage.backend):
+    def get_user_by_id(self, user_id, projection=None):
+      return None
+
+  class incomplete_async(storage.async_backend):
+    async def get_user_by_id(self, user_id, projection=None):
+      return None
+
+  for backend_class in [incomplete, incomplete_async]:
+    with pytest.raises(TypeError):
+      backend_class()
+
+
+def test_backend_users(backend):
+  ''' Test user lifecycle is the same on every backend
+      1) Duplicate email is refused
+      2) Password set, checked and left out by projection
+      3) Paged search by email
+      4) Delete, then deleting again is a record error
+  '''
+  user.create_user("dev.localhost", "store1@b.com", db=backend)
+  user.create_user("dev.localhost", "store2@b.com", db=backend)
+
+  #1
+  with pytest.raises(user.UserActionError):
+    user.create_user("dev.localhost", "store1@b.com", db=backend)
+
+  #2
+  user_obj = user.user(email_address="store1@b.com", db=backend)
+  user_obj.set_password("password")
+  assert user.user(email_address="store1@b.com", db=backend).authenticate("password") is True
+  assert "password" not in backend.get_user_by_id(user_obj.properties.userId, projection={"password": 0})
+  assert backend.get_user_by_id(user_obj.properties.userId, projection={"email": 1}) == {"email": "store1@b.com"}
+
+  #3
+  page, cursor = storage.find_page(backend.find_users_by_email_address, "store", 1)
+  assert [email for user_id, email in page] == ["store1@b.com"]
+  page, cursor = storage.find_page(backend.find_users_by_email_address, "store", 1, cursor=cursor)
+  assert [email for user_id, email in page] == ["store2@b.com"]
+  assert backend.find_users_by_email_address("store2", mode="prefix") == page
+
+  #4
+  user.delete_user(user_obj.properties.userId, db=backend)
+  with pytest.raises(storage.RecordError):
+    backend.delete_user(user_obj.properties.userId)
+
+
+def test_backend_groups(backend):
+  ''' Test group membership is the same on every backend
+      1) Members and the users' group names are recorded
+      2) Rename is copied to members
+      3) Replacing members adds and removes them in bulk, repeated IDs are added once
+      4) Delete removes memberships and group names
+  '''
+  user.create_user("dev.localhost", "member@b.com", db=backend)
+  user_id = user.user(email_address="member@b.com", db=backend).properties.userId
+
+  #1
+  group_id = group.create_group("storage-group", group_members=[user_id], db=backend)['storage-group']
+  assert backend.get_group_member_ids(group_id) == [user_id]
+  assert backend.find_user_groups(user_id) == [(group_id, "storage-group")]
+  assert user.user(user_id=user_id, db=backend).get_group_names() == ["storage-group"]
+  assert backend.add_group_member(group_id, user_id) is False
+
+  #2
+  group.group(group_id=group_id, db=backend).update(groupName="renamed-group")
+  assert backend.get_user_by_id(user_id)['groups'] == {group_id: "renamed-group"}
+
+  #3
+  user.create_user("dev.localhost", "member2@b.com", db=backend)
+  other_id = user.user(email_address="member2@b.com", db=backend).properties.userId
+  backend.set_group_members(group_id, [user_id, other_id, other_id])
+  assert sorted(backend.get_group_member_ids(group_id)) == sorted([user_id, other_id])
+  assert backend.get_user_by_id(other_id)['groups'] == {group_id: "renamed-group"}
+
+  backend.set_group_members(group_id, [other_id])
+  assert backend.get_group_member_ids(group_id) == [other_id]
+  assert backend.get_user_by_id(user_id)['groups'] == dict()
+
+  #4
+  group.delete_group(group_id, db=backend)
+  assert backend.find_user_groups(user_id) == list()
+  assert backend.get_user_by_id(user_id)['groups'] == dict()
+
+
+def test_async_memory():
+  ''' Test concurrent lookups through the async interface
+  '''
+  db = memory.async_memory("test")
+
+  async def run():
+    for n in range(20):
+      await db.create_user({"userId": str(n), "email": "async{}@b.com".format(n), "groups": dict()})
+    return await asyncio.gather(*[db.get_user_by_id(str(n), projection={"email": 1}) for n in range(20)])
+
+  try:
+    docs = asyncio.run(run())
+    assert [doc['email'] for doc in docs] == ["async{}@b.com".format(n) for n in range(20)]
+  finally:
+    db.backend.clear_collections()
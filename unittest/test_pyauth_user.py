@@ -1,7 +1,7 @@
 import pytest
 import mongomock
 
-from jots.pyauth import mongo, user, group
+from jots.pyauth import mongo, user, group, hashing, schema
 
 
 @pytest.fixture
@@ -20,7 +20,7 @@ def test_user_operations(mongo_object, user_data):
       2) Check user object can be retrieved and properties are as expected
       3) Reset user password and confirm sensitive fields are blanked
       4 & 5) Check authentication mechanism
-      6) Check resetting password results in a long reset code
+      6) Check resetting password results in a long reset code and no usable password
       7) Check that previous password no longer works
       8) Check that setting new password clears sensitive fields
       9 & 10) Check that old password is invalid and new one works
@@ -61,6 +61,7 @@ def test_user_operations(mongo_object, user_data):
   new_reset_code = user_object.reset_password(service_domain=user_data['service_domain'])
   assert len(user_object.properties.resetCode) > 100
   assert user_object.properties.status == "reset"
+  assert user_object.properties.password == hashing.UNUSABLE_PASSWORD
 
   #7
   auth_result_reset = user_object.authenticate(user_data['correct_password'])
@@ -98,3 +99,177 @@ def test_user_operations(mongo_object, user_data):
   del_result = user.delete_user(user_object.properties.userId,
                                 db=mongo_object)
   assert del_result
+
+
+def test_user_search_modes(mongo_object):
+  ''' Test find modes
+      1) Prefix only matches the start of the address
+      2) Substring uses the n-gram index and matches anywhere, including short queries
+      3) Regex characters in the query are matched literally
+      4) Search index follows deletes
+      5) Unknown mode is rejected
+      6) Short queries match at the end of a value, substring ignores case
+  '''
+  for email_address in ["alice@one.com", "bob@one.com", "carol@two.com"]:
+    user.create_user(service_domain="dev.localhost", email_address=email_address, db=mongo_object)
+
+  #1
+  assert list(user.find_users_like("bob@one.com", db=mongo_object, mode="prefix").keys()) == ["bob@one.com"]
+  assert user.find_users_like("b@one.com", db=mongo_object, mode="prefix") == dict()
+
+  #2
+  assert list(user.find_users_like("@one.com", db=mongo_object, mode="substring").keys()) == ["alice@one.com", "bob@one.com"]
+  assert list(mongo_object.find_users_by_email_address("wo", mode="substring")) == [(mongo_object.get_user_by_email("carol@two.com")['userId'], "carol@two.com")]
+
+  #3
+  assert user.find_users_like("b@one.c.m", db=mongo_object, mode="contains") == dict()
+  assert user.find_users_like("b@one.c.m", db=mongo_object, mode="substring") == dict()
+
+  #4
+  user.delete_user(mongo_object.get_user_by_email("bob@one.com")['userId'], db=mongo_object)
+  assert list(user.find_users_like("@one.com", db=mongo_object, mode="substring").keys()) == ["alice@one.com"]
+
+  #5
+  with pytest.raises(user.InputError):
+    user.find_users_like("@one.com", db=mongo_object, mode="fuzzy")
+
+  #6
+  user.create_user(service_domain="dev.localhost", email_address="dave@one.io", db=mongo_object)
+  dave_id = mongo_object.get_user_by_email("dave@one.io")['userId']
+  assert list(mongo_object.find_users_by_email_address("io", mode="substring")) == [(dave_id, "dave@one.io")]
+  assert list(mongo_object.find_users_by_email_address("Dave", mode="substring")) == [(dave_id, "dave@one.io")]
+  assert list(mongo_object.find_users_by_email_address("ONE.I", mode="substring")) == [(dave_id, "dave@one.io")]
+
+  # Entries written in an older n-gram format are rebuilt in place
+  mongo_object.search_collection.update_one({"refId": dave_id}, {"$set": {"grams": ["dav"]}})
+  assert schema.reindex_search(db=mongo_object) == 3
+  assert list(mongo_object.find_users_by_email_address("io", mode="substring")) == [(dave_id, "dave@one.io")]
+
+
+def test_user_rehash_on_login(mongo_object, user_data):
+  ''' Test stored hashes follow the configured bcrypt cost
+      1) Password is hashed at the current cost
+      2) After the cost changes a successful login rehashes at the new cost
+      3) A failed login leaves the hash alone
+      4) A lower cost never downgrades an existing hash
+  '''
+  user.create_user(service_domain=user_data['service_domain'], email_address=user_data['email_address'], db=mongo_object)
+  user_object = user.user(email_address=user_data['email_address'], db=mongo_object)
+
+  try:
+    #1
+    hashing.set_rounds(4)
+    user_object.set_password(user_data['correct_password'])
+    assert hashing.hash_rounds(mongo_object.get_user_by_email(user_data['email_address'])['password']) == 4
+
+    #2
+    hashing.set_rounds(5)
+    assert user_object.authenticate(user_data['correct_password'])
+    assert hashing.hash_rounds(mongo_object.get_user_by_email(user_data['email_address'])['password']) == 5
+    assert user_object.authenticate(user_data['correct_password'])
+
+    #3
+    hashing.set_rounds(6)
+    assert user_object.authenticate(user_data['incorrect_password']) is False
+    assert hashing.hash_rounds(mongo_object.get_user_by_email(user_data['email_address'])['password']) == 5
+
+    #4
+    hashing.set_rounds(4)
+    assert user_object.authenticate(user_data['correct_password'])
+    assert hashing.hash_rounds(mongo_object.get_user_by_email(user_data['email_address'])['password']) == 5
+  finally:
+    hashing.set_rounds(None)
+    user.delete_user(user_object.properties.userId, db=mongo_object)
+
+
+def test_user_batch_update(mongo_object, user_data):
+  ''' Test batched user updates
+      1) Sets and unsets are written in one update, local properties follow
+      2) Without the returned document, local properties are patched from the changes
+      3) Reset with a refresh token is a single update
+      4) Nothing is written if the block raises
+  '''
+  user.create_user(service_domain=user_data['service_domain'], email_address=user_data['email_address'], db=mongo_object)
+  user_object = user.user(email_address=user_data['email_address'], db=mongo_object)
+
+  calls = list()
+  update_user = mongo_object.update_user
+  def counting_update_user(*args, **kwargs):
+    calls.append(args)
+    return update_user(*args, **kwargs)
+  mongo_object.update_user = counting_update_user
+
+  #1
+  with user_object.batch_update() as changes:
+    changes.set(refreshJti="abc", status="active")
+    changes.unset("resetExpiry")
+  assert len(calls) == 1
+  assert user_object.properties.refreshJti == "abc"
+  assert not hasattr(user_object.properties, "resetExpiry")
+  assert "resetExpiry" not in mongo_object.get_user_by_email(user_data['email_address'])
+
+  #2
+  with user_object.batch_update(return_document=False) as changes:
+    changes.set(refreshJti="def")
+  assert len(calls) == 2
+  assert user_object.properties.refreshJti == "def"
+  assert user_object.properties.email == user_data['email_address']
+
+  #3
+  user_object.reset_password(service_domain=user_data['service_domain'])
+  assert len(calls) == 3
+  assert mongo_object.get_user_by_email(user_data['email_address'])['refreshJti'] == ""
+
+  #4
+  with pytest.raises(ValueError):
+    with user_object.batch_update() as changes:
+      changes.set(status="disabled")
+      raise ValueError()
+  assert len(calls) == 3
+  assert user_object.properties.status == "reset"
+
+  user.delete_user(user_object.properties.userId, db=mongo_object)
+
+
+def test_user_properties(mongo_object, user_data):
+  ''' Test read-only property container
+      1) Fields are attributes, missing fields raise AttributeError
+      2) as_dict leaves out the password, view does not copy and can't be changed
+      3) Properties can't be set or deleted
+      4) Password is only fetched when it's needed, unless loading eagerly
+  '''
+  user.create_user(service_domain=user_data['service_domain'], email_address=user_data['email_address'], db=mongo_object)
+  user_object = user.user(email_address=user_data['email_address'], db=mongo_object)
+  user_object.set_password(user_data['correct_password'])
+
+  #1
+  assert user_object.properties.email == user_data['email_address']
+  assert "email" in user_object.properties
+  assert user_object.properties.get("notafield") is None
+  with pytest.raises(AttributeError):
+    user_object.properties.notafield
+
+  #2
+  assert "password" not in user_object.properties.as_dict()
+  assert user_object.properties.as_dict()['email'] == user_data['email_address']
+  assert user_object.properties.view()["email"] is user_object.properties.email
+  assert "password" in user_object.properties.view()
+  with pytest.raises(TypeError):
+    user_object.properties.view()['email'] = "e@f.com"
+
+  #3
+  with pytest.raises(user.UserPropertyError):
+    user_object.properties.email = "e@f.com"
+  with pytest.raises(user.UserPropertyError):
+    del user_object.properties.email
+
+  #4
+  lazy_user = user.user(email_address=user_data['email_address'], db=mongo_object)
+  assert not lazy_user.properties.is_loaded("password")
+  assert "password" not in lazy_user.properties.as_dict()
+  assert not lazy_user.properties.is_loaded("password")
+  assert lazy_user.authenticate(user_data['correct_password'])
+  assert lazy_user.properties.is_loaded("password")
+  assert user.user(email_address=user_data['email_address'], db=mongo_object, lazy=False).properties.is_loaded("password")
+
+  user.delete_user(user_object.properties.userId, db=mongo_object)
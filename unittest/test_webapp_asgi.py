@@ -0,0 +1,240 @@
+import base64
+import asyncio
+import datetime
+
+import pytest
+
+from flask_jwt_extended import create_access_token, create_refresh_token, get_jti
+
+from jots.pyauth import memory, user, group, app
+
+
+@pytest.fixture(scope="function")
+def asgi_client(monkeypatch):
+  ''' Flask app and its ASGI front sharing one in-memory store
+  '''
+  with open("public.key", "r") as public_key:
+    monkeypatch.setenv("JWTPUBKEY", public_key.read())
+
+  with open("private.key", "r") as private_key:
+    monkeypatch.setenv("JWTPRIVKEY", private_key.read())
+
+  import jots.webapp
+  from jots.webapp import asgi
+
+  group.clear_member_cache()
+  db = memory.memory("asgi")
+  flask_app = jots.webapp.create_app({"TESTING": True,
+                                      "TEST_DB": db,
+                                      "TEST_ASYNC_DB": memory.async_memory("asgi"),
+                                      "DOMAIN_NAME": "dev.localhost",
+                                      "JWT_COOKIE_DOMAIN": "dev.localhost"})
+  yield asgi.create_asgi_app(flask_app), db
+  db.clear_collections()
+
+
+def _get(asgi_app, path, headers=None, query_string=b""):
+  ''' Run one GET through the ASGI app, returns (status, headers, body)
+  '''
+  scope = {"type": "http",
+           "method": "GET",
+           "path": path,
+           "root_path": "",
+           "query_string": query_string,
+           "http_version": "1.1",
+           "scheme": "http",
+           "server": ("dev.localhost", 80),
+           "client": ("127.0.0.1", 50000),
+           "headers": [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                       for name, value in (headers or dict()).items()]}
+  messages = list()
+
+  async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+  async def send(message):
+    messages.append(message)
+
+  asyncio.run(asgi_app(scope, receive, send))
+  start = messages[0]
+  response_headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in start['headers']]
+  return start['status'], response_headers, b"".join(message.get("body", b"") for message in messages[1:])
+
+
+def _header(headers, name):
+  return [value for header, value in headers if header == name]
+
+
+def test_asgi_token_new(asgi_client):
+  ''' App token over the async path
+      1) Good key and secret return a token for the app
+      2) Bad secret is refused, missing header is a bad request
+  '''
+  asgi_app, db = asgi_client
+  app_id, app_key, app_secret = app.create_app("asgiapp", db=db)
+
+  #1
+  auth = base64.b64encode("{}:{}".format(app_key, app_secret).encode('utf-8')).decode('utf-8')
+  status, headers, body = _get(asgi_app, "/token/new", headers={"Authorization": "Basic {}".format(auth)})
+  assert status == 200
+  with asgi_app.flask_app.app_context():
+    from flask_jwt_extended import decode_token
+    decoded = decode_token(body.decode('utf-8'))
+  assert decoded['identity'] == "asgiapp"
+  assert decoded['user_claims'] == {"appId": app_id}
+
+  #2
+  auth = base64.b64encode("{}:wrong".format(app_key).encode('utf-8')).decode('utf-8')
+  status, headers, body = _get(asgi_app, "/token/new", headers={"Authorization": "Basic {}".format(auth)})
+  assert status == 403
+  assert b"permission denied" in body
+
+  status, headers, body = _get(asgi_app, "/token/new")
+  assert status == 400
+
+
+def test_asgi_api_routes(asgi_client):
+  ''' Identity routes over the async path
+      1) /api/ returns the requester's user ID, from cookie or bearer header
+      2) No token redirects to login, an expired one to refresh
+      3) Admins get user details without the password, others are refused
+      4) A cookie that doesn't decode is refused as the Flask views refuse it, even with a bearer header
+  '''
+  asgi_app, db = asgi_client
+  user.create_user("dev.localhost", "asgi@b.com", db=db)
+  user.create_user("dev.localhost", "other@b.com", db=db)
+  user_obj = user.user(email_address="asgi@b.com", db=db)
+  user_obj.set_password("password")
+  other_obj = user.user(email_address="other@b.com", db=db)
+
+  with asgi_app.flask_app.app_context():
+    access_token = create_access_token(user_obj.properties.email)
+    other_token = create_access_token(other_obj.properties.email)
+    expired_token = create_access_token(user_obj.properties.email, expires_delta=datetime.timedelta(seconds=-1))
+
+  #1
+  status, headers, body = _get(asgi_app, "/api/", headers={"Cookie": "access_token_cookie={}".format(access_token)})
+  assert status == 200
+  assert user_obj.properties.userId in body.decode('utf-8')
+
+  status, headers, body = _get(asgi_app, "/api/", headers={"Authorization": "Bearer {}".format(access_token)})
+  assert status == 200
+
+  #2
+  status, headers, body = _get(asgi_app, "/api/")
+  assert status == 302
+  assert _header(headers, "location")[0].endswith("/")
+
+  status, headers, body = _get(asgi_app, "/api/", headers={"Authorization": "Bearer {}".format(expired_token)})
+  assert status == 302
+  assert "/token/refresh?request_path=%2Fapi%2F" in _header(headers, "location")[0]
+
+  #3
+  group.create_group("admin", group_members=[user_obj.properties.userId], db=db)
+  path = "/api/v1/users/{}/details".format(other_obj.properties.userId)
+  status, headers, body = _get(asgi_app, path, headers={"Authorization": "Bearer {}".format(access_token)})
+  assert status == 200
+  assert b"other@b.com" in body
+  assert b"password" not in body
+
+  status, headers, body = _get(asgi_app, path, headers={"Authorization": "Bearer {}".format(other_token)})
+  assert status == 403
+
+  #4
+  flask_client = asgi_app.flask_app.test_client()
+  flask_client.set_cookie("dev.localhost", "access_token_cookie", "stale")
+  flask_response = flask_client.get("/api/", headers={"Authorization": "Bearer {}".format(access_token)})
+  status, headers, body = _get(asgi_app, "/api/", headers={"Cookie": "access_token_cookie=stale",
+                                                           "Authorization": "Bearer {}".format(access_token)})
+  assert status == flask_response.status_code == 302
+  assert flask_response.headers['Location'].endswith(_header(headers, "location")[0])
+
+  status, headers, body = _get(asgi_app, "/api/", headers={"Cookie": "access_token_cookie=stale"})
+  assert status == 302
+
+
+def test_asgi_token_refresh(asgi_client):
+  ''' Refresh over the async path
+      1) Stored refresh token gets a new access cookie and a redirect
+      2) A superseded refresh token is sent to logout
+      3) Other paths are served by the Flask app
+  '''
+  asgi_app, db = asgi_client
+  user.create_user("dev.localhost", "refresh@b.com", db=db)
+  user_obj = user.user(email_address="refresh@b.com", db=db)
+
+  with asgi_app.flask_app.app_context():
+    refresh_token = create_refresh_token(identity="refresh@b.com")
+    old_refresh_token = create_refresh_token(identity="refresh@b.com")
+    refresh_jti = get_jti(refresh_token)
+  user_obj.set_refresh_jti(refresh_jti)
+
+  #1
+  status, headers, body = _get(asgi_app, "/token/refresh",
+                               headers={"Cookie": "refresh_token_cookie={}".format(refresh_token)},
+                               query_string=b"request_path=/page")
+  assert status == 302
+  assert _header(headers, "location")[0].endswith("/page")
+  assert any(cookie.startswith("access_token_cookie=") for cookie in _header(headers, "set-cookie"))
+
+  #2
+  status, headers, body = _get(asgi_app, "/token/refresh",
+                               headers={"Cookie": "refresh_token_cookie={}".format(old_refresh_token)})
+  assert status == 302
+  assert "/logout" in _header(headers, "location")[0]
+
+  #3
+  status, headers, body = _get(asgi_app, "/")
+  assert status == 200
+  assert b"Login" in body
+
+
+def test_asgi_trusted_claims(asgi_client):
+  ''' Trusted claims over the async path
+      1) Claims alone authorise /api/ and the admin check, storage is not touched
+      2) Refresh mints the claims from the stored record
+  '''
+  asgi_app, db = asgi_client
+  asgi_app.flask_app.config['TRUSTED_CLAIMS'] = True
+  user.create_user("dev.localhost", "trusted@b.com", db=db)
+  user_obj = user.user(email_address="trusted@b.com", db=db)
+  group.create_group("admin", group_members=[user_obj.properties.userId], db=db)
+
+  with asgi_app.flask_app.app_context():
+    admin_token = create_access_token("trusted@b.com", user_claims={"groups": [], "userId": user_obj.properties.userId,
+                                                                    "status": "active", "admin": True})
+    user_token = create_access_token("trusted@b.com", user_claims={"groups": [], "userId": user_obj.properties.userId,
+                                                                   "status": "active", "admin": False})
+    refresh_token = create_refresh_token(identity="trusted@b.com")
+    refresh_jti = get_jti(refresh_token)
+  user_obj.set_refresh_jti(refresh_jti)
+
+  #1
+  class no_storage(object):
+    def __getattr__(self, name):
+      raise AssertionError("storage used on the read path - {}".format(name))
+
+  async_db = asgi_app.flask_app.config['TEST_ASYNC_DB']
+  asgi_app.flask_app.config['TEST_ASYNC_DB'] = no_storage()
+  status, headers, body = _get(asgi_app, "/api/", headers={"Authorization": "Bearer {}".format(admin_token)})
+  assert status == 200
+  assert user_obj.properties.userId in body.decode('utf-8')
+
+  path = "/api/v1/users/{}/details".format(user_obj.properties.userId)
+  status, headers, body = _get(asgi_app, path, headers={"Authorization": "Bearer {}".format(user_token)})
+  assert status == 403
+  asgi_app.flask_app.config['TEST_ASYNC_DB'] = async_db
+
+  status, headers, body = _get(asgi_app, path, headers={"Authorization": "Bearer {}".format(admin_token)})
+  assert status == 200
+
+  #2
+  status, headers, body = _get(asgi_app, "/token/refresh",
+                               headers={"Cookie": "refresh_token_cookie={}".format(refresh_token)})
+  assert status == 302
+  access_cookie = [cookie for cookie in _header(headers, "set-cookie") if cookie.startswith("access_token_cookie=")][0]
+  with asgi_app.flask_app.app_context():
+    from flask_jwt_extended import decode_token
+    claims = decode_token(access_cookie.split(";")[0].split("=", 1)[1])['user_claims']
+  assert claims['userId'] == user_obj.properties.userId
+  assert claims['admin'] is True
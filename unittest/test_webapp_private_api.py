@@ -103,7 +103,7 @@ def test_post_protected_endpoint_groups(client, example_user, example_user_data,
 
 def test_post_protected_endpoint_users(client, example_user, example_user_data, registered_user, example_group, monkeypatch):
   ''' Access a restricted API endpoint using CSRF token signature
-      1) Find user
+      1) Find user, paged and streamed
       2) Delete user
   '''
   import jots.webapp
@@ -126,6 +126,27 @@ def test_post_protected_endpoint_users(client, example_user, example_user_data,
   assert result.status_code == 200
   assert example_user.properties.email in result.json
 
+  post_data = {"email": example_user.properties.email, "limit": 1}
+  result = client.post("/api/v1/users/find",
+                       data=json.dumps(post_data),
+                       headers=headers,
+                       follow_redirects=True)
+
+  assert result.status_code == 200
+  assert example_user.properties.email in result.json['results']
+  assert result.json['cursor'] is None
+
+  post_data = {"email": example_user.properties.email, "stream": True}
+  result = client.post("/api/v1/users/find",
+                       data=json.dumps(post_data),
+                       headers=headers,
+                       follow_redirects=True)
+
+  assert result.status_code == 200
+  assert result.mimetype == "application/x-ndjson"
+  lines = [json.loads(line) for line in result.data.decode('utf-8').splitlines()]
+  assert lines == [{example_user.properties.email: example_user.properties.userId}]
+
   #2
   post_data = {"userid": example_user.properties.userId}
   result = client.post("/api/v1/users/delete",
@@ -185,3 +206,115 @@ def test_post_protected_endpoint_apps(client, example_user, example_user_data, r
 
   assert result.status_code == 200
   assert result.data.decode('utf-8') == new_app_key
+
+
+def test_request_identity(client, example_user, example_app, monkeypatch):
+  ''' Resolve the requester once per request
+      1) User token resolves to the user, identity is memoised on the request
+      2) App token (appId claim) resolves to the app
+  '''
+  import jots.webapp
+  from flask_jwt_extended import verify_jwt_in_request
+  from jots.webapp.request_identity import current_identity
+
+  with client.application.app_context():
+    user_token = create_access_token(example_user.properties.email)
+    app_token = create_access_token("newappZ", user_claims={"appId": example_app['newappZ']['id']})
+
+  #1
+  with client.application.test_request_context(headers={"Authorization": "Bearer {}".format(user_token)}):
+    verify_jwt_in_request()
+    identity = current_identity()
+    assert identity is current_identity()
+    assert identity.get_user().properties.userId == example_user.properties.userId
+    assert identity.get_app() is None
+
+  #2
+  with client.application.test_request_context(headers={"Authorization": "Bearer {}".format(app_token)}):
+    verify_jwt_in_request()
+    identity = current_identity()
+    assert identity.get_app().properties.appId == example_app['newappZ']['id']
+    assert identity.get_user() is None
+
+
+def test_trusted_claims(client, example_user, example_user_data, example_group, registered_user, example_app, monkeypatch):
+  ''' Authorise from access token claims without storage lookups
+      1) Login mints the user ID, status and admin flag into the access token
+      2) Claims alone authorise the read path, storage is not touched
+      3) Refresh still checks the stored refresh token
+      4) App tokens carry write access and are short lived
+  '''
+  import base64
+  from flask_jwt_extended import decode_token
+
+  client.application.config['TRUSTED_CLAIMS'] = True
+  db = client.application.config['TEST_DB']
+
+  #1
+  post_data = {"username": example_user_data['email_address'],
+               "password": example_user_data['password']}
+  result = client.post("/login", data=post_data)
+  assert result.status_code < 400
+
+  cookies = dict(cookie.split(";")[0].split("=", 1) for cookie in result.headers.getlist("Set-Cookie"))
+  access_token = cookies['access_token_cookie']
+  with client.application.app_context():
+    claims = decode_token(access_token)['user_claims']
+    other_token = create_access_token(registered_user.properties.email,
+                                      user_claims={"groups": [], "userId": registered_user.properties.userId,
+                                                   "status": "active", "admin": False})
+    inactive_token = create_access_token(registered_user.properties.email,
+                                         user_claims={"groups": [], "userId": registered_user.properties.userId,
+                                                      "status": "new", "admin": False})
+  assert claims['userId'] == example_user.properties.userId
+  assert claims['status'] == "active"
+  assert claims['admin'] is True
+  assert "admin" not in claims['groups']
+
+  #2
+  class no_storage(object):
+    def __getattr__(self, name):
+      raise AssertionError("storage used on the read path - {}".format(name))
+
+  client.application.config['TEST_DB'] = no_storage()
+  result = client.get("/api/", headers={"Authorization": "Bearer {}".format(access_token)})
+  assert result.status_code == 200
+  assert result.json['your_user'] == example_user.properties.userId
+
+  path = "/api/v1/users/{}/details".format(example_user.properties.userId)
+  result = client.get(path, headers={"Authorization": "Bearer {}".format(other_token)})
+  assert result.status_code == 403
+
+  result = client.get("/api/", headers={"Authorization": "Bearer {}".format(inactive_token)})
+  assert result.status_code == 403
+  client.application.config['TEST_DB'] = db
+
+  result = client.get(path, headers={"Authorization": "Bearer {}".format(access_token)})
+  assert result.status_code == 200
+  assert result.json['email'] == example_user.properties.email
+
+  #3
+  with client.application.app_context():
+    stale_refresh_token = create_refresh_token(identity=example_user.properties.email)
+  client.set_cookie(example_user_data['service_domain'], "refresh_token_cookie", stale_refresh_token)
+  result = client.get("/token/refresh")
+  assert result.status_code == 302
+  assert "/logout" in result.headers['Location']
+
+  client.set_cookie(example_user_data['service_domain'], "refresh_token_cookie", cookies['refresh_token_cookie'])
+  result = client.get("/token/refresh")
+  assert result.status_code == 302
+  refreshed = [cookie for cookie in result.headers.getlist("Set-Cookie") if cookie.startswith("access_token_cookie=")]
+  with client.application.app_context():
+    refreshed_claims = decode_token(refreshed[0].split(";")[0].split("=", 1)[1])['user_claims']
+  assert refreshed_claims['userId'] == example_user.properties.userId
+  assert refreshed_claims['admin'] is True
+
+  #4
+  auth = base64.b64encode("{}:{}".format(example_app['newappZ']['key'], example_app['newappZ']['secret']).encode('utf-8'))
+  result = client.get("/token/new", headers={"Authorization": "Basic {}".format(auth.decode('utf-8'))})
+  assert result.status_code == 200
+  with client.application.app_context():
+    decoded = decode_token(result.data.decode('utf-8'))
+  assert decoded['user_claims'] == {"appId": example_app['newappZ']['id'], "writeEnabled": False}
+  assert decoded['exp'] - decoded['iat'] == client.application.config['TRUSTED_APP_TOKEN_EXPIRES']
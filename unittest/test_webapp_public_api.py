@@ -69,3 +69,21 @@ def test_get_app_token(client, example_app, example_user, monkeypatch):
 
   assert result.status_code == 200
   assert result.json['email'] == example_user.properties.email
+
+
+def test_login_hashing_busy(client, example_user, example_user_data, monkeypatch):
+  ''' A saturated bcrypt pool is reported once for every view, as 503 with Retry-After
+  '''
+  import jots.pyauth.hashing
+
+  def busy(func, *args):
+    raise jots.pyauth.hashing.HashingBusy("hash", "too many pending password operations")
+  monkeypatch.setattr(jots.pyauth.hashing._service, "run", busy)
+
+  post_data = {"username": example_user_data['email_address'],
+               "password": example_user_data['password']}
+  result = client.post("/login", data=post_data)
+
+  assert result.status_code == 503
+  assert result.headers['Retry-After'] == str(jots.pyauth.hashing.HASH_RETRY_AFTER)
+  assert result.json['errorMessage'] == "busy - try again later"
@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import subprocess
+
+import jots
+
+
+STARTUP_BUDGET = float(os.environ.get("STARTUPBUDGET", 10)) # Seconds allowed for import + first request
+
+_STARTUP_SCRIPT = '''
+import sys
+import json
+import time
+
+start = time.perf_counter()
+import jots.webapp
+imported = time.perf_counter()
+lazy = not any(name.startswith("jots.webapp.bp_") for name in sys.modules)
+
+app = jots.webapp.create_app({"TESTING": True, "TEST_DB": None})
+created = time.perf_counter()
+
+with app.test_client() as client:
+  status = client.get("/").status_code
+first_request = time.perf_counter()
+
+print(json.dumps({"lazy": lazy,
+                  "status": status,
+                  "import_ms": (imported - start) * 1000,
+                  "create_ms": (created - imported) * 1000,
+                  "first_request_ms": (first_request - created) * 1000,
+                  "total_ms": (first_request - start) * 1000}))
+'''
+
+
+def test_webapp_startup(monkeypatch):
+  ''' Time a cold start in a fresh interpreter
+      1) Importing the package builds no app and imports no blueprints
+      2) First request is served
+      3) Import + first request fits the startup budget
+  '''
+  with open("public.key", "r") as public_key:
+    monkeypatch.setenv("JWTPUBKEY", public_key.read())
+
+  with open("private.key", "r") as private_key:
+    monkeypatch.setenv("JWTPRIVKEY", private_key.read())
+
+  package_root = os.path.dirname(os.path.dirname(os.path.abspath(jots.__file__)))
+  monkeypatch.setenv("PYTHONPATH", os.pathsep.join([package_root, os.environ.get("PYTHONPATH", "")]))
+
+  output = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT],
+                          check=True, capture_output=True, text=True).stdout
+  timings = json.loads(output.strip().splitlines()[-1])
+  print("startup: import {import_ms:.0f}ms, create_app {create_ms:.0f}ms, "
+        "first request {first_request_ms:.0f}ms, total {total_ms:.0f}ms".format(**timings))
+
+  #1
+  assert timings['lazy'] is True
+
+  #2
+  assert timings['status'] == 200
+
+  #3
+  assert timings['total_ms'] < STARTUP_BUDGET * 1000
+
+
+def test_webapp_factory(client):
+  ''' Test apps built by the factory are independent but share keys
+      1) Config overrides apply to the new app only
+      2) Keys are loaded once and reused
+  '''
+  import jots.webapp
+
+  #1
+  other_app = jots.webapp.create_app({"DOMAIN_NAME": "other.localhost"})
+  assert other_app is not client.application
+  assert other_app.config['DOMAIN_NAME'] == "other.localhost"
+  assert client.application.config['DOMAIN_NAME'] == "dev.localhost"
+
+  #2
+  assert other_app.config['JWT_PRIVATE_KEY'] is client.application.config['JWT_PRIVATE_KEY']
+  assert jots.webapp.app is jots.webapp.app
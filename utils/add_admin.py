@@ -9,12 +9,12 @@ collection = db.groups
 documents = collection.find({"groupName": "admin"})
 documents = list(documents)
 
-members = documents[0]['members'].copy()
+membership = {"groupId": documents[0]['groupId'], "userId": sys.argv[1]}
 
-members.append(sys.argv[1])
-
-doc = collection.find_one_and_update({"groupName": "admin"},
-                                     {"$set": {"members": members}},
-                                      upsert=False,
-                                      return_document=pymongo.collection.ReturnDocument.AFTER)
+result = db.memberships.update_one(membership,
+                                   {"$setOnInsert": membership},
+                                   upsert=True)
 
+# Keep the user's denormalised group list in step, if the user has one
+db.users.update_one({"userId": sys.argv[1], "groups": {"$exists": True}},
+                    {"$set": {"groups.{}".format(documents[0]['groupId']): "admin"}})
@@ -7,8 +7,7 @@ db = client.pyauth
 col_g = db.groups
 
 new_group = {"groupName": str(sys.argv[1]),
-               "groupId": str(uuid.uuid4()),
-               "members": []}
+               "groupId": str(uuid.uuid4())}
 
 doc_id = col_g.insert_one(new_group).inserted_id
 
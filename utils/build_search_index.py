@@ -0,0 +1,7 @@
+from jots.pyauth import mongo, schema
+
+# (Re)builds the n-gram search index used by 'substring' find mode
+db = mongo.mongo(mongo_host="localhost", username="pyauthadmin", password="password")
+
+schema.ensure_indexes(db)
+print("{} indexed".format(schema.reindex_search(db)))
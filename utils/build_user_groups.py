@@ -0,0 +1,27 @@
+import pymongo
+
+# Fills each user's 'groups' field ({group ID: group name}) from the memberships collection
+# Login reads group claims from this field, users without it fall back to a membership lookup
+# Safe to re-run, the field is rebuilt from memberships each time
+client = pymongo.MongoClient(username="pyauthadmin", password="password")
+db = client.pyauth
+col_u = db.users
+col_g = db.groups
+col_m = db.memberships
+
+group_names = dict()
+for document in col_g.find({}, {"groupId": 1, "groupName": 1}):
+  group_names[document['groupId']] = document['groupName']
+
+user_groups = dict()
+for document in col_u.find({}, {"userId": 1}):
+  user_groups[document['userId']] = dict()
+
+for document in col_m.find({}, {"groupId": 1, "userId": 1}):
+  if document['userId'] in user_groups and document['groupId'] in group_names:
+    user_groups[document['userId']][document['groupId']] = group_names[document['groupId']]
+
+for user_id, groups in user_groups.items():
+  col_u.update_one({"userId": user_id}, {"$set": {"groups": groups}})
+
+print("{} users updated".format(len(user_groups)))
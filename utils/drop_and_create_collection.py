@@ -1,29 +1,20 @@
-import pymongo
 import uuid
 
-client = pymongo.MongoClient(username="pyauthadmin", password="password")
-db = client.pyauth
+from jots.pyauth import mongo, schema
 
-col_u = db.users
-col_u.drop()
+db = mongo.mongo(mongo_host="localhost", username="pyauthadmin", password="password")
 
-col_g = db.groups
-col_g.drop()
+db.users_collection.drop()
+db.groups_collection.drop()
+db.apps_collection.drop()
+db.memberships_collection.drop()
+db.search_collection.drop()
 
-col_a = db.apps
-col_a.drop()
-
-col_a = db.apps
-
-col_u = db.users
-col_u.create_index("email", unique=True)
-
-col_g = db.groups
-col_g.create_index("groupName", unique=True)
+# Indexes are declared in pyauth/schema.py
+schema.ensure_indexes(db)
 
 admin_group = {"groupName": "admin",
-               "groupId": str(uuid.uuid4()),
-               "members": []}
-
-doc_id = col_g.insert_one(admin_group).inserted_id
+               "groupId": str(uuid.uuid4())}
 
+doc_id = db.groups_collection.insert_one(admin_group).inserted_id
+db.index_search_value("groups", admin_group['groupId'], admin_group['groupName'])
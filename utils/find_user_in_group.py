@@ -9,7 +9,10 @@ collection = db.groups
 
 member_id = sys.argv[1]
 
-documents = collection.find({"members": member_id})
+memberships = db.memberships.find({"userId": member_id})
+group_ids = [membership['groupId'] for membership in memberships]
+
+documents = collection.find({"groupId": {"$in": group_ids}})
 documents = list(documents)
 
 print(documents)
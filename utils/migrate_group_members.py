@@ -0,0 +1,19 @@
+from jots.pyauth import mongo, schema
+
+# Moves embedded group 'members' arrays into the memberships collection
+# Safe to re-run, existing memberships are left as they are
+db = mongo.mongo(mongo_host="localhost", username="pyauthadmin", password="password")
+col_g = db.groups_collection
+col_m = db.memberships_collection
+
+schema.ensure_indexes(db)
+
+documents = col_g.find({"members": {"$exists": True}}, {"groupId": 1, "groupName": 1, "members": 1})
+
+for document in documents:
+  for member_id in document['members']:
+    membership = {"groupId": document['groupId'], "userId": member_id}
+    col_m.update_one(membership, {"$setOnInsert": membership}, upsert=True)
+
+  col_g.update_one({"groupId": document['groupId']}, {"$unset": {"members": ""}})
+  print("{} - {} members migrated".format(document['groupName'], len(document['members'])))
@@ -1,80 +1,133 @@
+''' Web app factory
+    Importing the package has no side effects, create_app builds a configured app
+    Blueprint modules are only imported when the first app is built
+'''
 import os
+import threading
+import importlib
 
 from flask import Flask
-from flask_jwt_extended import JWTManager
-from flask_cors import CORS
 
-PUB_KEY = os.environ.get("JWTPUBKEY")
-PRIV_KEY = os.environ.get("JWTPRIVKEY")
 ISSUER = os.environ.get("JWTISSUER")
 BASE_URL = ISSUER # This shoud be a seperate envvar
 SERVER_PORT = 5000 # Default server port
 SERVER_PROTOCOL = "http" # This should be an env var, used when rendering templates
-
-
-# If keys aren't passed in as env.vars, see if they are files
-if PUB_KEY is None:
-  try:
-    with open("public.key", "r") as public_key:
-      PUB_KEY = public_key.read()
-
-  except FileNotFoundError:
-    raise Exception("No public key provided, cannot run")
-
-if PRIV_KEY is None:
+TRUSTED_CLAIMS = os.environ.get("JWTTRUSTEDCLAIMS", "0") == "1" # Authorise from access token claims, no lookups on the read path
+TRUSTED_APP_TOKEN_EXPIRES = int(os.environ.get("JWTTRUSTEDAPPEXPIRES", 900)) # Seconds an app token lives with trusted claims
+
+# (module, blueprint, url prefix) registered on each app, in order
+BLUEPRINTS = [
+  # Public Webviews
+  ("bp_public_webview_common", "web_root", "/"),
+  # Public API
+  ("bp_public_api_common", "api_root", "/"),
+  # Private Webviews
+  ("bp_private_webview_common", "web_private_common", "/"),
+  ("bp_private_webview_example", "web_private_example", "/"),
+  ("bp_private_webview_admin", "web_private_admin", "/admin"),
+  # Private API
+  ("bp_private_api_common", "api_common", "/api"),
+  ("bp_private_api_users", "api_users", "/api/v1/users"),
+  ("bp_private_api_groups", "api_groups", "/api/v1/groups"),
+  ("bp_private_api_apps", "api_apps", "/api/v1/apps"),
+]
+
+
+_keys = {"public": None, "private": None}
+_keys_lock = threading.Lock()
+
+_default = {"app": None}
+_default_lock = threading.Lock()
+
+
+def _read_key(envvar, filename, name):
+  key = os.environ.get(envvar)
+  if key is not None:
+    return key
+
+  # If keys aren't passed in as env.vars, see if they are files
   try:
-    with open("private.key", "r") as private_key:
-      PRIV_KEY = private_key.read()
+    with open(filename, "r") as key_file:
+      return key_file.read()
 
   except FileNotFoundError:
-    raise Exception("No private key provided, cannot run")
-
-
-app = Flask(__name__)
-app.config['SERVER_PORT'] = SERVER_PORT
-app.config['SERVER_PROTOCOL'] = SERVER_PROTOCOL
-app.config['DOMAIN_NAME'] = BASE_URL
-
-app.config['JWT_PUBLIC_KEY'] = PUB_KEY
-app.config['JWT_PRIVATE_KEY'] = PRIV_KEY
-app.config['JWT_ALGORITHM'] = "RS512"
-
-app.config['JWT_COOKIE_DOMAIN'] = ISSUER
-app.config['JWT_TOKEN_LOCATION'] = ['cookies', 'headers']
-app.config['JWT_ACCESS_COOKIE_PATH'] = '/'
-app.config['JWT_COOKIE_SECURE'] = False # THIS MUST BE SET TO TRUE IN PRODUCTION
-app.config['JWT_COOKIE_SAMESITE'] = "lax"
-app.config['JWT_COOKIE_CSRF_PROTECT'] = True
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = 30
-
-jwt = JWTManager(app)
-CORS(app)
-
-
-from jots.webapp import error_handlers
-
-# Public Webviews
-from jots.webapp import bp_public_webview_common
-app.register_blueprint(bp_public_webview_common.web_root, url_prefix="/")
-
-# Public API
-from jots.webapp import bp_public_api_common
-app.register_blueprint(bp_public_api_common.api_root, url_prefix="/")
-
-# Private Webviews
-from jots.webapp import bp_private_webview_common
-from jots.webapp import bp_private_webview_example
-from jots.webapp import bp_private_webview_admin
-app.register_blueprint(bp_private_webview_common.web_private_common, url_prefix="/")
-app.register_blueprint(bp_private_webview_example.web_private_example, url_prefix="/")
-app.register_blueprint(bp_private_webview_admin.web_private_admin, url_prefix="/admin")
-
-# Private API
-from jots.webapp import bp_private_api_common
-from jots.webapp import bp_private_api_users
-from jots.webapp import bp_private_api_groups
-from jots.webapp import bp_private_api_apps
-app.register_blueprint(bp_private_api_common.api_common, url_prefix="/api")
-app.register_blueprint(bp_private_api_users.api_users, url_prefix="/api/v1/users")
-app.register_blueprint(bp_private_api_groups.api_groups, url_prefix="/api/v1/groups")
-app.register_blueprint(bp_private_api_apps.api_apps, url_prefix="/api/v1/apps")
+    raise Exception("No {} key provided, cannot run".format(name))
+
+
+def load_keys():
+  ''' Returns (public key, private key), read once per process
+      Apps built before a fork (e.g. gunicorn preload) share them with every worker
+  '''
+  with _keys_lock:
+    if _keys['public'] is None:
+      _keys['public'] = _read_key("JWTPUBKEY", "public.key", "public")
+    if _keys['private'] is None:
+      _keys['private'] = _read_key("JWTPRIVKEY", "private.key", "private")
+    return _keys['public'], _keys['private']
+
+
+def create_app(config=None):
+  ''' Build an app, config is a dict of overrides applied after the defaults
+      Keys are only loaded if config doesn't supply JWT_PUBLIC_KEY and JWT_PRIVATE_KEY
+  '''
+  from flask_jwt_extended import JWTManager
+  from flask_cors import CORS
+  from jots.webapp import error_handlers
+  from jots.mailer import outbox
+
+  config = dict(config or dict())
+
+  app = Flask(__name__)
+  app.config['SERVER_PORT'] = SERVER_PORT
+  app.config['SERVER_PROTOCOL'] = SERVER_PROTOCOL
+  app.config['DOMAIN_NAME'] = BASE_URL
+
+  app.config['JWT_ALGORITHM'] = "RS512"
+
+  app.config['JWT_COOKIE_DOMAIN'] = ISSUER
+  app.config['JWT_TOKEN_LOCATION'] = ['cookies', 'headers']
+  app.config['JWT_ACCESS_COOKIE_PATH'] = '/'
+  app.config['JWT_COOKIE_SECURE'] = False # THIS MUST BE SET TO TRUE IN PRODUCTION
+  app.config['JWT_COOKIE_SAMESITE'] = "lax"
+  app.config['JWT_COOKIE_CSRF_PROTECT'] = True
+  app.config['JWT_ACCESS_TOKEN_EXPIRES'] = 30
+
+  # User access tokens are already short, refresh is where revoked tokens and status changes are seen
+  app.config['TRUSTED_CLAIMS'] = TRUSTED_CLAIMS
+  app.config['TRUSTED_APP_TOKEN_EXPIRES'] = TRUSTED_APP_TOKEN_EXPIRES
+
+  if "JWT_PUBLIC_KEY" not in config or "JWT_PRIVATE_KEY" not in config:
+    app.config['JWT_PUBLIC_KEY'], app.config['JWT_PRIVATE_KEY'] = load_keys()
+
+  app.config.update(config)
+
+  # Accounts are committed before their email is queued, don't accept any until mail can go out
+  outbox.check()
+
+  jwt = JWTManager(app)
+  CORS(app)
+  error_handlers.init_app(app, jwt)
+
+  for module_name, blueprint_name, url_prefix in BLUEPRINTS:
+    module = importlib.import_module("jots.webapp." + module_name)
+    app.register_blueprint(getattr(module, blueprint_name), url_prefix=url_prefix)
+
+  return app
+
+
+def get_app():
+  ''' Shared app built with the default config on first use
+  '''
+  with _default_lock:
+    if _default['app'] is None:
+      _default['app'] = create_app()
+    return _default['app']
+
+
+def __getattr__(name):
+  # Keeps "from jots.webapp import app" working without building an app at import
+  if name == "app":
+    return get_app()
+  if name == "jwt":
+    return get_app().extensions['flask-jwt-extended']
+  raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,43 @@
+import json
+
+from flask import jsonify, Response, stream_with_context
+
+from jots.webapp import error_handlers
+
+
+def paged_find_response(request_content, query, find_page, iter_like, input_error, mode="contains", db=None):
+  ''' Builds the response for paged or streamed /find requests
+      "stream": true returns NDJSON, one {name: id} object per line
+      "limit" and/or "cursor" return {"results": {name: id}, "cursor": next or null}
+      Returns None if neither was requested, caller falls back to the unpaged find
+  '''
+  if request_content.get("stream") is True:
+    try:
+      matches = iter_like(query, db=db, mode=mode)
+    except input_error as err:
+      raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
+
+    def generate():
+      for name, item_id in matches:
+        yield json.dumps({name: item_id}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+  if "limit" not in request_content and "cursor" not in request_content:
+    return None
+
+  limit = request_content.get("limit")
+  cursor = request_content.get("cursor")
+  if cursor is not None and not isinstance(cursor, str):
+    raise error_handlers.InvalidAPIUsage("bad cursor", status_code=400)
+
+  try:
+    if limit is None:
+      results, next_cursor = find_page(query, cursor=cursor, db=db, mode=mode)
+    else:
+      results, next_cursor = find_page(query, limit=limit, cursor=cursor, db=db, mode=mode)
+  except input_error as err:
+    raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
+
+  return jsonify({"results": results,
+                  "cursor": next_cursor})
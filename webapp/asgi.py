@@ -0,0 +1,219 @@
+''' ASGI front for the web app
+    The token and identity routes spend most of their time waiting on storage,
+    so they are served here by coroutines over an async backend and keep many
+    requests in flight per worker. Every other request goes to the Flask app
+    through a2wsgi, on its thread pool, unchanged.
+
+      /token/new, /token/refresh, /api/, /api/v1/users/<id>/details
+
+    Behaviour matches the Flask views, including error bodies and cookies:
+    the decisions, token lookup included, are shared through request_identity
+    and errors are answered by the Flask app's own handlers and JWT loaders,
+    this module only deals with ASGI transport.
+    Flask 1.1 keeps its contexts per thread, so a request context is only
+    pushed around synchronous sections, never held across an await.
+
+    Needs a2wsgi, plus uvicorn to serve it. Run with runserv.py --server asgi,
+    or any ASGI server:
+
+      uvicorn --factory jots.webapp.asgi:create_asgi_app
+'''
+import io
+import os
+import re
+import html
+
+import jwt as pyjwt
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from werkzeug.wrappers import Request
+from werkzeug.utils import redirect
+from flask import jsonify, url_for
+from flask_jwt_extended import set_access_cookies
+from flask_jwt_extended.exceptions import JWTExtendedException
+
+from jots.webapp import error_handlers
+from jots.webapp import request_identity
+import jots.pyauth.storage
+import jots.pyauth.hashing
+import jots.pyauth.async_auth
+
+WSGI_THREADS = int(os.environ.get("WSGITHREADS", 32)) # Threads running requests passed on to the Flask app
+
+# Raised by the routes and answered by the Flask app's error handlers and JWT loaders
+ROUTE_ERRORS = (JWTExtendedException, pyjwt.InvalidTokenError,
+                error_handlers.InvalidUsage, error_handlers.InvalidAPIUsage, jots.pyauth.hashing.Error)
+
+
+class error_response(Exception):
+  ''' An error already answered by the Flask app, in the request context it was raised in
+      The JWT loaders read the failed token back from that context
+  '''
+  def __init__(self, response):
+    Exception.__init__(self)
+    self.response = response
+
+
+class jots_asgi(object):
+  def __init__(self, flask_app, db=None, wsgi_threads=WSGI_THREADS):
+    self.flask_app = flask_app
+    self.db = db
+    self.wsgi = WSGIMiddleware(flask_app, workers=wsgi_threads)
+    self.routes = [(re.compile(r"^/token/new$"), self.token_get),
+                   (re.compile(r"^/token/refresh$"), self.refresh_get),
+                   (re.compile(r"^/api/$"), self.api_index),
+                   (re.compile(r"^/api/v1/users/([^/]+)/details$"), self.api_user_details)]
+
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == "http" and scope['method'] in ("GET", "HEAD"):
+      for pattern, handler in self.routes:
+        match = pattern.match(scope['path'])
+        if match:
+          return await self._handle(handler, match.groups(), scope, send)
+
+    return await self.wsgi(scope, receive, send)
+
+
+  def get_db(self):
+    ''' One async backend per worker, created on the worker's event loop
+        Allow the use of a mock DB during testing
+    '''
+    if self.flask_app.config['TESTING']:
+      return self.flask_app.config['TEST_ASYNC_DB']
+
+    if self.db is None:
+      # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+      self.db = jots.pyauth.storage.get_async_backend()
+    return self.db
+
+
+  async def _handle(self, handler, args, scope, send):
+    # The routes are all GET, there is no body to read
+    request = Request(build_environ(scope, io.BytesIO()))
+    try:
+      response = await handler(request, *args)
+    except error_response as err:
+      response = err.response
+    except ROUTE_ERRORS as err:
+      with self._request_context(request):
+        response = self._answer(err)
+
+    if "Origin" in request.headers:
+      # Same as flask_cors with its defaults
+      response.headers['Access-Control-Allow-Origin'] = "*"
+
+    await _send_response(send, response, head=request.method == "HEAD")
+
+
+  def _request_context(self, request):
+    return self.flask_app.request_context(request.environ)
+
+
+  def _answer(self, err):
+    # Must run while err is being handled, Flask reads it back from sys.exc_info
+    return self.flask_app.make_response(self.flask_app.handle_user_exception(err))
+
+
+  def _verified_token(self, request, token_type):
+    with self._request_context(request):
+      try:
+        return request_identity.verified_token(token_type)
+      except ROUTE_ERRORS as err:
+        raise error_response(self._answer(err))
+
+
+  def _identity(self, decoded_token):
+    # Only access tokens are trusted, refresh always checks the stored record
+    config = self.flask_app.config
+    return request_identity.async_identity(decoded_token[config['JWT_IDENTITY_CLAIM']],
+                                           claims=decoded_token.get(config['JWT_USER_CLAIMS']),
+                                           db=self.get_db(),
+                                           trusted=request_identity.trusted_claims(config) and decoded_token['type'] == "access")
+
+
+  async def token_get(self, request):
+    ''' As bp_public_api_common.token_get
+    '''
+    key, secret = request_identity.basic_auth_credentials(request.headers.get("Authorization"))
+    with request_identity.api_lookup_errors("forbidden - bad app"):
+      app_props = await jots.pyauth.async_auth.get_app(app_key=key, db=self.get_db())
+
+    authenticated = await jots.pyauth.async_auth.authenticate_app(app_props, secret)
+
+    if not authenticated:
+      raise error_handlers.InvalidAPIUsage("permission denied", status_code=403)
+
+    with self.flask_app.app_context():
+      return self.flask_app.make_response(request_identity.app_access_token(app_props))
+
+
+  async def refresh_get(self, request):
+    ''' As bp_private_webview_common.refresh_get
+    '''
+    decoded_token = self._verified_token(request, "refresh")
+    identity = self._identity(decoded_token)
+    user = await identity.get_user()
+
+    # Check that refresh token given matches what is stored
+    if not request_identity.refresh_jti_valid(user, decoded_token['jti']):
+      with self._request_context(request):
+        return redirect(url_for("public_webview_common.logout", request_path=request.path))
+
+    request_path = request_identity.refresh_redirect_path(request.args, config=self.flask_app.config)
+
+    group_names = None
+    if request_identity.trusted_claims(self.flask_app.config):
+      group_names = await jots.pyauth.async_auth.get_group_names(user.properties, db=self.get_db())
+
+    response = redirect(request_path)
+    with self.flask_app.app_context():
+      set_access_cookies(response, request_identity.refreshed_access_token(identity.requester_id, user.properties, group_names))
+    return response
+
+
+  async def api_index(self, request):
+    ''' As bp_private_api_common.api_index
+    '''
+    user = await self._identity(self._verified_token(request, "access")).get_user()
+    request_identity.require_requester(user)
+
+    with self.flask_app.app_context():
+      return jsonify({"version": "v1",
+                      "your_user": user.properties.userId})
+
+
+  async def api_user_details(self, request, user_id):
+    ''' As bp_private_api_users.api_user_details, with valid_id_required and user_is_admin
+    '''
+    identity = self._identity(self._verified_token(request, "access"))
+    user = await identity.get_user()
+    request_identity.require_requester(user, await identity.get_app())
+    if user is not None:
+      request_identity.require_admin(await identity.is_admin())
+
+    user_id = html.escape(user_id)
+    with request_identity.api_lookup_errors("invalid user"):
+      user_details = await jots.pyauth.async_auth.get_user(user_id=user_id, db=self.get_db(),
+                                                           projection={"password": 0})
+
+    with self.flask_app.app_context():
+      return jsonify(user_details.as_dict())
+
+
+async def _send_response(send, response, head=False):
+  body = b"" if head else response.get_data()
+  headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+             for name, value in response.headers.items() if name.lower() != "content-length"]
+  headers.append((b"content-length", str(len(response.get_data())).encode('latin-1')))
+  await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+  await send({"type": "http.response.body", "body": body})
+
+
+def create_asgi_app(flask_app=None, db=None, wsgi_threads=WSGI_THREADS):
+  ''' ASGI app serving the async routes in front of flask_app, the shared default app if not given
+  '''
+  if flask_app is None:
+    from jots.webapp import get_app
+    flask_app = get_app()
+  return jots_asgi(flask_app, db=db, wsgi_threads=wsgi_threads)
@@ -2,13 +2,9 @@ from functools import wraps
 from distutils.util import strtobool
 
 from flask import g
-from flask_jwt_extended import get_jwt_identity
 
-from jots.webapp import app
 from jots.webapp import error_handlers
-import jots.pyauth.user
-import jots.pyauth.group
-import jots.pyauth.app
+from jots.webapp.request_identity import current_identity, require_requester, require_admin
 
 
 def valid_id_required(func):
@@ -17,36 +13,14 @@ def valid_id_required(func):
   '''
   @wraps(func)
   def id_wrapper(*args, **kwargs):
-    # Allow the use of a mock DB during testing
-    if app.config['TESTING']:
-      DB_CON = app.config['TEST_DB']
-    else:
-      DB_CON = None
+    # Requester is resolved once per request and shared with later decorators and the view
+    identity = current_identity()
 
-    g.app_obj = None
-    g.user_obj = None
-
-    # Extract requesters identidy and confirm it's a valid app
-    requester_id = get_jwt_identity()
-
-    # App errors passed as we need to check that a user isn't authing before raising an error
-    try:
-      g.app_obj = jots.pyauth.app.app(app_name=requester_id, db=DB_CON)
-    except jots.pyauth.app.AppNotFound:
-      pass
-    except jots.pyauth.user.InputError:
-      pass
-
-    try:
-      g.user_obj = jots.pyauth.user.user(email_address=requester_id, db=DB_CON)
-    except jots.pyauth.user.UserNotFound:
-      pass
-    except jots.pyauth.user.InputError:
-      pass
+    g.app_obj = identity.get_app()
+    g.user_obj = identity.get_user()
 
     # Catch all - if neither object is populated, raise error
-    if g.app_obj is None and g.user_obj is None:
-      raise error_handlers.InvalidAPIUsage("access denied", status_code=403)
+    require_requester(g.user_obj, g.app_obj)
 
     return func(*args, **kwargs)
   return id_wrapper
@@ -73,24 +47,9 @@ def user_is_admin(func):
   '''
   @wraps(func)
   def usr_adm_wrapper(*args, **kwargs):
-    # Allow the use of a mock DB during testing
-    if app.config['TESTING']:
-      DB_CON = app.config['TEST_DB']
-    else:
-      DB_CON = None
-
     if g.user_obj is not None:
-      # If user object was created, check user is admin
-      try:
-        group = jots.pyauth.group.group(group_name="admin", db=DB_CON)
-      except jots.pyauth.group.GroupNotFound:
-        raise error_handlers.InvalidAPIUsage("admin group not found", status_code=500)
-
-      if g.user_obj.properties.userId not in group.properties.members:
-        raise error_handlers.InvalidAPIUsage("access denied", status_code=403)
+      # Admin flag from trusted claims, else checked against the cached member set
+      require_admin(current_identity().is_admin())
 
     return func(*args, **kwargs)
   return usr_adm_wrapper
-
-
-
@@ -4,16 +4,11 @@ import datetime
 
 from functools import wraps
 
-from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint
-from flask_jwt_extended import (
-    JWTManager, jwt_required, jwt_optional, jwt_refresh_token_required,
-    create_refresh_token, create_access_token,
-    set_access_cookies, set_refresh_cookies, unset_jwt_cookies,
-    get_jwt_identity, verify_jwt_in_request
-)
+from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint, current_app
 
-from jots.webapp import app
 from jots.webapp import error_handlers
+from jots.webapp.request_identity import token_required
+from jots.webapp.api_paging import paged_find_response
 from jots.mailer import send as mailer
 from jots.webapp.authorisation_decorators import (
     valid_id_required, app_write_enabled_required, user_is_admin
@@ -28,13 +23,13 @@ api_apps = Blueprint('apps', __name__)
 
 
 @api_apps.route('/find', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 def api_findapps():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -47,24 +42,38 @@ def api_findapps():
     raise error_handlers.InvalidAPIUsage("bad payload", status_code=400)
 
   app_name = html.escape(request_content['appname'])
+  # contains (default), prefix (index backed) or substring (n-gram index backed)
+  search_mode = request_content.get("mode", "contains")
+
+  # Optional paging or NDJSON streaming, large result sets are never built in memory
+  paged_response = paged_find_response(request_content, app_name,
+                                       jots.pyauth.app.find_apps_page,
+                                       jots.pyauth.app.iter_apps_like,
+                                       jots.pyauth.app.InputError,
+                                       mode=search_mode,
+                                       db=DB_CON)
+  if paged_response is not None:
+    return paged_response
 
   try:
-    response = jots.pyauth.app.find_apps_like(app_name, db=DB_CON)
+    response = jots.pyauth.app.find_apps_like(app_name, db=DB_CON, mode=search_mode)
     return jsonify(response)
 
   except jots.pyauth.app.AppNotFound:
     return jsonify(dict())
+  except jots.pyauth.app.InputError as err:
+    raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
 
 
 @api_apps.route('/new', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 @app_write_enabled_required
 def api_newapp():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -91,14 +100,14 @@ def api_newapp():
 
 
 @api_apps.route('/delete', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 @app_write_enabled_required
 def api_deleteapp():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -121,13 +130,13 @@ def api_deleteapp():
 
 
 @api_apps.route('/<app_id>/key')
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 def api_get_appkey(app_id):
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -143,13 +152,13 @@ def api_get_appkey(app_id):
 
 
 @api_apps.route('/<app_id>/details')
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 def api_get_appdetails(app_id):
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
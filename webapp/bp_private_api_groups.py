@@ -4,16 +4,11 @@ import datetime
 
 from functools import wraps
 
-from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint
-from flask_jwt_extended import (
-    JWTManager, jwt_required, jwt_optional, jwt_refresh_token_required,
-    create_refresh_token, create_access_token,
-    set_access_cookies, set_refresh_cookies, unset_jwt_cookies,
-    get_jwt_identity, verify_jwt_in_request
-)
+from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint, current_app
 
-from jots.webapp import app
 from jots.webapp import error_handlers
+from jots.webapp.request_identity import token_required
+from jots.webapp.api_paging import paged_find_response
 from jots.mailer import send as mailer
 from jots.webapp.authorisation_decorators import (
     valid_id_required, app_write_enabled_required, user_is_admin
@@ -27,7 +22,7 @@ api_groups = Blueprint('groups', __name__)
 # /api/v1/groups/
 
 @api_groups.route('/find', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 def api_findgroups():
@@ -36,8 +31,8 @@ def api_findgroups():
       but should result in the same output
   '''
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -49,13 +44,27 @@ def api_findgroups():
   # Search by group name
   if 'groupname' in request_content:
     groupname = html.escape(request_content['groupname'])
+    # contains (default), prefix (index backed) or substring (n-gram index backed)
+    search_mode = request_content.get("mode", "contains")
+
+    # Optional paging or NDJSON streaming, large result sets are never built in memory
+    paged_response = paged_find_response(request_content, groupname,
+                                         jots.pyauth.group.find_groups_page,
+                                         jots.pyauth.group.iter_groups_like,
+                                         jots.pyauth.group.InputError,
+                                         mode=search_mode,
+                                         db=DB_CON)
+    if paged_response is not None:
+      return paged_response
 
     try:
-      response = jots.pyauth.group.find_groups_like(groupname, db=DB_CON)
+      response = jots.pyauth.group.find_groups_like(groupname, db=DB_CON, mode=search_mode)
       return jsonify(response)
 
     except jots.pyauth.group.GroupNotFound:
       return jsonify(dict())
+    except jots.pyauth.group.InputError as err:
+      raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
 
   # Search for group by member user id
   elif 'userid' in request_content:
@@ -73,14 +82,14 @@ def api_findgroups():
 
 
 @api_groups.route('/new', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 @app_write_enabled_required
 def api_newgroup():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -101,14 +110,14 @@ def api_newgroup():
 
 
 @api_groups.route('/delete', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 @app_write_enabled_required
 def api_deletegroup():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -132,13 +141,13 @@ def api_deletegroup():
 
 
 @api_groups.route('/<group_id>/members')
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 def api_groupmembers(group_id):
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -157,14 +166,14 @@ def api_groupmembers(group_id):
 
 
 @api_groups.route('/<group_id>/members/add', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 @app_write_enabled_required
 def api_groupmember_add(group_id):
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -199,14 +208,14 @@ def api_groupmember_add(group_id):
 
 
 @api_groups.route('/<group_id>/members/remove', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 @app_write_enabled_required
 def api_groupmember_remove(group_id):
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -4,20 +4,17 @@ import datetime
 
 from functools import wraps
 
-from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint, g
-from flask_jwt_extended import (
-    JWTManager, jwt_required, jwt_optional, jwt_refresh_token_required,
-    create_refresh_token, create_access_token,
-    set_access_cookies, set_refresh_cookies, unset_jwt_cookies,
-    get_jwt_identity, verify_jwt_in_request, get_jwt_claims
-)
+from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint, g, current_app
 
-from jots.webapp import app
 from jots.webapp import error_handlers
+from jots.webapp import request_identity
+from jots.webapp.request_identity import token_required
+from jots.webapp.api_paging import paged_find_response
 from jots.webapp.authorisation_decorators import (
     valid_id_required, app_write_enabled_required, user_is_admin
 )
 from jots.mailer import send as mailer
+from jots.mailer import outbox
 
 import jots.pyauth.user
 import jots.pyauth.group
@@ -30,8 +27,8 @@ api_users = Blueprint('users', __name__)
 @api_users.route('/new', methods=["POST"])
 def api_newuser():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -49,7 +46,7 @@ def api_newuser():
 
   # This should be the start of a verification process, short-circuit for now
   try:
-    reset_code = jots.pyauth.user.create_user(service_domain=app.config['DOMAIN_NAME'],
+    reset_code = jots.pyauth.user.create_user(service_domain=current_app.config['DOMAIN_NAME'],
                                               email_address=email,
                                               db=DB_CON)
 
@@ -60,18 +57,18 @@ def api_newuser():
   try:
     email_obj = mailer.personalised_email(recipient=email,
                                           template_name="newuser",
-                                          data={"site_name": app.config['DOMAIN_NAME'],
-                                                "reset_url": "https://{}:{}/reset?q={}".format(app.config['DOMAIN_NAME'],
-                                                                                               app.config['SERVER_PORT'],
+                                          data={"site_name": current_app.config['DOMAIN_NAME'],
+                                                "reset_url": "https://{}:{}/reset?q={}".format(current_app.config['DOMAIN_NAME'],
+                                                                                               current_app.config['SERVER_PORT'],
                                                                                                reset_code)})
-    if app.config['TESTING']:
-      email_obj.send(mail_agent="file")
-    else:
-      email_obj.send()
+    # Rendered and sent by the mail outbox workers
+    outbox.enqueue(email_obj)
   except mailer.InputError as err:
     raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
   except mailer.MailActionError as err:
     raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
+  except outbox.QueueError as err:
+    raise error_handlers.InvalidAPIUsage(err.message, status_code=503)
 
   return jsonify({"status": "ok",
                   "reset_code": reset_code})
@@ -80,8 +77,8 @@ def api_newuser():
 @api_users.route('/reset', methods=["POST"])
 def api_passwordreset():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -105,7 +102,7 @@ def api_passwordreset():
     raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
 
   try:
-    reset_code = user.reset_password(service_domain=app.config['DOMAIN_NAME'])
+    reset_code = user.reset_password(service_domain=current_app.config['DOMAIN_NAME'])
   except jots.pyauth.user.UserActionError as err:
     raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
   except jots.pyauth.user.InputError as err:
@@ -115,31 +112,31 @@ def api_passwordreset():
   try:
     email_obj = mailer.personalised_email(recipient=email,
                                           template_name="reset",
-                                          data={"site_name": app.config['DOMAIN_NAME'],
-                                                "reset_url": "https://{}:{}/reset?q={}".format(app.config['DOMAIN_NAME'],
-                                                                                               app.config['SERVER_PORT'],
+                                          data={"site_name": current_app.config['DOMAIN_NAME'],
+                                                "reset_url": "https://{}:{}/reset?q={}".format(current_app.config['DOMAIN_NAME'],
+                                                                                               current_app.config['SERVER_PORT'],
                                                                                                reset_code)})
-    if app.config['TESTING']:
-      email_obj.send(mail_agent="file")
-    else:
-      email_obj.send()
+    # Rendered and sent by the mail outbox workers
+    outbox.enqueue(email_obj)
   except mailer.InputError as err:
     raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
   except mailer.MailActionError as err:
     raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
+  except outbox.QueueError as err:
+    raise error_handlers.InvalidAPIUsage(err.message, status_code=503)
 
   return jsonify({"status": "ok",
                   "reset_code": reset_code})
 
 
 @api_users.route('/find', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 def api_findusers():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -153,46 +150,56 @@ def api_findusers():
     raise error_handlers.InvalidAPIUsage("bad payload", status_code=400)
 
   email_address = html.escape(request_content['email'])
+  # contains (default), prefix (index backed) or substring (n-gram index backed)
+  search_mode = request_content.get("mode", "contains")
+
+  # Optional paging or NDJSON streaming, large result sets are never built in memory
+  paged_response = paged_find_response(request_content, email_address,
+                                       jots.pyauth.user.find_users_page,
+                                       jots.pyauth.user.iter_users_like,
+                                       jots.pyauth.user.InputError,
+                                       mode=search_mode,
+                                       db=DB_CON)
+  if paged_response is not None:
+    return paged_response
 
   try:
-    response = jots.pyauth.user.find_users_like(email_address, db=DB_CON)
+    response = jots.pyauth.user.find_users_like(email_address, db=DB_CON, mode=search_mode)
     return jsonify(response)
 
   except jots.pyauth.group.GroupNotFound:
     return jsonify(dict())
+  except jots.pyauth.user.InputError as err:
+    raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
 
 
 @api_users.route('/<user_id>/details')
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 def api_user_details(user_id):
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
   user_id = html.escape(user_id)
 
-  try:
+  with request_identity.api_lookup_errors("invalid user"):
     user = jots.pyauth.user.user(user_id=user_id, db=DB_CON)
-    return jsonify(user.properties.as_dict())
-  except jots.pyauth.user.UserNotFound:
-    raise error_handlers.InvalidAPIUsage("invalid user", status=403)
-  except jots.pyauth.user.InputError as err:
-    raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
+  return jsonify(user.properties.as_dict())
 
 
 @api_users.route('/<user_id>/set/<user_attribute>', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 @app_write_enabled_required
 def api_set_user_attribute(user_id, user_attribute):
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -219,7 +226,7 @@ def api_set_user_attribute(user_id, user_attribute):
   # Else use attribute change method
   if user_attribute == "status" and attribute_value == "reset":
     try:
-      reset_code = user.reset_password(service_domain=app.config['DOMAIN_NAME'])
+      reset_code = user.reset_password(service_domain=current_app.config['DOMAIN_NAME'])
     except jots.pyauth.user.UserActionError as err:
       raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
     except jots.pyauth.user.InputError as err:
@@ -229,25 +236,25 @@ def api_set_user_attribute(user_id, user_attribute):
     try:
       email_obj = mailer.personalised_email(recipient=user.properties.email,
                                             template_name="reset",
-                                            data={"site_name": app.config['DOMAIN_NAME'],
-                                                  "reset_url": "https://{}:{}/reset?q={}".format(app.config['DOMAIN_NAME'],
-                                                                                                 app.config['SERVER_PORT'],
+                                            data={"site_name": current_app.config['DOMAIN_NAME'],
+                                                  "reset_url": "https://{}:{}/reset?q={}".format(current_app.config['DOMAIN_NAME'],
+                                                                                                 current_app.config['SERVER_PORT'],
                                                                                                  reset_code)})
-      if app.config['TESTING']:
-        email_obj.send(mail_agent="file")
-      else:
-        email_obj.send()
+      # Rendered and sent by the mail outbox workers
+      outbox.enqueue(email_obj)
     except mailer.InputError as err:
       raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
     except mailer.MailActionError as err:
       raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
+    except outbox.QueueError as err:
+      raise error_handlers.InvalidAPIUsage(err.message, status_code=503)
 
-    return jsonify({"new_value": user.properties.as_dict()[user_attribute]})
+    return jsonify({"new_value": user.properties.get(user_attribute)})
 
   else:
     try:
       user.update_named_attribute(user_attribute, attribute_value)
-      return jsonify({"new_value": user.properties.as_dict()[user_attribute]})
+      return jsonify({"new_value": user.properties.get(user_attribute)})
     except jots.pyauth.user.InputError as err:
       raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
     except jots.pyauth.user.UserActionError as err:
@@ -255,14 +262,14 @@ def api_set_user_attribute(user_id, user_attribute):
 
 
 @api_users.route('/delete', methods=['POST'])
-@jwt_required
+@token_required
 @valid_id_required
 @user_is_admin
 @app_write_enabled_required
 def api_user_delete():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
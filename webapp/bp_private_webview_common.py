@@ -1,19 +1,13 @@
-import html
 import sys
-from urllib.parse import urlparse
 
 from functools import wraps
 
-from flask import Flask, request, render_template, jsonify, make_response, redirect, url_for, Blueprint
-from flask_jwt_extended import (
-    JWTManager, jwt_required, jwt_optional, jwt_refresh_token_required,
-    create_refresh_token, create_access_token,
-    set_access_cookies, set_refresh_cookies, unset_jwt_cookies,
-    get_jwt_identity, verify_jwt_in_request, get_raw_jwt
-)
+from flask import Flask, request, render_template, jsonify, make_response, redirect, url_for, Blueprint, current_app
+from flask_jwt_extended import set_access_cookies, get_jwt_identity, get_raw_jwt
 
-from jots.webapp import app
 from jots.webapp import error_handlers
+from jots.webapp import request_identity
+from jots.webapp.request_identity import current_identity, trusted_claims, refresh_token_required
 
 import jots.pyauth.user
 import jots.pyauth.group
@@ -22,44 +16,19 @@ web_private_common = Blueprint('private_webview_common', __name__)
 
 
 @web_private_common.route('/token/refresh')
-@jwt_refresh_token_required
+@refresh_token_required
 def refresh_get():
-  # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
-  else:
-    DB_CON = None
-
-  # Create the new access token
-  current_user = get_jwt_identity()
-  current_refresh_jti = get_raw_jwt()['jti']
-
-  try:
-    user = jots.pyauth.user.user(email_address=current_user, db=DB_CON)
-  except jots.pyauth.user.UserNotFound:
-    raise error_handlers.InvalidUsage("access denied", status_code=403)
-  except jots.pyauth.user.InputError:
-    raise error_handlers.InvalidUsage("access denied", status_code=403)
+  user = current_identity().get_user()
 
   # Check that refresh token given matches what is stored
-  if current_refresh_jti != user.properties.refreshJti:
+  if not request_identity.refresh_jti_valid(user, get_raw_jwt()['jti']):
     return redirect(url_for('public_webview_common.logout', request_path=request.path))
 
-  access_token = create_access_token(identity=current_user)
+  request_path = request_identity.refresh_redirect_path(request.args)
 
-  if "request_path" in request.args:
-    referrer_path = request.args.get("request_path")
-    # if // or . is given, assumption is that it is a domain name so must be checked
-    if "//" in referrer_path or "." in referrer_path:
-      # Don't redirect to sites that don't share the same root domain.
-      parsed_url = urlparse(referrer_path)
-      domain_name = '{url.scheme}://{url.netloc}'.format(url=parsed_url)
-      if app.config['DOMAIN_NAME'] not in domain_name:
-        raise error_handlers.InvalidUsage("out of domain request", status_code=403)
-
-    request_path = html.escape(request.args.get("request_path"))
-  else:
-    request_path = "/page"
+  # Create the new access token
+  group_names = user.get_group_names() if trusted_claims() else None
+  access_token = request_identity.refreshed_access_token(get_jwt_identity(), user.properties, group_names)
 
   print("token refreshed, redirecting to {}".format(request_path))
   response = make_response(redirect(request_path))
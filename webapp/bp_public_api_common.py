@@ -1,20 +1,15 @@
 import html
 import sys
 import datetime
-import base64
 
-from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint
+from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint, current_app
 from flask_jwt_extended import (
-    JWTManager, jwt_required, jwt_optional, jwt_refresh_token_required,
-    create_refresh_token, create_access_token,
-    set_access_cookies, set_refresh_cookies, unset_jwt_cookies,
-    get_jwt_identity, verify_jwt_in_request, get_jti
+    create_refresh_token, create_access_token, set_access_cookies, set_refresh_cookies, get_jti
 )
 
 import jots.pyauth.user
-import jots.pyauth.group
-from jots.webapp import app, jwt
 from jots.webapp import error_handlers
+from jots.webapp import request_identity
 from jots.mailer import send as mailer
 
 api_root = Blueprint('root_api', __name__)
@@ -27,8 +22,8 @@ def login_form():
       Returns access and refresh tokens with CSRF tokens
   '''
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -38,7 +33,8 @@ def login_form():
   password = form_data['password']
 
   try:
-    user = jots.pyauth.user.user(email_address=username, db=DB_CON)
+    # Password is checked straight away, fetch it with the rest of the user
+    user = jots.pyauth.user.user(email_address=username, db=DB_CON, lazy=False)
 
   except jots.pyauth.user.UserNotFound:
     raise error_handlers.InvalidAPIUsage("access denied", status_code=403)
@@ -53,15 +49,10 @@ def login_form():
   if not result:
     raise error_handlers.InvalidAPIUsage("access denied", status_code=403)
 
-  # Add user claims - groups, all except admin
-  group_data = jots.pyauth.group.find_user_in_group(user.properties.userId, db=DB_CON)
-  group_names = list()
-  for group in group_data.keys():
-    if group != "admin":
-      group_names.append(group)
-
+  # Add user claims - groups, all except admin, and the requester's details with trusted claims
   access_token = create_access_token(identity=username,
-                                     user_claims={"groups": group_names})
+                                     user_claims=request_identity.user_claims(user.properties,
+                                                                              user.get_group_names()))
 
   refresh_token = create_refresh_token(identity=username)
   refresh_jti = get_jti(refresh_token)
@@ -87,8 +78,8 @@ def reset_form():
       Returns to login if OK
   '''
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
@@ -135,37 +126,19 @@ def reset_form():
 @api_root.route('/token/new')
 def token_get():
   # Allow the use of a mock DB during testing
-  if app.config['TESTING']:
-    DB_CON = app.config['TEST_DB']
+  if current_app.config['TESTING']:
+    DB_CON = current_app.config['TEST_DB']
   else:
     DB_CON = None
 
-  if 'Authorization' not in request.headers:
-    raise error_handlers.InvalidAPIUsage("missing autorization header", status_code=400)
-
-  auth_header = request.headers.get('Authorization')
-  if "Basic " in auth_header:
-    auth_header = auth_header.split("Basic ")[1]
-
-  b64_auth_content = base64.b64decode(auth_header).decode('utf-8').strip()
+  key, secret = request_identity.basic_auth_credentials(request.headers.get('Authorization'))
+  with request_identity.api_lookup_errors("forbidden - bad app"):
+    app_obj = jots.pyauth.app.app(app_key=key, db=DB_CON, lazy=False)
 
-  if ":" not in b64_auth_content:
-    raise error_handlers.InvalidAPIUsage("bad autorization header", status_code=400)
-
-  key, secret = b64_auth_content.split(":")
-  try:
-    app_obj = jots.pyauth.app.app(app_key=key, db=DB_CON)
-  except jots.pyauth.app.AppNotFound:
-    raise error_handlers.InvalidAPIUsage("forbidden - bad app", status_code=403)
-  except jots.pyauth.app.InputError as err:
-    raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
+  authenticated = app_obj.authenticate(secret)
 
-  if app_obj.authenticate(secret):
-    expires = datetime.timedelta(days=30)
-    access_token = create_access_token(identity=app_obj.properties.appName,
-                                       expires_delta=expires,
-                                       user_claims={"appId": app_obj.properties.appId})
-    return access_token
+  if authenticated:
+    return request_identity.app_access_token(app_obj.properties)
   else:
     raise error_handlers.InvalidAPIUsage("permission denied", status_code=403)
 
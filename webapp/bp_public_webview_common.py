@@ -1,15 +1,9 @@
 import html
 import sys
 
-from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint
-from flask_jwt_extended import (
-    JWTManager, jwt_required, jwt_optional, jwt_refresh_token_required,
-    create_refresh_token, create_access_token,
-    set_access_cookies, set_refresh_cookies, unset_jwt_cookies,
-    get_jwt_identity, verify_jwt_in_request, get_jwt_claims
-)
-
-from jots.webapp import app
+from flask import Flask, request, render_template, jsonify, make_response, redirect, Blueprint, current_app
+from flask_jwt_extended import jwt_optional, unset_jwt_cookies, get_jwt_identity
+
 from jots.webapp import error_handlers
 
 
@@ -21,9 +15,9 @@ web_root = Blueprint("public_webview_common", __name__)
 def index():
   if get_jwt_identity() is None:
     return render_template("login.tmpl",
-                           api_url=app.config['DOMAIN_NAME'],
-                           server_port=app.config['SERVER_PORT'],
-                           protocol=app.config['SERVER_PROTOCOL'])
+                           api_url=current_app.config['DOMAIN_NAME'],
+                           server_port=current_app.config['SERVER_PORT'],
+                           protocol=current_app.config['SERVER_PROTOCOL'])
 
   else:
     return make_response(redirect("/page"))
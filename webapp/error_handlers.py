@@ -1,6 +1,12 @@
+import logging
+
 from flask import make_response, redirect, jsonify, render_template, request, url_for, Response
 
-from jots.webapp import app, jwt
+import jots.pyauth.hashing
+
+# The token loaders also answer the ASGI front, where a blocking print would hold up the event loop
+logger = logging.getLogger(__name__)
+
 
 class InvalidUsage(Exception):
   def __init__(self, message, status_code=400, payload=None):
@@ -15,7 +21,6 @@ class InvalidUsage(Exception):
     return rv
 
 
-@app.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
   return render_template("error.tmpl",
                          error_message=error.message,
@@ -24,11 +29,12 @@ def handle_invalid_usage(error):
 
 
 class InvalidAPIUsage(Exception):
-  def __init__(self, message, status_code=400, payload=None):
+  def __init__(self, message, status_code=400, payload=None, headers=None):
     Exception.__init__(self)
     self.message = message
     self.status_code = status_code
     self.payload = payload
+    self.headers = headers
 
   def to_dict(self):
     rv = dict(self.payload or ())
@@ -36,24 +42,30 @@ class InvalidAPIUsage(Exception):
     return rv
 
 
-@app.errorhandler(InvalidAPIUsage)
 def handle_invalid_api_usage(error):
   response = make_response(jsonify({'errorMessage': error.message,
                                     'errorData': error.payload,
                                     'errorCode': error.status_code}),
                            error.status_code)
   response.headers['Content-Type'] = "application/json"
+  for header, value in (error.headers or dict()).items():
+    response.headers[header] = value
   return response
 
-@jwt.expired_token_loader
+def handle_hashing_error(error):
+  # The bcrypt pool is saturated, timed out or failed - ask the client to come back shortly
+  return handle_invalid_api_usage(InvalidAPIUsage("busy - try again later", status_code=503,
+                                                  headers={"Retry-After": str(jots.pyauth.hashing.HASH_RETRY_AFTER)}))
+
+
 def expired_token_callback(token):
   token_type = token['type']
   if token_type == "access":
-    print("access token has expired - goto refresh")
+    logger.info("access token has expired - goto refresh")
     return redirect(url_for('private_webview_common.refresh_get', request_path=request.path))
 
   elif token_type == "refresh":
-    print("refresh token has expired - goto root/login")
+    logger.info("refresh token has expired - goto root/login")
     response = make_response(redirect("/"))
     return response
 
@@ -61,23 +73,32 @@ def expired_token_callback(token):
     raise InvalidUsage("unknown token type", status_code=403)
 
 
-@jwt.needs_fresh_token_loader
 def fresh_token_loader_callback():
-  print("token is not fresh - goto refresh")
+  logger.info("token is not fresh - goto refresh")
   response = make_response(redirect("/token/refresh"))
   return response
 
 
-@jwt.invalid_token_loader
-def invalid_token_callback():
-  print("token is invalid - goto root/login")
+def invalid_token_callback(error):
+  logger.info("token is invalid - goto root/login")
   response = make_response(redirect("/"))
   return response
 
 
-@jwt.unauthorized_loader
 def missing_token_callback(token):
-  print("token is missing - goto root/login")
+  logger.info("token is missing - goto root/login")
   response = make_response(redirect("/"))
   return response
 
+
+def init_app(app, jwt):
+  ''' Attach the handlers above to an app and its JWTManager
+  '''
+  app.register_error_handler(InvalidUsage, handle_invalid_usage)
+  app.register_error_handler(InvalidAPIUsage, handle_invalid_api_usage)
+  app.register_error_handler(jots.pyauth.hashing.Error, handle_hashing_error)
+
+  jwt.expired_token_loader(expired_token_callback)
+  jwt.needs_fresh_token_loader(fresh_token_loader_callback)
+  jwt.invalid_token_loader(invalid_token_callback)
+  jwt.unauthorized_loader(missing_token_callback)
@@ -0,0 +1,428 @@
+''' Who is making the request and what they may do
+    The decisions here are shared by the Flask views and decorators and the
+    ASGI front (asgi.py), which only differ in how a request arrives
+'''
+import html
+import base64
+import datetime
+import contextlib
+from functools import wraps
+from urllib.parse import urlparse
+from distutils.util import strtobool
+
+from flask import g, current_app
+from flask_jwt_extended import (
+    get_jwt_identity, get_jwt_claims, get_raw_jwt, create_access_token,
+    verify_jwt_in_request, verify_jwt_refresh_token_in_request
+)
+
+from jots.webapp import error_handlers
+import jots.pyauth.storage
+import jots.pyauth.user
+import jots.pyauth.group
+import jots.pyauth.app
+import jots.pyauth.async_auth
+
+
+class requester(object):
+  ''' Stands in for a user or app object when only its properties are loaded,
+      from trusted claims or an async lookup
+  '''
+  def __init__(self, properties):
+    self.properties = properties
+
+
+class identity(object):
+  ''' Request scoped view of the JWT identity
+      The requester is looked up once, resolved user, app and group objects
+      are memoised so decorators and views share them
+      With trusted claims the requester is built from the token, without a lookup
+  '''
+  def __init__(self, requester_id, claims=None, db=None, trusted=False):
+    self.requester_id = requester_id
+    self.claims = claims or dict()
+    self.db = db
+    self.trusted = trusted
+
+    self.resolved = False
+    self.from_claims = False
+    self.user_obj = None
+    self.app_obj = None
+    self._groups = dict()
+
+
+  def resolve(self):
+    if not self._needs_lookup():
+      return
+
+    for lookup in self._lookups():
+      if lookup():
+        break
+
+
+  def _needs_lookup(self):
+    # Marks the requester resolved, False if claims or a missing identity settle it
+    if self.resolved:
+      return False
+    self.resolved = True
+
+    if self.requester_id is None:
+      return False
+
+    return not (self.trusted and self._resolve_claims())
+
+
+  def _lookups(self):
+    ''' App tokens carry an appId claim, so the claim decides which collection
+        is queried first. The other is only tried if the first has no match
+    '''
+    if "appId" in self.claims:
+      return [self._resolve_app, self._resolve_user]
+    return [self._resolve_user, self._resolve_app]
+
+
+  def _resolve_claims(self):
+    # Tokens minted before trusted claims were enabled fall back to a lookup
+    from_claims = claims_properties(self.requester_id, self.claims)
+    if from_claims is None:
+      return False
+
+    user_props, app_props = from_claims
+    if user_props is not None:
+      self.user_obj = requester(user_props)
+    if app_props is not None:
+      self.app_obj = requester(app_props)
+
+    self.from_claims = True
+    return True
+
+
+  def _resolve_user(self):
+    try:
+      self.user_obj = jots.pyauth.user.user(email_address=self.requester_id, db=self.db)
+    except jots.pyauth.user.UserNotFound:
+      pass
+    except jots.pyauth.user.InputError:
+      pass
+
+    return self.user_obj is not None
+
+
+  def _resolve_app(self):
+    try:
+      self.app_obj = jots.pyauth.app.app(app_name=self.requester_id, db=self.db)
+    except jots.pyauth.app.AppNotFound:
+      pass
+    except jots.pyauth.app.InputError:
+      pass
+
+    return self.app_obj is not None
+
+
+  def get_user(self):
+    self.resolve()
+    return self.user_obj
+
+
+  def get_app(self):
+    self.resolve()
+    return self.app_obj
+
+
+  def is_admin(self):
+    ''' True if the requester is a user in the admin group
+        Raises InvalidAPIUsage if there is no admin group
+    '''
+    user = self.get_user()
+    if user is None:
+      return False
+
+    if self.from_claims:
+      return self.claims.get("admin") is True
+
+    with admin_group_required():
+      return jots.pyauth.group.user_in_group(user.properties.userId, "admin", db=self.db)
+
+
+  def get_group(self, group_name):
+    ''' Returns group object, raises GroupNotFound
+    '''
+    if group_name not in self._groups:
+      self._groups[group_name] = jots.pyauth.group.group(group_name=group_name, db=self.db)
+
+    return self._groups[group_name]
+
+
+class async_identity(identity):
+  ''' identity over a storage.async_backend, for the ASGI front
+      Same decisions, the lookups are awaited and load properties only
+  '''
+  async def resolve(self):
+    if not self._needs_lookup():
+      return
+
+    for lookup in self._lookups():
+      if await lookup():
+        break
+
+
+  async def _resolve_user(self):
+    try:
+      self.user_obj = requester(await jots.pyauth.async_auth.get_user(email_address=self.requester_id, db=self.db))
+    except (jots.pyauth.user.UserNotFound, jots.pyauth.user.InputError):
+      pass
+
+    return self.user_obj is not None
+
+
+  async def _resolve_app(self):
+    try:
+      self.app_obj = requester(await jots.pyauth.async_auth.get_app(app_name=self.requester_id, db=self.db,
+                                                                    projection={"secret": 0}))
+    except (jots.pyauth.app.AppNotFound, jots.pyauth.app.InputError):
+      pass
+
+    return self.app_obj is not None
+
+
+  async def get_user(self):
+    await self.resolve()
+    return self.user_obj
+
+
+  async def get_app(self):
+    await self.resolve()
+    return self.app_obj
+
+
+  async def is_admin(self):
+    user = await self.get_user()
+    if user is None:
+      return False
+
+    if self.from_claims:
+      return self.claims.get("admin") is True
+
+    with admin_group_required():
+      return await jots.pyauth.async_auth.user_in_group(user.properties, "admin", db=self.db)
+
+
+def verified_token(token_type="access"):
+  ''' The request's decoded JWT, looked up and checked by flask_jwt_extended, needs a request context
+      Raises its errors for the JWT loaders in error_handlers to answer
+  '''
+  if token_type == "refresh":
+    verify_jwt_refresh_token_in_request()
+  else:
+    verify_jwt_in_request()
+  return get_raw_jwt()
+
+
+def token_required(fn):
+  ''' As jwt_required, through verified_token
+  '''
+  @wraps(fn)
+  def wrapper(*args, **kwargs):
+    verified_token("access")
+    return fn(*args, **kwargs)
+  return wrapper
+
+
+def refresh_token_required(fn):
+  ''' As jwt_refresh_token_required, through verified_token
+  '''
+  @wraps(fn)
+  def wrapper(*args, **kwargs):
+    verified_token("refresh")
+    return fn(*args, **kwargs)
+  return wrapper
+
+
+@contextlib.contextmanager
+def admin_group_required():
+  try:
+    yield
+  except jots.pyauth.group.GroupNotFound:
+    raise error_handlers.InvalidAPIUsage("admin group not found", status_code=500)
+
+
+@contextlib.contextmanager
+def api_lookup_errors(not_found_message):
+  ''' User and app lookups as API errors - not found is 403, bad input 400
+  '''
+  try:
+    yield
+  except (jots.pyauth.user.UserNotFound, jots.pyauth.app.AppNotFound):
+    raise error_handlers.InvalidAPIUsage(not_found_message, status_code=403)
+  except (jots.pyauth.user.InputError, jots.pyauth.app.InputError) as err:
+    raise error_handlers.InvalidAPIUsage(err.message, status_code=400)
+
+
+def require_requester(user_obj, app_obj=None):
+  ''' Raises InvalidAPIUsage unless the request came from a known user or app
+  '''
+  if user_obj is None and app_obj is None:
+    raise error_handlers.InvalidAPIUsage("access denied", status_code=403)
+
+
+def require_admin(is_admin):
+  if not is_admin:
+    raise error_handlers.InvalidAPIUsage("access denied", status_code=403)
+
+
+def basic_auth_credentials(auth_header):
+  ''' Returns (key, secret) from an Authorization header, raises InvalidAPIUsage
+  '''
+  if auth_header is None:
+    raise error_handlers.InvalidAPIUsage("missing autorization header", status_code=400)
+
+  if "Basic " in auth_header:
+    auth_header = auth_header.split("Basic ")[1]
+
+  b64_auth_content = base64.b64decode(auth_header).decode('utf-8').strip()
+
+  if ":" not in b64_auth_content:
+    raise error_handlers.InvalidAPIUsage("bad autorization header", status_code=400)
+
+  key, secret = b64_auth_content.split(":")
+  return key, secret
+
+
+def refresh_jti_valid(user_obj, refresh_jti):
+  ''' True if the refresh token is the one stored for the user, the caller logs out if not
+      Raises InvalidUsage if the user is unknown
+  '''
+  if user_obj is None:
+    raise error_handlers.InvalidUsage("access denied", status_code=403)
+
+  return refresh_jti == user_obj.properties.get("refreshJti")
+
+
+def refresh_redirect_path(args, config=None):
+  ''' Where /token/refresh sends the client, request_path if in this domain
+      Raises InvalidUsage for other domains
+  '''
+  if config is None:
+    config = current_app.config
+
+  if "request_path" not in args:
+    return "/page"
+
+  referrer_path = args.get("request_path")
+  # if // or . is given, assumption is that it is a domain name so must be checked
+  if "//" in referrer_path or "." in referrer_path:
+    # Don't redirect to sites that don't share the same root domain.
+    parsed_url = urlparse(referrer_path)
+    domain_name = '{url.scheme}://{url.netloc}'.format(url=parsed_url)
+    if config['DOMAIN_NAME'] not in domain_name:
+      raise error_handlers.InvalidUsage("out of domain request", status_code=403)
+
+  return html.escape(referrer_path)
+
+
+def refreshed_access_token(identity_name, user_props, group_names=None):
+  ''' Access token issued on refresh, needs an app context
+      With trusted claims group_names is required, the claims are re-read here
+      so revocation and status changes apply from the next access token
+  '''
+  if trusted_claims():
+    return create_access_token(identity=identity_name, user_claims=user_claims(user_props, group_names))
+  return create_access_token(identity=identity_name)
+
+
+def app_access_token(app_props):
+  ''' Access token for an authenticated app, needs an app context
+  '''
+  return create_access_token(identity=app_props.appName,
+                             expires_delta=app_token_expires(),
+                             user_claims=app_claims(app_props))
+
+
+def trusted_claims(config=None):
+  ''' True when access tokens carry the requester's details and are authorised from them
+  '''
+  if config is None:
+    config = current_app.config
+  return config.get('TRUSTED_CLAIMS', False)
+
+
+def user_claims(user_props, group_names, config=None):
+  ''' Access token claims for a user - groups, all except admin
+      With trusted claims also the user ID, status and admin flag
+  '''
+  claims = {"groups": [group for group in group_names if group != "admin"]}
+  if trusted_claims(config):
+    claims['userId'] = user_props.userId
+    claims['status'] = user_props.status
+    claims['admin'] = "admin" in group_names
+  return claims
+
+
+def app_claims(app_props, config=None):
+  ''' Access token claims for an app - its ID, with trusted claims also write access
+  '''
+  claims = {"appId": app_props.appId}
+  if trusted_claims(config):
+    attributes = app_props.get("attributes") or dict()
+    claims['writeEnabled'] = bool(strtobool(attributes.get("writeEnabled", "false")))
+  return claims
+
+
+def app_token_expires(config=None):
+  ''' App tokens can't be refreshed, so with trusted claims they are kept short
+      and the app authenticates again for a new one
+  '''
+  if config is None:
+    config = current_app.config
+  if trusted_claims(config):
+    return datetime.timedelta(seconds=config['TRUSTED_APP_TOKEN_EXPIRES'])
+  return datetime.timedelta(days=30)
+
+
+def claims_properties(requester_id, claims):
+  ''' Requester from trusted claims as (user properties or None, app properties or None)
+      Users that aren't active are treated as not found
+      Returns None if the claims don't carry the requester's details
+  '''
+  if "userId" in claims and "status" in claims:
+    if claims['status'] != "active":
+      return None, None
+    return jots.pyauth.user.user_properties({"userId": claims['userId'],
+                                             "email": requester_id,
+                                             "status": claims['status']}), None
+
+  if "appId" in claims and "writeEnabled" in claims:
+    write_enabled = "true" if claims['writeEnabled'] is True else "false"
+    return None, jots.pyauth.app.app_properties({"appId": claims['appId'],
+                                                 "appName": requester_id,
+                                                 "attributes": {"writeEnabled": write_enabled}})
+
+  return None
+
+
+def request_db():
+  ''' One storage connection per request
+      Allow the use of a mock DB during testing
+  '''
+  if current_app.config['TESTING']:
+    return current_app.config['TEST_DB']
+
+  if "db" not in g:
+    # Backend from PYAUTHBACKEND, mongo assumes host and port have been set in envvars
+    g.db = jots.pyauth.storage.get_backend()
+
+  return g.db
+
+
+def current_identity():
+  ''' Returns the identity for the current request, creating it on first use
+      Must be called after the JWT has been verified
+  '''
+  if "identity" not in g:
+    # Only access tokens are trusted, refresh always checks the stored record
+    g.identity = identity(get_jwt_identity(),
+                          claims=get_jwt_claims(),
+                          db=request_db(),
+                          trusted=trusted_claims() and get_raw_jwt()['type'] == "access")
+
+  return g.identity